@@ -7,19 +7,49 @@ __author__ = "Justin B. (justin@justin.directory)"
 
 from os import environ
 
-from sqlalchemy import Engine, create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import URL, make_url
+from sqlalchemy.ext.asyncio import (AsyncEngine, async_sessionmaker,
+                                    create_async_engine)
+
+from app.database.observability import (SQL_ECHO, SQL_STATS,
+                                        instrument_queries)
+from app.database.pool import get_pool_options, instrument_pool
 
 DATABASE_URL = environ.get(
     "DATABASE_URL", "sqlite:///shipping.db?check_same_thread=False")
 
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "mysql": "aiomysql"
+}
+"""The async driver used for each database backend."""
+
+
+def get_async_url(url: str) -> URL:
+    """
+    Get the async equivalent of a database URL, so that sync URLs keep working.
+    For example, mysql+pymysql://... becomes mysql+aiomysql://...
+
+    :param url: the database URL
+    :return: the database URL, using the async driver of its backend
+    """
+    database_url = make_url(url)
+    driver = ASYNC_DRIVERS.get(database_url.get_backend_name())
+
+    if driver is None:
+        return database_url
+
+    return database_url.set(drivername=f"{database_url.get_backend_name()}+{driver}")
+
 
-engine: Engine = create_engine(
-    DATABASE_URL,
-    echo=True,
-    pool_pre_ping=True,
-    pool_recycle=60
+engine: AsyncEngine = create_async_engine(
+    get_async_url(DATABASE_URL),
+    echo=SQL_ECHO,
+    **get_pool_options(make_url(DATABASE_URL))
 )
+instrument_pool(engine)
+if SQL_STATS:
+    instrument_queries(engine)
 
-Session = sessionmaker(engine)
-session = Session()
+# Objects are not expired on commit, as reloading them would need another await.
+Session = async_sessionmaker(engine, expire_on_commit=False)
@@ -8,12 +8,9 @@ from app.database import Session
 
 async def get_db():
     """
-    Creates a database session from the database engine.
+    Creates an async database session from the database engine.
 
 
     """
-    db = Session()
-    try:
+    async with Session() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,215 @@
+"""
+Idempotency keys for requests that must not be run twice, such as creating a delivery.
+
+The first request with a key claims it, by inserting a record without a response.
+When it finishes, its response is stored, and every retry with the same key gets that response back.
+A request that commits its own transaction can store its response in that transaction,
+so the response is kept if and only if the work of the request is.
+Retries that arrive while the first request is still running wait for it to finish.
+If the first request fails, its claim is removed, so a retry runs the request again.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+from os import environ
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from pydantic import BaseModel
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import Session
+from app.database.schemas import IdempotencyRecord
+
+IDEMPOTENCY_TTL = timedelta(
+    hours=float(environ.get("IDEMPOTENCY_TTL_HOURS", "24")))
+"""How long the response of a request is kept for retries."""
+IDEMPOTENCY_LOCK_TIMEOUT = timedelta(
+    seconds=float(environ.get("IDEMPOTENCY_LOCK_SECONDS", "60")))
+"""How long a request can run before its claim is considered abandoned, and a retry can run it again."""
+IDEMPOTENCY_POLL_INTERVAL = 0.1
+"""How often a retry checks if a request on another worker has finished, in seconds."""
+
+ResponseModel = TypeVar("ResponseModel", bound=BaseModel)
+StoreResponse = Callable[[AsyncSession, BaseModel], Awaitable[None]]
+"""Stores the response of a request in a session, to be committed along with the rest of the request."""
+
+_in_flight: dict[str, asyncio.Event] = {}
+"""Requests that are running on this worker, by key hash."""
+
+
+class IdempotencyKeyMismatchException(Exception):
+    """Raised when an idempotency key is reused for a different request."""
+
+
+class IdempotencyKeyInProgressException(Exception):
+    """Raised when the request of an idempotency key did not finish in time for a retry."""
+
+
+def hash_key(operation: str, key: str) -> str:
+    """
+    Hash an idempotency key, so keys of any length fit the table, and each operation has its own keys.
+
+    :param operation: the operation that the key is for
+    :param key: the idempotency key
+    :return: the SHA-256 of the operation & key, as hex
+    """
+    return hashlib.sha256(f"{operation}\n{key}".encode()).hexdigest()
+
+
+async def _claim(key_hash: str, request_hash: str) -> tuple[bool, Optional[IdempotencyRecord]]:
+    """
+    Claim a key for a new request.
+
+    :return: whether the key was claimed, and the record of the request that has it otherwise, if it still exists
+    """
+    now = datetime.now()
+    async with Session() as db:
+        record = await db.get(IdempotencyRecord, key_hash)
+
+        if record is not None and record.expires_at <= now:
+            await db.delete(record)
+            record = None
+
+        if record is None:
+            db.add(IdempotencyRecord(
+                key_hash=key_hash,
+                request_hash=request_hash,
+                response=None,
+                created_at=now,
+                locked_until=now + IDEMPOTENCY_LOCK_TIMEOUT,
+                expires_at=now + IDEMPOTENCY_TTL
+            ))
+            try:
+                await db.commit()
+                return True, None
+            except IntegrityError:
+                # Another worker has claimed the same key in the meantime.
+                await db.rollback()
+                return False, await db.get(IdempotencyRecord, key_hash)
+
+        if record.response is None and record.locked_until <= now and record.request_hash == request_hash:
+            # The request was abandoned, so it is taken over, unless another retry got to it first.
+            result = await db.execute(
+                update(IdempotencyRecord)
+                .where(IdempotencyRecord.key_hash == key_hash)
+                .where(IdempotencyRecord.locked_until == record.locked_until)
+                .values(locked_until=now + IDEMPOTENCY_LOCK_TIMEOUT)
+            )
+            await db.commit()
+            if result.rowcount == 1:
+                return True, None
+
+        return False, record
+
+
+async def _finish(key_hash: str, response: Optional[BaseModel]):
+    """
+    Store the response of a request, or remove its claim if it failed.
+    """
+    async with Session() as db:
+        if response is None:
+            await db.execute(delete(IdempotencyRecord).where(IdempotencyRecord.key_hash == key_hash))
+        else:
+            await db.execute(
+                update(IdempotencyRecord)
+                .where(IdempotencyRecord.key_hash == key_hash)
+                .values(response=response.model_dump_json())
+            )
+        await db.commit()
+
+
+async def _store_nothing(_: AsyncSession, __: BaseModel):
+    pass
+
+
+async def run_idempotent(operation: str, key: Optional[str], request: BaseModel, response_type: type[ResponseModel], run: Callable[[StoreResponse], Awaitable[ResponseModel]], wait: float = 30) -> ResponseModel:
+    """
+    Run a request once for an idempotency key, and give every retry the same response.
+
+    :param operation: the operation that the key is for, such as the route & its path parameters
+    :param key: the idempotency key, or None to always run the request
+    :param request: the body of the request, which must be the same for every retry
+    :param response_type: the model of the response
+    :param run: runs the request, given a function that stores the response in the session it commits with.
+        If the response is not stored that way, it is stored once the request returns.
+    :param wait: how long a retry waits for the first request to finish, in seconds
+    :return: the response of the first request
+    :raises IdempotencyKeyMismatchException: if the key was used for a different request
+    :raises IdempotencyKeyInProgressException: if the first request did not finish in time
+    """
+    if key is None:
+        return await run(_store_nothing)
+
+    key_hash = hash_key(operation, key)
+    request_hash = hashlib.sha256(request.model_dump_json().encode()).hexdigest()
+    deadline = asyncio.get_running_loop().time() + wait
+
+    while True:
+        # Duplicates on this worker wait for the request here, instead of racing it for the claim.
+        event = _in_flight.get(key_hash)
+        if event is not None:
+            try:
+                await asyncio.wait_for(event.wait(), timeout=max(deadline - asyncio.get_running_loop().time(), 0))
+            except asyncio.TimeoutError:
+                raise IdempotencyKeyInProgressException(
+                    "The request with this idempotency key is still in progress.")
+            continue
+
+        event = _in_flight[key_hash] = asyncio.Event()
+        claimed = False
+        try:
+            claimed, record = await _claim(key_hash, request_hash)
+        finally:
+            # Duplicates waiting on this worker check again, even if the claim failed.
+            if not claimed:
+                del _in_flight[key_hash]
+                event.set()
+
+        if claimed:
+            break
+
+        if record is None:
+            # The claim that got in the way has already been removed.
+            continue
+        if record.request_hash != request_hash:
+            raise IdempotencyKeyMismatchException(
+                "The idempotency key was used for a different request.")
+        if record.response is not None:
+            return response_type.model_validate_json(record.response)
+
+        # The request is running on another worker, so check again shortly.
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            raise IdempotencyKeyInProgressException(
+                "The request with this idempotency key is still in progress.")
+        await asyncio.sleep(min(IDEMPOTENCY_POLL_INTERVAL, remaining))
+
+    response = None
+    stored = False
+
+    async def store(db: AsyncSession, stored_response: BaseModel):
+        nonlocal stored
+        await db.execute(
+            update(IdempotencyRecord)
+            .where(IdempotencyRecord.key_hash == key_hash)
+            .values(response=stored_response.model_dump_json())
+        )
+        stored = True
+
+    try:
+        response = await run(store)
+        return response
+    finally:
+        try:
+            # A request that failed did not commit the response it stored, so its claim is removed.
+            if response is None or not stored:
+                await _finish(key_hash, response)
+        finally:
+            del _in_flight[key_hash]
+            event.set()
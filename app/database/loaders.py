@@ -0,0 +1,36 @@
+"""
+Loader options for each kind of response.
+Every relationship that a response model reads is loaded with the query,
+so serializing a page costs a fixed amount of queries, no matter how many rows it has.
+
+Collections are loaded with selectinload, which is one extra query for the whole page.
+Single related rows are loaded with joinedload, which adds a join to the same query.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+from sqlalchemy.orm import joinedload, selectinload
+
+from app.database.schemas import Delivery, Return, Shipment
+
+shipment_loaders = (
+    selectinload(Shipment.items),
+)
+"""For shipment responses, which include the items."""
+
+shipment_status_loaders = (
+    joinedload(Shipment.status),
+    joinedload(Shipment.reservation)
+)
+"""For changes to the status of a shipment, which check its reservation."""
+
+delivery_loaders = (
+    selectinload(Delivery.shipments).selectinload(Shipment.items),
+)
+"""For delivery responses, which include the shipments & their items."""
+
+return_loaders = (
+    joinedload(Return.shipment).selectinload(Shipment.items),
+)
+"""For return responses, which include the shipment & its items."""
@@ -0,0 +1,62 @@
+"""
+All the models related to the database itself, rather than what is stored in it.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class PoolStats(BaseModel):
+    """
+    Connection pool counters for a worker, used to size the pool & find starvation.
+    """
+    size: Optional[int] = None
+    """The amount of connections the pool keeps open, or None if the pool is not sized."""
+    checked_out: Optional[int] = None
+    """The amount of connections that are currently in use."""
+    overflow: Optional[int] = None
+    """The amount of connections that are currently open past the pool size."""
+    peak_overflow: int = 0
+    """The most connections that have been open past the pool size at once."""
+    checkouts: int = 0
+    """The amount of times a connection was taken from the pool."""
+    overflow_checkouts: int = 0
+    """The amount of checkouts that happened while connections were open past the pool size."""
+    connects: int = 0
+    """The amount of new connections that were opened."""
+    invalidations: int = 0
+    """The amount of connections that were invalidated, such as after a disconnect."""
+    timeouts: int = 0
+    """The amount of checkouts that gave up waiting for a free connection."""
+    wait_seconds: float = 0.0
+    """The total time spent waiting for a connection, including opening new connections."""
+    max_wait_seconds: float = 0.0
+    """The longest time a single checkout waited for a connection."""
+
+
+class QueryStats(BaseModel):
+    """
+    The queries made while handling a single request.
+    """
+    queries: int = 0
+    """The amount of queries that were executed."""
+    seconds: float = 0.0
+    """The total time spent executing queries."""
+
+
+class RouteQueryStats(BaseModel):
+    """
+    The queries made by every request to a route, used to find N+1 patterns.
+    """
+    requests: int = 0
+    """The amount of requests that were handled."""
+    queries: int = 0
+    """The amount of queries that were executed, across all requests."""
+    max_queries: int = 0
+    """The most queries that a single request executed."""
+    seconds: float = 0.0
+    """The total time spent executing queries, across all requests."""
@@ -0,0 +1,106 @@
+"""
+SQL observability, which is much cheaper than echoing every statement.
+When enabled, every query is timed, and counted against the request that made it.
+Slow queries are always logged, and other queries can be sampled into the log.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import logging
+import random
+import time
+from contextvars import ContextVar
+from os import environ
+from typing import Any, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.database.models import QueryStats, RouteQueryStats
+
+SQL_ECHO = environ.get("SQL_ECHO", "false").lower() in ("1", "true", "yes")
+"""Whether every statement & its parameters are echoed. Only meant for local debugging."""
+SQL_STATS = environ.get("SQL_STATS", "false").lower() in ("1", "true", "yes")
+"""Whether queries are timed & counted per request, and reported in the Server-Timing header."""
+SQL_SLOW_QUERY_MS = float(environ.get("SQL_SLOW_QUERY_MS", "250"))
+"""Queries that take at least this long are logged, in milliseconds."""
+SQL_LOG_SAMPLE_RATE = float(environ.get("SQL_LOG_SAMPLE_RATE", "0"))
+"""The fraction of other queries that are logged, from 0 to 1."""
+
+logger = logging.getLogger("app.sql")
+
+route_query_stats: dict[str, RouteQueryStats] = {}
+"""The query counters of this worker, by route."""
+
+_request_stats: ContextVar[Optional[QueryStats]] = ContextVar(
+    "request_query_stats", default=None)
+"""The query counters of the request that is being handled, if it is tracked."""
+
+
+def track_queries() -> QueryStats:
+    """
+    Count the queries made by the current context, and any tasks it starts from now on.
+
+    :return: the counters, which are updated as queries finish
+    """
+    stats = QueryStats()
+    _request_stats.set(stats)
+    return stats
+
+
+def record_route_queries(route: str, stats: QueryStats):
+    """
+    Add the queries of a request to the counters of its route.
+
+    :param route: the method & path template of the route
+    :param stats: the queries of the request
+    """
+    route_stats = route_query_stats.setdefault(route, RouteQueryStats())
+    route_stats.requests += 1
+    route_stats.queries += stats.queries
+    route_stats.max_queries = max(route_stats.max_queries, stats.queries)
+    route_stats.seconds += stats.seconds
+
+
+def _before_cursor_execute(conn: Any, *_: Any):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn: Any, _cursor: Any, statement: str, *_: Any):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += elapsed
+
+    elapsed_ms = elapsed * 1000
+    if elapsed_ms >= SQL_SLOW_QUERY_MS:
+        logger.warning("Slow query (%.1f ms): %s", elapsed_ms, statement)
+    elif SQL_LOG_SAMPLE_RATE > 0 and random.random() < SQL_LOG_SAMPLE_RATE:
+        logger.info("Query (%.1f ms): %s", elapsed_ms, statement)
+
+
+def _handle_error(context: Any):
+    # A failed query never reaches after_cursor_execute, so drop its start time here.
+    if context.connection is not None and context.cursor is not None:
+        started = context.connection.info.get("query_started")
+        if started:
+            started.pop()
+
+
+def instrument_queries(engine: AsyncEngine):
+    """
+    Time every query made through an engine.
+    Instrumenting the same engine again does nothing.
+
+    :param engine: the engine to instrument
+    """
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
@@ -0,0 +1,123 @@
+"""
+Configuration & telemetry for the database connection pool.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import time
+from os import environ
+from typing import Any
+
+from sqlalchemy import URL, event, exc
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool
+
+from app.database.models import PoolStats
+
+DB_POOL_SIZE = int(environ.get("DB_POOL_SIZE", "5"))
+"""The amount of connections each worker keeps open."""
+DB_MAX_OVERFLOW = int(environ.get("DB_MAX_OVERFLOW", "10"))
+"""The amount of connections that can be opened past the pool size during peaks."""
+DB_POOL_TIMEOUT = float(environ.get("DB_POOL_TIMEOUT", "30"))
+"""How long a checkout waits for a free connection before it fails, in seconds."""
+DB_POOL_RECYCLE = int(environ.get("DB_POOL_RECYCLE", "1800"))
+"""How old a connection can get before it is replaced, in seconds. Keep this below the server's wait_timeout."""
+DB_POOL_PRE_PING = environ.get(
+    "DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+"""Whether connections are pinged on every checkout, for servers that drop idle connections early."""
+
+pool_stats = PoolStats()
+"""Connection pool counters for this worker."""
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """
+    A queue pool which records how long checkouts wait for a connection.
+    """
+
+    def _do_get(self) -> Any:
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            pool_stats.wait_seconds += waited
+            pool_stats.max_wait_seconds = max(
+                pool_stats.max_wait_seconds, waited)
+
+
+def get_pool_options(url: URL) -> dict[str, Any]:
+    """
+    Get the engine options for the connection pool of a database.
+    SQLite does not use a sized pool, so only recycling & pinging apply to it.
+
+    :param url: the database URL
+    :return: the keyword arguments for the engine
+    """
+    options: dict[str, Any] = {
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING
+    }
+
+    if url.get_backend_name() != "sqlite":
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT
+        )
+
+    return options
+
+
+def _current_overflow(pool: Pool) -> int:
+    # A queue pool counts up from -size, so anything above zero is overflow.
+    return max(0, pool.overflow()) if isinstance(pool, AsyncAdaptedQueuePool) else 0
+
+
+def instrument_pool(engine: AsyncEngine):
+    """
+    Count the checkouts, connects & invalidations of an engine's pool.
+
+    :param engine: the engine to instrument
+    """
+    pool = engine.sync_engine.pool
+
+    @event.listens_for(pool, "checkout")
+    def on_checkout(*_: Any):
+        pool_stats.checkouts += 1
+        overflow = _current_overflow(pool)
+        if overflow > 0:
+            pool_stats.overflow_checkouts += 1
+            pool_stats.peak_overflow = max(pool_stats.peak_overflow, overflow)
+
+    @event.listens_for(pool, "connect")
+    def on_connect(*_: Any):
+        pool_stats.connects += 1
+
+    @event.listens_for(pool, "invalidate")
+    @event.listens_for(pool, "soft_invalidate")
+    def on_invalidate(*_: Any):
+        pool_stats.invalidations += 1
+
+
+def get_pool_stats(engine: AsyncEngine) -> PoolStats:
+    """
+    Get the counters of an engine's pool, along with its current usage.
+
+    :param engine: the engine to get the pool stats for
+    :return: a snapshot of the pool stats
+    """
+    pool = engine.sync_engine.pool
+    stats = pool_stats.model_copy()
+
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        stats.size = pool.size()
+        stats.checked_out = pool.checkedout()
+        stats.overflow = _current_overflow(pool)
+
+    return stats
@@ -11,7 +11,7 @@ from typing import Optional
 from uuid import UUID
 
 from sqlalchemy import UUID as NativeUUID
-from sqlalchemy import VARCHAR, ForeignKey
+from sqlalchemy import VARCHAR, Connection, ForeignKey, Index, Text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 from app.shipping.enums import SLA
@@ -31,7 +31,7 @@ class Order(Base):
     __tablename__ = "orders"
     order_id: Mapped[UUID] = mapped_column(primary_key=True)
     """The ID of the order."""
-    customer_id: Mapped[UUID]
+    customer_id: Mapped[UUID] = mapped_column(index=True)
     """The ID of the customer that placed the order."""
     created_at: Mapped[datetime]
     """The date and time that the order was created."""
@@ -44,6 +44,11 @@ class Shipment(Base):
     Multiple shipments can be created for one order.
     """
     __tablename__ = "shipments"
+    __table_args__ = (
+        # Shipment listings filter by provider, and are always ordered by creation.
+        Index("ix_shipments_provider_created_at", "provider", "created_at"),
+        Index("ix_shipments_created_at", "created_at", "shipment_id"),
+    )
     shipment_id: Mapped[UUID] = mapped_column(NativeUUID, primary_key=True)
     """The ID of the shipment. This is a primary key"""
     from_address: Mapped[str] = mapped_column(VARCHAR(255))
@@ -78,7 +83,7 @@ class ShipmentDeliveryInfo(Base):
         ForeignKey("shipments.shipment_id"), primary_key=True)
     """A shipment ID that is associated with the delivery."""
     delivery_id: Mapped[UUID] = mapped_column(
-        ForeignKey("deliveries.delivery_id"), primary_key=True)
+        ForeignKey("deliveries.delivery_id"), primary_key=True, index=True)
     """A delivery ID that is associated with the shipment."""
 
 
@@ -89,7 +94,8 @@ class Delivery(Base):
     __tablename__ = "deliveries"
     delivery_id: Mapped[UUID] = mapped_column(NativeUUID, primary_key=True)
     """The ID of the delivery."""
-    order_id: Mapped[UUID] = mapped_column(ForeignKey("orders.order_id"))
+    order_id: Mapped[UUID] = mapped_column(
+        ForeignKey("orders.order_id"), index=True)
     """The ID of the order that is associated with the delivery."""
     order: Mapped[Order] = relationship(back_populates="deliveries")
     """The order that is associated with the delivery."""
@@ -133,7 +139,7 @@ class Return(Base):
     """
     The ID of the associated shipment that is used to get a return package.
     """
-    order_id: Mapped[UUID] = mapped_column(NativeUUID)
+    order_id: Mapped[UUID] = mapped_column(NativeUUID, index=True)
     """
     The ID of the order that is associated with the return.
     """
@@ -172,7 +178,7 @@ class ShipmentStatus(Base):
         ForeignKey("shipments.shipment_id"), primary_key=True
     )
     """The ID of the shipment that this status is associated with."""
-    message: Mapped[Status]
+    message: Mapped[Status] = mapped_column(index=True)
     """The status of the shipment."""
     expected_at: Mapped[datetime]
     """The expected time that the shipment should be delivered."""
@@ -189,7 +195,7 @@ class Warehouse(Base):
     __tablename__ = "warehouses"
     warehouse_id: Mapped[UUID] = mapped_column(NativeUUID, primary_key=True)
     """The ID of the warehouse."""
-    address: Mapped[str] = mapped_column(VARCHAR(255))
+    address: Mapped[str] = mapped_column(VARCHAR(255), index=True)
     """The address of the warehouse."""
     latitude: Mapped[float]
     """The latitude of the warehouse."""
@@ -207,6 +213,117 @@ class ShippingEmployeeReservation(Base):
     employee_id: Mapped[UUID] = mapped_column(NativeUUID, primary_key=True)
     """The ID of the employee that is reserved for the shipment."""
     shipment_id: Mapped[UUID] = mapped_column(
-        ForeignKey("shipments.shipment_id")
+        ForeignKey("shipments.shipment_id"), index=True
     )
     """The ID of the shipment that the employee is reserved for."""
+
+
+class GeocodedAddress(Base):
+    """
+    A cached geocoding result for a normalized address.
+    Shared by every worker, so addresses are only geocoded once per TTL.
+    """
+    __tablename__ = "geocoded_addresses"
+    address_key: Mapped[str] = mapped_column(VARCHAR(255), primary_key=True)
+    """The normalized address that was geocoded."""
+    latitude: Mapped[Optional[float]]
+    """The latitude of the address, or None if the address could not be found."""
+    longitude: Mapped[Optional[float]]
+    """The longitude of the address, or None if the address could not be found."""
+    cached_at: Mapped[datetime]
+    """The date and time that the address was geocoded."""
+    expires_at: Mapped[datetime]
+    """The date and time that the cached result should no longer be used."""
+
+
+class DeliveryEstimate(Base):
+    """
+    A precomputed delivery estimate from a warehouse to a destination cell, for a provider.
+    Destinations are grouped into geohash cells, and estimated from the center of the cell.
+    """
+    __tablename__ = "delivery_estimates"
+    cell: Mapped[str] = mapped_column(VARCHAR(12), primary_key=True)
+    """The geohash of the destination cell."""
+    warehouse_id: Mapped[UUID] = mapped_column(
+        ForeignKey("warehouses.warehouse_id"), primary_key=True)
+    """The ID of the warehouse that the delivery is coming from."""
+    provider: Mapped[Provider] = mapped_column(primary_key=True)
+    """The provider that is handling the delivery."""
+    transit_hours: Mapped[float]
+    """The estimated delivery time, in hours."""
+    price: Mapped[float]
+    """The estimated price of shipping."""
+
+
+class ShipmentSearchGram(Base):
+    """
+    A trigram of a searchable shipment field, used to narrow down wildcard searches.
+    Maintained as shipments are inserted, and can be rebuilt from the shipments at any time.
+    """
+    __tablename__ = "shipment_search_grams"
+    field: Mapped[str] = mapped_column(VARCHAR(16), primary_key=True)
+    """The name of the field that the trigram is from."""
+    gram: Mapped[str] = mapped_column(VARCHAR(3), primary_key=True)
+    """The trigram, taken from the normalized field."""
+    shipment_id: Mapped[UUID] = mapped_column(
+        NativeUUID, primary_key=True, index=True)
+    """The ID of the shipment that the field belongs to, indexed so a shipment's trigrams can be replaced."""
+
+
+class DeliverySearchKey(Base):
+    """
+    The normalized hex of a delivery ID, used to look up deliveries by a partial ID.
+    Maintained as deliveries are inserted, and can be rebuilt from the deliveries at any time.
+    """
+    __tablename__ = "delivery_search_keys"
+    delivery_hex: Mapped[str] = mapped_column(VARCHAR(32), primary_key=True)
+    """The delivery ID as 32 lowercase hex characters, without dashes."""
+    delivery_id: Mapped[UUID] = mapped_column(NativeUUID, unique=True)
+    """The ID of the delivery."""
+
+
+class DeliveryQuote(Base):
+    """
+    A delivery breakdown that was quoted to a client, so an order can be created from it without making it again.
+    """
+    __tablename__ = "delivery_quotes"
+    quote_id: Mapped[UUID] = mapped_column(NativeUUID, primary_key=True)
+    """The ID of the quote, which is signed before it is given to the client."""
+    breakdown: Mapped[str] = mapped_column(Text)
+    """The quoted breakdown, as JSON."""
+    created_at: Mapped[datetime]
+    """The date and time that the breakdown was quoted."""
+    expires_at: Mapped[datetime] = mapped_column(index=True)
+    """The date and time that the quote can no longer be used."""
+
+
+class IdempotencyRecord(Base):
+    """
+    The stored result of a request that was made with an idempotency key.
+    A record without a response is a request that is still in progress.
+    """
+    __tablename__ = "idempotency_records"
+    key_hash: Mapped[str] = mapped_column(VARCHAR(64), primary_key=True)
+    """The SHA-256 of the operation & the idempotency key, as hex."""
+    request_hash: Mapped[str] = mapped_column(VARCHAR(64))
+    """The SHA-256 of the request body, as hex, so a key cannot be reused for a different request."""
+    response: Mapped[Optional[str]] = mapped_column(Text)
+    """The response of the request as JSON, or None if it is still in progress."""
+    created_at: Mapped[datetime]
+    """The date and time that the request was first made."""
+    locked_until: Mapped[datetime]
+    """The date and time that an unfinished request is considered abandoned, and can be run again."""
+    expires_at: Mapped[datetime] = mapped_column(index=True)
+    """The date and time that the key can be used for a new request."""
+
+
+def create_missing_indexes(connection: Connection):
+    """
+    Create the indexes that are missing from tables that already exist.
+    Creating the tables only creates the indexes of new tables.
+
+    :param connection: the connection to create the indexes with
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
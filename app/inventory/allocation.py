@@ -0,0 +1,268 @@
+"""
+Allocation of order items to warehouses.
+Strategies are pluggable, and decide which warehouses an order is split between.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+from abc import ABC, abstractmethod
+from itertools import combinations
+from os import environ
+from typing import Optional
+from uuid import UUID
+
+import numpy as np
+from pydantic import BaseModel
+
+from app.inventory.models import WarehouseStockAvailability
+from app.shipping.models import ShipmentItem
+
+ALLOCATION_STRATEGY = environ.get("ALLOCATION_STRATEGY", "cover")
+"""The allocation strategy used for delivery breakdowns, either "cover" or "greedy"."""
+ALLOCATION_MAX_CANDIDATES = int(environ.get("ALLOCATION_MAX_CANDIDATES", "16"))
+"""The maximum amount of nearest warehouses that are considered for an order."""
+ALLOCATION_RADIUS_MILES = float(environ.get("ALLOCATION_RADIUS_MILES", "3000"))
+"""The maximum distance of a warehouse that is considered for an order."""
+ALLOCATION_SEARCH_LIMIT = int(environ.get("ALLOCATION_SEARCH_LIMIT", "5000"))
+"""The maximum amount of warehouse combinations that are checked for a smaller split."""
+
+
+class OutOfStockException(Exception):
+    """Raised when there is not enough stock to fulfill an order."""
+
+    def __init__(self, message: str, upcs: Optional[dict[UUID, list[int]]] = None) -> None:
+        super().__init__(message)
+        self.upcs = upcs or {}
+        """The UPCs that did not have enough stock, by warehouse ID, if they are known."""
+
+
+def take_stock_availability(warehouse_id: UUID, items: list[ShipmentItem], warehouse_stock: dict[int, int]) -> WarehouseStockAvailability:
+    """
+    For a given warehouse's stock by UPC, take as much of the items as the warehouse has.
+    Returns min(warehouse.stock, item.stock) for each item.
+    Mutates the stock of the items in the list.
+
+    :param warehouse_id: the ID of the warehouse
+    :param items: the items to take the stock for
+    :param warehouse_stock: the stock of the warehouse by UPC
+    """
+    stock_availability = []
+    for item in items:
+        min_value = min(warehouse_stock.get(item.upc, 0), item.stock)
+        stock_availability.append(ShipmentItem(
+            upc=item.upc,
+            stock=min_value
+        ))
+        item.stock -= min_value
+    return WarehouseStockAvailability(warehouse_id=warehouse_id, items=stock_availability)
+
+
+class AllocationCandidate(BaseModel):
+    """
+    A warehouse that an order can be allocated to.
+    """
+    warehouse_id: UUID
+    """The ID of the warehouse."""
+    distance: float
+    """The distance from the warehouse to the recipient, in miles."""
+    stock: dict[int, int]
+    """The stock of the warehouse, by UPC."""
+
+
+class AllocationStrategy(ABC):
+    """
+    A strategy which splits the items of an order between warehouses.
+
+    :param max_candidates: the maximum amount of nearest warehouses to consider
+    :param max_distance: the maximum distance of a warehouse to consider, in miles
+    """
+
+    def __init__(self, max_candidates: int, max_distance: Optional[float] = None) -> None:
+        self.max_candidates = max_candidates
+        self.max_distance = max_distance
+
+    @abstractmethod
+    def allocate(self, items: list[ShipmentItem], candidates: list[AllocationCandidate]) -> list[WarehouseStockAvailability]:
+        """
+        Split the items between the candidate warehouses.
+
+        :param items: the items to allocate
+        :param candidates: the candidate warehouses, nearest first
+        :return: the items that each chosen warehouse should ship
+        :raises OutOfStockException: if the candidates cannot fulfill the order
+        """
+        raise NotImplementedError()
+
+
+class GreedyNearestAllocation(AllocationStrategy):
+    """
+    Takes as much as possible from the nearest warehouse, then the next nearest, and so on.
+    Every warehouse that is visited gets a chunk, even if it could not give anything.
+    """
+
+    def __init__(self, max_candidates: int = 4, max_distance: Optional[float] = None) -> None:
+        super().__init__(max_candidates, max_distance)
+
+    def allocate(self, items: list[ShipmentItem], candidates: list[AllocationCandidate]) -> list[WarehouseStockAvailability]:
+        items_left = [item.model_copy() for item in items if item.stock > 0]
+        warehouse_chunks = []
+
+        for candidate in candidates:
+
+            if len(items_left) == 0:
+                break
+
+            warehouse_chunks.append(take_stock_availability(
+                candidate.warehouse_id, items_left, candidate.stock))
+            items_left = [item for item in items_left if item.stock > 0]
+
+        if len(items_left) > 0:
+            raise OutOfStockException("Not enough stock to fulfill the order.")
+
+        return warehouse_chunks
+
+
+class SetCoverAllocation(AllocationStrategy):
+    """
+    Splits an order between as few warehouses as possible, then as close as possible.
+    Shipping prices grow with distance, so the closest split is also the cheapest.
+
+    A weighted greedy set cover picks the warehouses, which is then improved by
+    dropping redundant warehouses and swapping in closer ones.
+    When that takes more than one warehouse, combinations of fewer warehouses
+    are searched exhaustively, up to the search limit.
+
+    :param search_limit: the maximum amount of combinations to check for a smaller split
+    """
+
+    def __init__(self, max_candidates: int = ALLOCATION_MAX_CANDIDATES, max_distance: Optional[float] = ALLOCATION_RADIUS_MILES, search_limit: int = ALLOCATION_SEARCH_LIMIT) -> None:
+        super().__init__(max_candidates, max_distance)
+        self.search_limit = search_limit
+
+    def allocate(self, items: list[ShipmentItem], candidates: list[AllocationCandidate]) -> list[WarehouseStockAvailability]:
+        # Merge duplicate UPCs, so each column of the matrix is one UPC.
+        needed: dict[int, int] = {}
+        for item in items:
+            if item.stock > 0:
+                needed[item.upc] = needed.get(item.upc, 0) + item.stock
+
+        if len(needed) == 0:
+            return []
+
+        upcs = list(needed.keys())
+        need = np.array([needed[upc] for upc in upcs])
+        # A (warehouses, UPCs) matrix of the stock that is useful for this order.
+        stock = np.array([
+            [candidate.stock.get(upc, 0) for upc in upcs]
+            for candidate in candidates
+        ]).reshape(len(candidates), len(upcs)).clip(0, need)
+        distances = np.array([candidate.distance for candidate in candidates])
+
+        if (stock.sum(axis=0) < need).any():
+            raise OutOfStockException("Not enough stock to fulfill the order.")
+
+        selected = self._improve(self._greedy(stock, need), stock, need, distances)
+        if len(selected) > 1:
+            selected = self._search(
+                stock, need, distances, len(selected) - 1) or selected
+
+        return self._assign(selected, stock, need, distances, upcs, candidates)
+
+    @staticmethod
+    def _covers(selected: list[int], stock: np.ndarray, need: np.ndarray) -> bool:
+        return bool((stock[selected].sum(axis=0) >= need).all())
+
+    @staticmethod
+    def _greedy(stock: np.ndarray, need: np.ndarray) -> list[int]:
+        """
+        Repeatedly pick the warehouse that covers the most of what is left.
+        Each UPC weighs the same, no matter the quantity, and ties go to the nearest warehouse.
+        """
+        remaining = need.copy()
+        selected: list[int] = []
+
+        while remaining.any():
+            coverage = (np.minimum(stock, remaining) /
+                        np.maximum(remaining, 1)).sum(axis=1)
+            coverage[selected] = -1
+            best = int(coverage.argmax())
+            selected.append(best)
+            remaining = remaining - np.minimum(stock[best], remaining)
+
+        return selected
+
+    def _improve(self, selected: list[int], stock: np.ndarray, need: np.ndarray, distances: np.ndarray) -> list[int]:
+        """
+        Drop warehouses that are not needed, then swap in closer warehouses where possible.
+        """
+        for index in sorted(selected, key=lambda i: -distances[i]):
+            rest = [i for i in selected if i != index]
+            if len(rest) > 0 and self._covers(rest, stock, need):
+                selected = rest
+
+        for index in sorted(selected, key=lambda i: -distances[i]):
+            rest = [i for i in selected if i != index]
+            for closer in np.flatnonzero(distances < distances[index]):
+                if closer not in selected and self._covers(rest + [int(closer)], stock, need):
+                    selected = rest + [int(closer)]
+                    break
+
+        return selected
+
+    def _search(self, stock: np.ndarray, need: np.ndarray, distances: np.ndarray, max_size: int) -> Optional[list[int]]:
+        """
+        Search combinations of up to max_size warehouses, smallest first.
+        Returns the closest combination of the smallest size that covers the order,
+        or None if there is none, or the search limit was reached.
+        """
+        checked = 0
+        for size in range(1, max_size + 1):
+            best: Optional[list[int]] = None
+            for combination in combinations(range(len(distances)), size):
+                checked += 1
+                if checked > self.search_limit:
+                    return best
+
+                if self._covers(list(combination), stock, need):
+                    if best is None or distances[list(combination)].sum() < distances[best].sum():
+                        best = list(combination)
+
+            if best is not None:
+                return best
+
+        return None
+
+    @staticmethod
+    def _assign(selected: list[int], stock: np.ndarray, need: np.ndarray, distances: np.ndarray, upcs: list[int], candidates: list[AllocationCandidate]) -> list[WarehouseStockAvailability]:
+        """
+        Take the items from the nearest chosen warehouse first.
+        Warehouses that end up with nothing to ship are left out.
+        """
+        remaining = need.copy()
+        warehouse_chunks = []
+
+        for index in sorted(selected, key=lambda i: distances[i]):
+            taken = np.minimum(stock[index], remaining)
+            remaining = remaining - taken
+
+            if not taken.any():
+                continue
+
+            warehouse_chunks.append(WarehouseStockAvailability(
+                warehouse_id=candidates[index].warehouse_id,
+                items=[
+                    ShipmentItem(upc=upc, stock=int(amount))
+                    for upc, amount in zip(upcs, taken)
+                    if amount > 0
+                ]
+            ))
+
+        return warehouse_chunks
+
+
+allocation_strategies: dict[str, AllocationStrategy] = {
+    "greedy": GreedyNearestAllocation(),
+    "cover": SetCoverAllocation()
+}
+"""The available allocation strategies, by name."""
@@ -0,0 +1,165 @@
+"""
+Spatial indexing for warehouses, used to find the nearest warehouses without sorting all of them.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import heapq
+import math
+import time
+from os import environ
+from typing import Any, Generic, Optional, TypeVar
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.schemas import Warehouse
+
+WAREHOUSE_INDEX_TTL = float(environ.get("WAREHOUSE_INDEX_TTL_SECONDS", "300"))
+"""
+How long the warehouse index is used before it is rebuilt, in seconds.
+Changes made by this worker rebuild the index right away, this catches changes made by other workers.
+"""
+
+T = TypeVar("T")
+
+Vector = tuple[float, float, float]
+
+
+def to_unit_vector(latitude: float, longitude: float) -> Vector:
+    """
+    Convert coordinates to a point on the unit sphere.
+    The straight-line distance between two of these points grows with the great-circle distance,
+    so nearest neighbours on the sphere are nearest neighbours on the globe.
+
+    :param latitude: the latitude, in degrees
+    :param longitude: the longitude, in degrees
+    :return: the point on the unit sphere
+    """
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    return (
+        math.cos(lat) * math.cos(lon),
+        math.cos(lat) * math.sin(lon),
+        math.sin(lat)
+    )
+
+
+class KDTree(Generic[T]):
+    """
+    A static k-d tree over 3D points, which answers k-nearest neighbour queries.
+
+    :param points: the points to index
+    :param values: the value associated with each point
+    """
+
+    def __init__(self, points: list[Vector], values: list[T]) -> None:
+        self.points = points
+        self.values = values
+        # Each node is (index, axis, left, right).
+        self.root = self._build(list(range(len(points))), 0)
+
+    def _build(self, indices: list[int], depth: int) -> Optional[tuple]:
+        if len(indices) == 0:
+            return None
+
+        axis = depth % 3
+        indices.sort(key=lambda i: self.points[i][axis])
+        median = len(indices) // 2
+
+        return (
+            indices[median],
+            axis,
+            self._build(indices[:median], depth + 1),
+            self._build(indices[median + 1:], depth + 1)
+        )
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def nearest(self, point: Vector, k: int) -> list[T]:
+        """
+        Get the k nearest values to a point, nearest first.
+
+        :param point: the point to search around
+        :param k: the amount of values to return
+        :return: the nearest values
+        """
+        # A max-heap of the best candidates so far, as (-distance, index).
+        best: list[tuple[float, int]] = []
+
+        def search(node: Optional[tuple]):
+            if node is None:
+                return
+
+            index, axis, left, right = node
+            candidate = self.points[index]
+            distance = sum((a - b) ** 2 for a, b in zip(point, candidate))
+
+            if len(best) < k:
+                heapq.heappush(best, (-distance, index))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, index))
+
+            delta = point[axis] - candidate[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            search(near)
+
+            # Only cross the splitting plane if it is closer than the worst candidate.
+            if len(best) < k or delta ** 2 < -best[0][0]:
+                search(far)
+
+        search(self.root)
+        return [self.values[index] for _, index in sorted(best, key=lambda entry: -entry[0])]
+
+
+class WarehouseIndex:
+    """
+    An in-memory spatial index of all warehouses.
+    Rebuilt when warehouses change in this worker, or when it is older than the TTL.
+
+    :param ttl: how long the index can be used before it is rebuilt, in seconds
+    """
+
+    def __init__(self, ttl: float = WAREHOUSE_INDEX_TTL) -> None:
+        self.ttl = ttl
+        self._tree: Optional[KDTree[Warehouse]] = None
+        self._built_at = 0.0
+
+    def mark_stale(self, *_: Any):
+        """
+        Mark the index as stale, so it is rebuilt on the next query.
+        """
+        self._tree = None
+
+    async def _get_tree(self, db: AsyncSession) -> KDTree[Warehouse]:
+        if self._tree is None or time.monotonic() - self._built_at > self.ttl:
+            warehouses = list(await db.scalars(select(Warehouse)))
+            points = [
+                to_unit_vector(warehouse.latitude, warehouse.longitude)
+                for warehouse in warehouses
+            ]
+            self._tree = KDTree(points, warehouses)
+            self._built_at = time.monotonic()
+
+        return self._tree
+
+    async def nearest(self, db: AsyncSession, coordinates: tuple[float, float], k: int) -> list[Warehouse]:
+        """
+        Get the k nearest warehouses to a set of coordinates, nearest first.
+
+        :param db: the database session used to build the index, if needed
+        :param coordinates: the coordinates to search around
+        :param k: the amount of warehouses to return
+        :return: the nearest warehouses
+        """
+        tree = await self._get_tree(db)
+        return tree.nearest(to_unit_vector(*coordinates), k)
+
+
+warehouse_index = WarehouseIndex()
+"""The warehouse index shared by this worker."""
+
+for _event in ("after_insert", "after_update", "after_delete"):
+    event.listen(Warehouse, _event, warehouse_index.mark_stale)
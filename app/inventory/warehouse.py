@@ -4,23 +4,29 @@ Warehouse related requests.
 
 __author__ = "Justin B. (justin@justin.directory)"
 
+from typing import Optional
 from uuid import UUID
 
-from geopy.distance import geodesic
+import numpy as np
+from sqlalchemy import case, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import Session, schemas
 from app.database.schemas import Warehouse
+from app.inventory.allocation import (ALLOCATION_STRATEGY,
+                                      AllocationCandidate, AllocationStrategy,
+                                      OutOfStockException,
+                                      allocation_strategies,
+                                      take_stock_availability)
 from app.inventory.models import WarehouseStockAvailability
+from app.inventory.spatial import warehouse_index
+from app.shipping.distance import distances
 from app.shipping.location import get_address_coordinates
 from app.shipping.models import ShipmentItem
 
 from . import client
 
 
-class OutOfStockException(Exception):
-    """Raised when there is not enough stock to fulfill an order."""
-
-
 async def get_warehouses() -> list[Warehouse]:
     """
     Get all warehouses.
@@ -36,8 +42,8 @@ async def get_warehouse(warehouse_id: UUID) -> Warehouse:
     Get a warehouse by its ID.
     """
     """TEST IMPL, VOLATILE!"""
-    with Session() as db:
-        warehouse = db.get(Warehouse, warehouse_id)
+    async with Session() as db:
+        warehouse = await db.get(Warehouse, warehouse_id)
         return warehouse
 
     response = await client.get(f"/warehouses/{warehouse_id}")
@@ -45,6 +51,20 @@ async def get_warehouse(warehouse_id: UUID) -> Warehouse:
     return response.json()
 
 
+async def get_warehouses_by_id(warehouse_ids: list[UUID]) -> dict[UUID, Warehouse]:
+    """
+    Get many warehouses by their IDs, with a single query.
+
+    :param warehouse_ids: the IDs of the warehouses
+    :return: the warehouses that were found, by ID
+    """
+    """TEST IMPL, VOLATILE!"""
+    async with Session() as db:
+        warehouses = await db.scalars(
+            select(Warehouse).where(Warehouse.warehouse_id.in_(warehouse_ids)))
+        return {warehouse.warehouse_id: warehouse for warehouse in warehouses}
+
+
 async def get_warehouse_by_address(address: str) -> Warehouse:
     """
     Get a warehouse by its address.
@@ -52,9 +72,9 @@ async def get_warehouse_by_address(address: str) -> Warehouse:
     :param address: the address of the warehouse
     """
     """TEST IMPL, VOLATILE!"""
-    with Session() as db:
-        warehouse = db.query(Warehouse).filter(
-            Warehouse.address == address).first()
+    async with Session() as db:
+        warehouse = await db.scalar(
+            select(Warehouse).where(Warehouse.address == address))
         if warehouse is None:
             raise ValueError("Warehouse not found.")
         return warehouse
@@ -69,19 +89,47 @@ async def get_warehouse_stock(warehouse_id: UUID, upcs: list[int]) -> list[Shipm
     Get the stock for a list of UPCs in a warehouse.
     """
     """TEST IMPL, VOLATILE!"""
-    with Session() as db:
-        items = db.query(schemas.WarehouseItem)\
-            .filter(schemas.WarehouseItem.warehouse_id == warehouse_id)\
-            .filter(schemas.WarehouseItem.upc.in_(upcs))\
-            .all()
+    async with Session() as db:
+        items = await db.scalars(
+            select(schemas.WarehouseItem)
+            .where(schemas.WarehouseItem.warehouse_id == warehouse_id)
+            .where(schemas.WarehouseItem.upc.in_(upcs))
+        )
 
-        return items
+        return items.all()
 
     response = await client.post(f"/warehouses/{warehouse_id}/stock", json={"items": upcs})
     response.raise_for_status()
     return response.json()
 
 
+async def get_warehouses_stock(warehouse_ids: list[UUID], upcs: list[int]) -> dict[UUID, dict[int, int]]:
+    """
+    Get the stock for a list of UPCs across many warehouses, with a single query.
+
+    :param warehouse_ids: the IDs of the warehouses
+    :param upcs: the UPCs to get the stock for
+    :return: the stock by UPC, by warehouse ID
+    """
+    """TEST IMPL, VOLATILE!"""
+    warehouse_stock: dict[UUID, dict[int, int]] = {
+        warehouse_id: {} for warehouse_id in warehouse_ids
+    }
+    async with Session() as db:
+        rows = await db.execute(
+            select(schemas.WarehouseItem.warehouse_id,
+                   schemas.WarehouseItem.upc,
+                   schemas.WarehouseItem.stock)
+            .where(schemas.WarehouseItem.warehouse_id.in_(warehouse_ids))
+            .where(schemas.WarehouseItem.upc.in_(upcs))
+        )
+
+        for warehouse_id, upc, stock in rows:
+            warehouse_stock[warehouse_id][upc] = stock
+
+    return warehouse_stock
+
+
 async def get_warehouse_stock_availability(warehouse_id: UUID, items: list[ShipmentItem]) -> WarehouseStockAvailability:
     """
     For a given warehouse, and a list of items with their UPC & stock, get the items available by UPC.
@@ -93,15 +141,35 @@ async def get_warehouse_stock_availability(warehouse_id: UUID, items: list[Shipm
     """
     warehouse_stock = await get_warehouse_stock(warehouse_id, [item.upc for item in items])
     warehouse_stock_map = {item.upc: item.stock for item in warehouse_stock}
-    stock_availability = []
-    for item in items:
-        min_value = min(warehouse_stock_map[item.upc], item.stock)
-        stock_availability.append(ShipmentItem(
-            upc=item.upc,
-            stock=min_value
-        ))
-        item.stock -= min_value
-    return WarehouseStockAvailability(warehouse_id=warehouse_id, items=stock_availability)
+    return take_stock_availability(warehouse_id, items, warehouse_stock_map)
+
+
+async def get_nearest_warehouse_distances(coordinates: tuple[float, float], count: int, max_distance: Optional[float] = None) -> list[tuple[Warehouse, float]]:
+    """
+    Get the nearest warehouses to a set of coordinates, with their distance in miles.
+    Candidates come from the spatial index, and are then ranked by their distance on the ellipsoid.
+
+    :param coordinates: the coordinates to search around
+    :param count: the maximum amount of warehouses to return
+    :param max_distance: the maximum distance of a warehouse, in miles
+    :return: the nearest warehouses & their distances, nearest first
+    """
+    async with Session() as db:
+        # The index ranks on a sphere, so take a few spare candidates for the ellipsoid ranking.
+        candidates = await warehouse_index.nearest(db, coordinates, count + 4)
+
+    miles = distances(
+        coordinates,
+        [(warehouse.latitude, warehouse.longitude) for warehouse in candidates],
+        precise=True
+    )
+    # A stable sort, so ties keep the order of the index.
+    order = np.argsort(miles, kind="stable")[:count]
+    return [
+        (candidates[i], float(miles[i]))
+        for i in order
+        if max_distance is None or miles[i] <= max_distance
+    ]
 
 
 async def get_nearest_warehouses(location: str) -> list[Warehouse]:
@@ -109,62 +177,158 @@ async def get_nearest_warehouses(location: str) -> list[Warehouse]:
     Get the 4 nearest warehouses to a given location.
     TODO: Move over to the warehouse API once it is implemented.
     """
-    with Session() as db:
-        coordinates = await get_address_coordinates(location)
-        warehouses = db.query(Warehouse).all()
-        nearest_warehouses = sorted(
-            warehouses,
-            key=lambda warehouse: geodesic(
-                coordinates, (warehouse.latitude, warehouse.longitude)).miles
-        )
-        nearest_warehouses = nearest_warehouses[:4]
-
-    return nearest_warehouses
+    coordinates = await get_address_coordinates(location)
+    nearest = await get_nearest_warehouse_distances(coordinates, 4)
+    return [warehouse for warehouse, _ in nearest]
 
 
-async def get_warehouse_chunks(address: str, items: list[ShipmentItem]) -> list[WarehouseStockAvailability]:
+async def get_warehouse_chunks(address: str, items: list[ShipmentItem], strategy: Optional[AllocationStrategy] = None) -> list[WarehouseStockAvailability]:
     """
-    Get a delivery breakdown given a specific SLA and items.
+    Split the items of an order between the warehouses near an address.
     If the order cannot be fulfilled, raise an OutOfStockException.
 
     :param address: the address to deliver to
     :param items: the items to deliver
+    :param strategy: the allocation strategy, or None for the configured strategy
     """
-    items_left = [item.model_copy() for item in items if item.stock > 0]
-    nearest_warehouses = await get_nearest_warehouses(address)
-    warehouse_chunks = []
+    if strategy is None:
+        strategy = allocation_strategies[ALLOCATION_STRATEGY]
+
+    coordinates = await get_address_coordinates(address)
+    nearest = await get_nearest_warehouse_distances(
+        coordinates, strategy.max_candidates, strategy.max_distance)
+    warehouse_stock = await get_warehouses_stock(
+        [warehouse.warehouse_id for warehouse, _ in nearest],
+        [item.upc for item in items]
+    )
+
+    candidates = [
+        AllocationCandidate(
+            warehouse_id=warehouse.warehouse_id,
+            distance=miles,
+            stock=warehouse_stock[warehouse.warehouse_id]
+        )
+        for warehouse, miles in nearest
+    ]
+    return strategy.allocate(items, candidates)
 
-    for warehouse in nearest_warehouses:
 
-        if len(items_left) == 0:
-            break
+def _stock_by_upc(items: list[ShipmentItem]) -> dict[int, int]:
+    stock: dict[int, int] = {}
+    for item in items:
+        if item.stock > 0:
+            stock[item.upc] = stock.get(item.upc, 0) + item.stock
+    return stock
 
-        warehouse_stock = await get_warehouse_stock_availability(warehouse.warehouse_id, items_left)
-        warehouse_chunks.append(warehouse_stock)
-        items_left = [item for item in items_left if item.stock > 0]
 
-    if len(items_left) > 0:
-        raise OutOfStockException("Not enough stock to fulfill the order.")
+async def reserve_warehouse_stock(db: AsyncSession, warehouse_items: dict[UUID, list[ShipmentItem]]):
+    """
+    Remove the stock of many items from many warehouses, without committing.
+    The rows are locked & checked with one query, then each warehouse is updated with one conditional UPDATE,
+    so concurrent orders can never take the stock of a warehouse below zero.
+    If any item is short, nothing is removed, and the transaction should be rolled back.
+
+    :param db: the database session to reserve the stock with
+    :param warehouse_items: the items to remove, by warehouse ID
+    :raises OutOfStockException: with the UPCs that did not have enough stock, by warehouse ID
+    """
+    """TEST IMPL, VOLATILE!"""
+    reservations = {
+        warehouse_id: stock
+        for warehouse_id, items in warehouse_items.items()
+        if len(stock := _stock_by_upc(items)) > 0
+    }
+    if len(reservations) == 0:
+        return
+
+    rows = await db.execute(
+        select(schemas.WarehouseItem.warehouse_id,
+               schemas.WarehouseItem.upc,
+               schemas.WarehouseItem.stock)
+        .where(schemas.WarehouseItem.warehouse_id.in_(reservations))
+        .where(schemas.WarehouseItem.upc.in_({upc for stock in reservations.values() for upc in stock}))
+        .with_for_update()
+    )
+    warehouse_stock = {(warehouse_id, upc): stock for warehouse_id, upc, stock in rows}
+
+    short_upcs = {
+        warehouse_id: sorted(
+            upc for upc, count in stock.items()
+            if warehouse_stock.get((warehouse_id, upc), 0) < count
+        )
+        for warehouse_id, stock in reservations.items()
+    }
+    short_upcs = {warehouse_id: upcs for warehouse_id, upcs in short_upcs.items() if len(upcs) > 0}
+    if len(short_upcs) > 0:
+        raise OutOfStockException("Not enough stock to fulfill the order.", short_upcs)
+
+    for warehouse_id, stock in reservations.items():
+        count = case(stock, value=schemas.WarehouseItem.upc)
+        result = await db.execute(
+            update(schemas.WarehouseItem)
+            .where(schemas.WarehouseItem.warehouse_id == warehouse_id)
+            .where(schemas.WarehouseItem.upc.in_(stock))
+            .where(schemas.WarehouseItem.stock >= count)
+            .values(stock=schemas.WarehouseItem.stock - count)
+            .execution_options(synchronize_session=False)
+        )
+
+        # The stock was checked above, so this is only reached if the rows were not locked.
+        if result.rowcount != len(stock):
+            rows = await db.execute(
+                select(schemas.WarehouseItem.upc, schemas.WarehouseItem.stock)
+                .where(schemas.WarehouseItem.warehouse_id == warehouse_id)
+                .where(schemas.WarehouseItem.upc.in_(stock))
+            )
+            current_stock = dict(rows.all())
+
+            # The rows that were updated hold exactly the checked stock minus the reservation.
+            short = sorted(
+                upc for upc, count in stock.items()
+                if current_stock.get(upc) != warehouse_stock[(warehouse_id, upc)] - count
+            )
+            raise OutOfStockException(
+                "Not enough stock to fulfill the order.", {warehouse_id: short or sorted(stock)})
+
+
+async def release_warehouse_stock(db: AsyncSession, warehouse_items: dict[UUID, list[ShipmentItem]]):
+    """
+    Add the stock of many items back to many warehouses, without committing.
+    Each warehouse is updated with one UPDATE.
 
-    return warehouse_chunks
+    :param db: the database session to release the stock with
+    :param warehouse_items: the items to add, by warehouse ID
+    """
+    """TEST IMPL, VOLATILE!"""
+    for warehouse_id, items in warehouse_items.items():
+        stock = _stock_by_upc(items)
+        if len(stock) == 0:
+            continue
+
+        await db.execute(
+            update(schemas.WarehouseItem)
+            .where(schemas.WarehouseItem.warehouse_id == warehouse_id)
+            .where(schemas.WarehouseItem.upc.in_(stock))
+            .values(stock=schemas.WarehouseItem.stock + case(stock, value=schemas.WarehouseItem.upc))
+            .execution_options(synchronize_session=False)
+        )
 
 
 async def remove_warehouse_stock(warehouse_id: UUID, items: list[ShipmentItem]):
     """
     Remove stock from a warehouse.
+
+    :raises OutOfStockException: if the warehouse does not have enough stock, in which case none is removed
     """
     """TEST IMPL, VOLATILE!"""
-    with Session() as db:
-        for item in items:
-            db_item = db.query(schemas.WarehouseItem)\
-                .filter(schemas.WarehouseItem.warehouse_id == warehouse_id)\
-                .filter(schemas.WarehouseItem.upc == item.upc)\
-                .first()
-
-            db_item.stock -= item.stock
+    async with Session() as db:
+        try:
+            await reserve_warehouse_stock(db, {warehouse_id: items})
+        except OutOfStockException:
+            await db.rollback()
+            raise
 
-        db.flush()
-        db.commit()
+        await db.commit()
 
     # response = await client.post(f"/warehouses/{warehouse_id}/stock/remove", json={"items": items})
     # response.raise_for_status()
@@ -176,17 +340,9 @@ async def add_warehouse_stock(warehouse_id: UUID, items: list[ShipmentItem]):
     Add stock to a warehouse.
     """
     """TEST IMPL, VOLATILE!"""
-    with Session() as db:
-        for item in items:
-            db_item = db.query(schemas.WarehouseItem)\
-                .filter(schemas.WarehouseItem.warehouse_id == warehouse_id)\
-                .filter(schemas.WarehouseItem.upc == item.upc)\
-                .first()
-
-            db_item.stock += item.stock
-
-        db.flush()
-        db.commit()
+    async with Session() as db:
+        await release_warehouse_stock(db, {warehouse_id: items})
+        await db.commit()
 
     # response = await client.post(f"/warehouses/{warehouse_id}/stock/add", json={"items": items})
     # response.raise_for_status()
@@ -4,6 +4,7 @@ The main module, containing the FastAPI application.
 
 __author__ = "Justin B. (justin@justin.directory)"
 
+from contextlib import asynccontextmanager
 from os import environ
 
 from fastapi import Depends, FastAPI
@@ -17,17 +18,33 @@ if __name__ == "__main__":
 from app.auth import CLIENT_ID, TENANT_ID, TENANT_SHORT_NAME
 from app.auth.dependencies import has_roles
 from app.database import engine
-from app.database.schemas import Base
+from app.database.observability import SQL_STATS
+from app.database.schemas import Base, create_missing_indexes
 from app.middleware.authenticate import EntraOAuth2Middleware
+from app.middleware.timing import QueryTimingMiddleware
 from app.routers import internal, me, orders, returns, shipments, users
+from app.shipping.location import geocoding_service
 
 SERVER_URL = environ.get("SERVER_URL", "http://127.0.0.1:8000")
 
-# Create all the tables mentioned in this schema.
-Base.metadata.create_all(bind=engine)
 
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """
+    Opens the long-lived services of a worker, and closes them on shutdown.
+    """
+    # Create all the tables mentioned in this schema.
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.run_sync(create_missing_indexes)
+
+    await geocoding_service.open()
+    yield
+    await geocoding_service.close()
+    await engine.dispose()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 # Middleware
 anonymous_endpoints = ["/docs", "/openapi.json", "/about"]
@@ -38,6 +55,8 @@ app.add_middleware(
     b2c_short_name=TENANT_SHORT_NAME,
     anonymous_endpoints=anonymous_endpoints
 )
+if SQL_STATS:
+    app.add_middleware(QueryTimingMiddleware)
 # Routers
 app.include_router(
     shipments.router,
@@ -55,6 +74,14 @@ app.include_router(
         Depends(has_roles(["SHP-DLR"]))
     ]
 )
+app.include_router(
+    internal.staff_router,
+    prefix="/internal",
+    tags=["internal"],
+    dependencies=[
+        Depends(has_roles(["SHP-STF"]))
+    ]
+)
 app.include_router(
     me.router,
     prefix="/me",
@@ -51,6 +51,11 @@ class EntraOAuth2Middleware:
         self.anonymous_endpoints = anonymous_endpoints
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # Lifespan & other scopes have no request to authenticate.
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
         url = URL(scope=scope)
 
         # If the URL is in the anonymous endpoints, we don't need to authenticate.
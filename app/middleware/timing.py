@@ -0,0 +1,50 @@
+"""
+Query Timing Middleware
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.database.observability import record_route_queries, track_queries
+
+
+class QueryTimingMiddleware:
+    """
+    Pure ASGI Middleware that counts the queries of each request.
+    The count & total time are added to the response as a Server-Timing header,
+    and to the counters of the route.
+
+    :param app: The ASGI application to wrap around.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = track_queries()
+
+        async def send_with_timing(message: Message):
+            # The endpoint has finished by the time the response starts.
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "Server-Timing",
+                    f'db;dur={stats.seconds * 1000:.1f};desc="{stats.queries} queries"'
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            # The router adds the matched route to the scope.
+            route = scope.get("route")
+            if route is not None:
+                record_route_queries(
+                    f"{scope['method']} {route.path}", stats)
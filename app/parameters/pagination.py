@@ -4,7 +4,18 @@ A pagination parameter is needed to limit the number of results returned by the
 
 __author__ = "Justin B. (justin@justin.directory)"
 
-from pydantic import BaseModel
+import base64
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+
+from fastapi import Response
+from pydantic import BaseModel, ValidationError
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+"""The response header with the cursor of the next page, if there is one."""
+PREV_CURSOR_HEADER = "X-Prev-Cursor"
+"""The response header with the cursor of the previous page, if there is one."""
 
 
 class PaginationParams(BaseModel):
@@ -13,3 +24,59 @@ class PaginationParams(BaseModel):
     """
     limit: int = 50
     offset: int = 0
+    cursor: Optional[str] = None
+    """
+    A cursor from the X-Next-Cursor or X-Prev-Cursor header of a previous page.
+    Cursors stay stable as rows are inserted, and the offset is ignored when one is given.
+    """
+
+
+class PageCursor(BaseModel):
+    """
+    A position in a listing that is ordered by creation, used for keyset pagination.
+    Encoded as an opaque string, so the format can change without breaking clients.
+    """
+    created_at: datetime
+    """The creation time of the row at the edge of the page."""
+    id: UUID
+    """The ID of the row at the edge of the page, which breaks ties in creation time."""
+    backwards: bool = False
+    """Whether the page is before this row, instead of after it."""
+
+    def encode(self) -> str:
+        """
+        Encode the cursor as an opaque, URL safe string.
+        """
+        return base64.urlsafe_b64encode(self.model_dump_json().encode()).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, cursor: str) -> "PageCursor":
+        """
+        Decode a cursor that was made with encode.
+
+        :param cursor: the encoded cursor
+        :return: the cursor
+        :raises ValueError: if the cursor is not valid
+        """
+        try:
+            padding = "=" * (-len(cursor) % 4)
+            return cls.model_validate_json(base64.urlsafe_b64decode(cursor + padding))
+        except (ValueError, ValidationError) as e:
+            raise ValueError("Invalid cursor.") from e
+
+
+def set_page_cursors(response: Optional[Response], next_cursor: Optional[PageCursor], prev_cursor: Optional[PageCursor]):
+    """
+    Add the cursors of the next & previous pages to the response headers.
+
+    :param response: the response, or None if the route was called directly
+    :param next_cursor: the cursor of the next page, or None if this is the last page
+    :param prev_cursor: the cursor of the previous page, or None if this is the first page
+    """
+    if response is None:
+        return
+
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor.encode()
+    if prev_cursor is not None:
+        response.headers[PREV_CURSOR_HEADER] = prev_cursor.encode()
@@ -27,7 +27,7 @@ class BaseShipmentQueryParams(PaginationParams):
     shipping_address: Optional[str] = None
     """The shipping address to filter by. This is a wildcard search."""
     delivery_id: Optional[str] = None
-    """The delivery ID to filter by. This is a partial UUID."""
+    """The delivery ID to filter by. This is the start of a UUID, and dashes are ignored."""
     tracking_id: Optional[str] = None
     """The tracking ID to filter by. This is a wildcard search."""
 
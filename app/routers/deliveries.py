@@ -6,27 +6,33 @@ __author__ = "Justin B. (justin@justin.directory)"
 
 from uuid import UUID
 
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import schemas
+from app.database import Session, schemas
 from app.database.dependencies import get_db
-from app.shipping.delivery import get_delivery_breakdown
+from app.database.loaders import shipment_loaders
+from app.shipping.delivery import (QuoteUnavailableException,
+                                   get_delivery_breakdown)
 from app.shipping.models import (CreateDeliveryRequest, Shipment,
                                  ShipmentDeliveryBreakdown)
+from app.shipping.quotes import save_quote
 
 router = APIRouter()
 
 
 @router.get("/{delivery_id}/shipments", operation_id="get_delivery_shipments")
-async def get_delivery_shipments(delivery_id: UUID, db: Session = Depends(get_db)) -> list[Shipment]:
+async def get_delivery_shipments(delivery_id: UUID, db: AsyncSession = Depends(get_db)) -> list[Shipment]:
     """
     Get all the shipments for a given delivery.
     """
-    shipments = db.query(schemas.Shipment)\
-        .join(schemas.ShipmentDeliveryInfo)\
-        .where(schemas.ShipmentDeliveryInfo.delivery_id == delivery_id)\
-        .all()
+    shipments = (await db.scalars(
+        select(schemas.Shipment)
+        .join(schemas.ShipmentDeliveryInfo)
+        .where(schemas.ShipmentDeliveryInfo.delivery_id == delivery_id)
+        .options(*shipment_loaders)
+    )).all()
 
     return shipments
 
@@ -35,6 +41,19 @@ async def get_delivery_shipments(delivery_id: UUID, db: Session = Depends(get_db
 async def make_delivery_breakdown(request: CreateDeliveryRequest) -> ShipmentDeliveryBreakdown:
     """
     Make a delivery breakdown with the given request.
+    The breakdown comes with a quote ID, which skips making it again when the delivery is created.
     """
-    breakdown = await get_delivery_breakdown(request.recipient_address, request.delivery_sla, request.items)
+    try:
+        breakdown = await get_delivery_breakdown(request.recipient_address, request.delivery_sla, request.items)
+    except QuoteUnavailableException as e:
+        raise HTTPException(
+            status_code=503,
+            detail={"error": "Quote unavailable",
+                    "unavailable_providers": e.unavailable_providers}
+        ) from e
+
+    async with Session() as db:
+        breakdown.quote_id = await save_quote(db, request, breakdown)
+        await db.commit()
+
     return breakdown
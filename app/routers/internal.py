@@ -8,24 +8,34 @@ __author__ = "Justin B. (justin@justin.directory)"
 from datetime import datetime
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy import select, union
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.auth.dependencies import get_profile
 from app.auth.profile import AccountProfile
-from app.database import schemas
+from app.database import engine, schemas
 from app.database.dependencies import get_db
+from app.database.loaders import shipment_loaders, shipment_status_loaders
+from app.database.observability import route_query_stats
+from app.database.pool import get_pool_stats
 from app.parameters.pagination import PaginationParams
 from app.parameters.shipment import FullShipmentQueryParams
 from app.routers.shipments import get_shipments
 from app.shipping.enums import Provider, Status
-from app.shipping.models import Shipment
+from app.shipping.location import (geocode_cache_stats,
+                                   get_addresses_coordinates)
+from app.shipping.models import (GeocodeWarmResponse, MetricsResponse,
+                                 SearchRebuildResponse, Shipment)
+from app.shipping.search import rebuild_search_index
 
 router = APIRouter()
+staff_router = APIRouter()
+"""Endpoints for staff under the same prefix, which do not require the driver role."""
 
 
 @router.get("/open_shipments", operation_id="get_open_shipments")
-async def get_open_shipments(params: PaginationParams = Depends(), db: Session = Depends(get_db)) -> list[Shipment]:
+async def get_open_shipments(params: PaginationParams = Depends(), db: AsyncSession = Depends(get_db), response: Response = None) -> list[Shipment]:
     """
     An endpoint which returns shipments that are internal, and in a pending status.
     This allows employees to take on individual shipments as needed.
@@ -34,21 +44,25 @@ async def get_open_shipments(params: PaginationParams = Depends(), db: Session =
     params = FullShipmentQueryParams(
         limit=params.limit,
         offset=params.offset,
+        cursor=params.cursor,
         date_desc=False,
         status=Status.PENDING,
         provider=Provider.INTERNAL
     )
 
-    open_shipments = await get_shipments(params, db)
+    open_shipments = await get_shipments(params, db, response)
     return open_shipments
 
 
 @router.post("/open_shipments/{shipment_id}/claim", operation_id="claim_open_shipment")
-async def claim_shipment(shipment_id: UUID, profile: AccountProfile = Depends(get_profile), db: Session = Depends(get_db)) -> Shipment:
+async def claim_shipment(shipment_id: UUID, profile: AccountProfile = Depends(get_profile), db: AsyncSession = Depends(get_db)) -> Shipment:
     """
     Claim a shipment for delivery.
     """
-    shipment = db.get(schemas.Shipment, shipment_id)
+    shipment = await db.get(schemas.Shipment, shipment_id, options=[
+        *shipment_loaders,
+        *shipment_status_loaders
+    ])
 
     if shipment is None:
         raise HTTPException(status_code=404, detail="Shipment not found.")
@@ -73,6 +87,54 @@ async def claim_shipment(shipment_id: UUID, profile: AccountProfile = Depends(ge
     )
 
     db.add(reservation)
-    db.commit()
+    await db.commit()
 
     return shipment
+
+
+@staff_router.post("/geocode/warm", operation_id="warm_geocode_cache")
+async def warm_geocode_cache(db: AsyncSession = Depends(get_db)) -> GeocodeWarmResponse:
+    """
+    Geocode every shipment & warehouse address ahead of time, so that they are cached before peak hours.
+    Addresses that are already cached are not geocoded again.
+    Addresses that the geocoder fails on are counted, without failing the rest.
+    """
+    addresses = (await db.scalars(union(
+        select(schemas.Shipment.shipping_address),
+        select(schemas.Shipment.from_address),
+        select(schemas.Warehouse.address)
+    ))).all()
+
+    coordinates, failed = await get_addresses_coordinates(addresses)
+    resolved = sum(1 for coordinate in coordinates.values()
+                   if coordinate is not None)
+
+    return GeocodeWarmResponse(
+        addresses=len(coordinates),
+        resolved=resolved,
+        not_found=len(coordinates) - resolved - len(failed),
+        failed=len(failed)
+    )
+
+
+@staff_router.post("/search/rebuild", operation_id="rebuild_search_index")
+async def rebuild_shipment_search_index(db: AsyncSession = Depends(get_db)) -> SearchRebuildResponse:
+    """
+    Rebuild the search indexes for the shipment filters from every shipment & delivery.
+    Only needed for rows that were written outside of the API, or before the indexes existed.
+    """
+    shipments, deliveries = await rebuild_search_index(db)
+    return SearchRebuildResponse(shipments=shipments, deliveries=deliveries)
+
+
+@staff_router.get("/metrics", operation_id="get_metrics")
+async def get_metrics() -> MetricsResponse:
+    """
+    Get the runtime metrics of this worker, such as connection pool usage.
+    Counters are kept per worker, and reset when it restarts.
+    """
+    return MetricsResponse(
+        pool=get_pool_stats(engine),
+        geocode_cache=geocode_cache_stats,
+        routes=route_query_stats
+    )
@@ -6,8 +6,8 @@ __author__ = "Justin B. (justin@justin.directory)"
 
 from uuid import UUID
 
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.auth.dependencies import get_profile
 from app.auth.profile import AccountProfile
@@ -21,17 +21,17 @@ router = APIRouter()
 
 
 @router.get("/shipments", operation_id="get_personal_shipments")
-async def get_my_shipments(params: BaseShipmentQueryParams = Depends(), profile: AccountProfile = Depends(get_profile), db: Session = Depends(get_db)) -> list[Shipment]:
+async def get_my_shipments(params: BaseShipmentQueryParams = Depends(), profile: AccountProfile = Depends(get_profile), db: AsyncSession = Depends(get_db), response: Response = None) -> list[Shipment]:
     """
     Get all the shipments related to the currently logged in user.
     """
     profile_id = profile.user_id
 
-    return await get_user_shipments(profile_id, params, db)
+    return await get_user_shipments(profile_id, params, db, response)
 
 
 @router.get("/shipments/{shipment_id}/status", operation_id="get_personal_shipment_status")
-async def get_my_shipment_status(shipment_id: UUID, db: Session = Depends(get_db), profile: AccountProfile = Depends(get_profile)) -> ShipmentStatus:
+async def get_my_shipment_status(shipment_id: UUID, db: AsyncSession = Depends(get_db), profile: AccountProfile = Depends(get_profile)) -> ShipmentStatus:
     """
     Get the status of a shipment for the currently logged in user.
     """
@@ -41,7 +41,7 @@ async def get_my_shipment_status(shipment_id: UUID, db: Session = Depends(get_db
 
 
 @router.get("/deliveries", operation_id="get_personal_deliveries")
-async def get_my_deliveries(db: Session = Depends(get_db), profile: AccountProfile = Depends(get_profile)) -> list[Delivery]:
+async def get_my_deliveries(db: AsyncSession = Depends(get_db), profile: AccountProfile = Depends(get_profile)) -> list[Delivery]:
     """
     Get all the deliveries related to this user.
     """
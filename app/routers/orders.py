@@ -5,63 +5,115 @@ All the routes to get shipping information related to billing orders.
 __author__ = "Justin B. (justin@justin.directory)"
 
 from datetime import datetime
+from typing import Annotated, Awaitable, Callable, Optional
 from uuid import UUID, uuid4
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.database import Session
 from app.database.dependencies import get_db
-from app.inventory.warehouse import add_warehouse_stock, remove_warehouse_stock
-from app.routers.deliveries import (get_delivery_shipments,
-                                    make_delivery_breakdown)
+from app.database.idempotency import (IdempotencyKeyInProgressException,
+                                      IdempotencyKeyMismatchException,
+                                      ResponseModel, StoreResponse,
+                                      run_idempotent)
+from app.database.loaders import delivery_loaders, return_loaders
+from app.inventory.allocation import OutOfStockException
+from app.inventory.warehouse import reserve_warehouse_stock
+from app.shipping.bulk import create_bulk_deliveries
+from app.shipping.delivery import (QuoteUnavailableException,
+                                   get_delivery_breakdown)
 from app.shipping.enums import Provider, Status
-from app.shipping.shipment import create_shipment
+from app.shipping.quotes import InvalidQuoteException, use_quote
+from app.shipping.shipment import cancel_shipments, create_shipments
 
 from ..database import schemas
-from ..shipping.models import (CreateDeliveryRequest, CreateReturnRequest,
-                               CreateShipmentRequest, Delivery,
-                               DeliveryTimeResponse, Return, Shipment)
+from ..shipping.models import (BulkDeliveryRequest, CreateDeliveryRequest,
+                               CreateReturnRequest, CreateShipmentRequest,
+                               Delivery, Return, Shipment)
 from ..shipping.providers.internal import client as internal_shipping
 
 router = APIRouter()
 
 
 @router.get("/{order_id}/deliveries", operation_id="get_order_deliveries")
-async def get_order_deliveries(order_id: UUID, db: Session = Depends(get_db)) -> list[Delivery]:
+async def get_order_deliveries(order_id: UUID, db: AsyncSession = Depends(get_db)) -> list[Delivery]:
     """
     Get all the deliveries for a given order.
+    The deliveries, their shipments & the shipment items are each loaded with one query,
+    no matter how many deliveries the order was split into.
 
     :param order_id: the ID of the order to get the deliveries for
     """
-    deliveries = db.query(schemas.Delivery)\
-        .where(schemas.Delivery.order_id == order_id)\
-        .all()
+    deliveries = (await db.scalars(
+        select(schemas.Delivery)
+        .where(schemas.Delivery.order_id == order_id)
+        .options(*delivery_loaders)
+    )).all()
 
-    delivery_models: list[Delivery] = []
-    for db_delivery in deliveries:
-        delivery_shipments = await get_delivery_shipments(db_delivery.delivery_id, db)
+    return [Delivery.model_validate(db_delivery) for db_delivery in deliveries]
 
-        delivery_models.append(Delivery(
-            delivery_id=db_delivery.delivery_id,
-            order_id=db_delivery.order_id,
-            created_at=db_delivery.created_at,
-            fulfilled_at=db_delivery.fulfilled_at,
-            delivery_sla=db_delivery.delivery_sla,
-            shipments=delivery_shipments
-        ))
-    return delivery_models
+
+async def _run_idempotent(operation: str, key: Optional[str], request: BaseModel, response_type: type[ResponseModel], run: Callable[[StoreResponse], Awaitable[ResponseModel]]) -> ResponseModel:
+    """
+    Run a request once for an idempotency key, turning misused keys into HTTP errors.
+    """
+    try:
+        return await run_idempotent(operation, key, request, response_type, run)
+    except IdempotencyKeyMismatchException as e:
+        raise HTTPException(
+            status_code=422,
+            detail={"error": "Idempotency key was used for a different request"}
+        ) from e
+    except IdempotencyKeyInProgressException as e:
+        raise HTTPException(
+            status_code=409,
+            detail={"error": "Request with this idempotency key is in progress"}
+        ) from e
 
 
 @router.post("/{order_id}/deliveries", status_code=201, operation_id="create_order_delivery")
-async def create_order_delivery(order_id: UUID, request: CreateDeliveryRequest, db: Session = Depends(get_db)) -> Delivery:
+async def create_order_delivery(order_id: UUID, request: CreateDeliveryRequest, db: AsyncSession = Depends(get_db), idempotency_key: Annotated[Optional[str], Header()] = None) -> Delivery:
     """
     Create a delivery for a given order.
+    Retries with the same Idempotency-Key header get the delivery that was created the first time.
 
     :param order_id: the ID of the order to create a delivery for
     :param request: the request to create the delivery
+    :param idempotency_key: a key that is unique to this delivery, chosen by the client
     """
+    return await _run_idempotent(
+        f"create_order_delivery:{order_id}", idempotency_key, request, Delivery,
+        lambda store_response: _create_order_delivery(order_id, request, db, store_response)
+    )
+
+
+async def _create_order_delivery(order_id: UUID, request: CreateDeliveryRequest, db: AsyncSession, store_response: StoreResponse) -> Delivery:
     # We first need to get the delivery breakdown to see if we can meet the SLA.
-    delivery_breakdown = await make_delivery_breakdown(request)
+    # A quoted breakdown is used as is, since the stock is checked again when it is reserved.
+    delivery_breakdown = None
+    if request.quote_id is not None:
+        try:
+            delivery_breakdown = await use_quote(db, request)
+        except InvalidQuoteException as e:
+            raise HTTPException(
+                status_code=400,
+                detail={"error": "Invalid quote"}
+            ) from e
+
+    if delivery_breakdown is None:
+        try:
+            delivery_breakdown = await get_delivery_breakdown(
+                request.recipient_address, request.delivery_sla, request.items)
+        except QuoteUnavailableException as e:
+            raise HTTPException(
+                status_code=503,
+                detail={"error": "Quote unavailable",
+                        "unavailable_providers": e.unavailable_providers}
+            ) from e
 
     # If we cannot meet the SLA, we should return an error.
     if not delivery_breakdown.can_meet_sla:
@@ -73,30 +125,31 @@ async def create_order_delivery(order_id: UUID, request: CreateDeliveryRequest,
 
     delivery_id = uuid4()
     shipments: list[Shipment] = []
-    db_shipments: list[schemas.Shipment] = []
-    successful_item_removals: list[DeliveryTimeResponse] = []
     try:
-        for delivery_time in delivery_breakdown.delivery_times:
-
-            # first, remove the stock from the associated warehouse.
-            # if this excepts, we should rollback the previous stock removals.
-            await remove_warehouse_stock(delivery_time.warehouse_id, delivery_time.items)
-            successful_item_removals.append(delivery_time)
-
-            shipment_request = CreateShipmentRequest(
-                order_id=order_id,
-                shipping_address=request.recipient_address,
-                from_address=delivery_time.from_address,
-                items=delivery_time.items,
-                provider=delivery_time.provider
+        # The breakdown already quoted every chunk, so the shipments are not estimated again.
+        shipments = await create_shipments([
+            (
+                CreateShipmentRequest(
+                    order_id=order_id,
+                    shipping_address=request.recipient_address,
+                    from_address=delivery_time.from_address,
+                    items=delivery_time.items,
+                    provider=delivery_time.provider
+                ),
+                delivery_time.delivery_time
             )
-
-            # Create the shipment and add it to the list of shipment for the model.
-            shipment = await create_shipment(shipment_request)
-            shipments.append(shipment)
-
-            # Create the shipment model and add it to the list of delivery infos.
-            db_shipment = schemas.Shipment(
+            for delivery_time in delivery_breakdown.delivery_times
+        ])
+
+        # The stock is only locked once the providers have answered, so other orders do not wait on them.
+        # The stock of every warehouse is reserved at once, and is only removed if the delivery is committed.
+        await reserve_warehouse_stock(db, {
+            delivery_time.warehouse_id: delivery_time.items
+            for delivery_time in delivery_breakdown.delivery_times
+        })
+
+        db_shipments = [
+            schemas.Shipment(
                 **shipment.model_dump(exclude=["items"]),
                 status=schemas.ShipmentStatus(
                     message=Status.PENDING,
@@ -111,10 +164,10 @@ async def create_order_delivery(order_id: UUID, request: CreateDeliveryRequest,
                     for item in shipment.items
                 ]
             )
+            for shipment, delivery_time in zip(shipments, delivery_breakdown.delivery_times)
+        ]
 
-            db_shipments.append(db_shipment)
-
-        dump = request.model_dump(exclude=["items"])
+        dump = request.model_dump(exclude=["items", "quote_id"])
         created_at = datetime.now()
         db_delivery = schemas.Delivery(
             delivery_id=delivery_id,
@@ -125,9 +178,8 @@ async def create_order_delivery(order_id: UUID, request: CreateDeliveryRequest,
         )
 
         db.add(db_delivery)
-        db.commit()
 
-        return Delivery(
+        delivery = Delivery(
             delivery_id=delivery_id,
             order_id=order_id,
             created_at=created_at,
@@ -135,32 +187,74 @@ async def create_order_delivery(order_id: UUID, request: CreateDeliveryRequest,
 
             **dump,
         )
-    except Exception as e:
-        # If we have an exception, we should rollback the stock removals.
-        for delivery_time in successful_item_removals:
-            await add_warehouse_stock(delivery_time.warehouse_id, delivery_time.items)
 
-        db.rollback()
+        # The response of an idempotent request is kept only if the delivery is.
+        await store_response(db, delivery)
+        await db.commit()
+
+        return delivery
+    except OutOfStockException as e:
+        # The stock was taken by another order since the breakdown was made.
+        await db.rollback()
+        await cancel_shipments(shipments)
+        raise HTTPException(
+            status_code=409,
+            detail={"error": "Out of stock",
+                    "upcs": {str(warehouse_id): upcs for warehouse_id, upcs in e.upcs.items()}}
+        ) from e
+    except Exception as e:
+        # Rolling back releases the reserved stock along with everything else.
+        await db.rollback()
+        await cancel_shipments(shipments)
         raise e
 
 
+@router.post("/deliveries", operation_id="create_bulk_deliveries")
+async def create_bulk_order_deliveries(requests: list[BulkDeliveryRequest]) -> StreamingResponse:
+    """
+    Create a delivery for each of many orders, such as an import from the marketplace.
+    The result of each order is streamed as a line of JSON, in the order of the requests,
+    as soon as the batch that it is in is committed.
+    An order that cannot be fulfilled gets an error, without failing the other orders.
+
+    :param requests: the deliveries to create, each for its own order
+    """
+    async def stream():
+        # The session outlives the request dependencies, since the response is streamed.
+        async with Session() as db:
+            async for result in create_bulk_deliveries(db, requests):
+                yield result.model_dump_json() + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 @router.get("/{order_id}/returns", operation_id="get_order_returns")
-async def get_order_returns(order_id: UUID, db: Session = Depends(get_db)) -> list[Return]:
+async def get_order_returns(order_id: UUID, db: AsyncSession = Depends(get_db)) -> list[Return]:
     """
     Get all the returns for a given order.
     """
-    returns = db.query(schemas.Return)\
-        .where(schemas.Return.order_id == order_id)\
-        .all()
+    returns = (await db.scalars(
+        select(schemas.Return)
+        .where(schemas.Return.order_id == order_id)
+        .options(*return_loaders)
+    )).all()
 
     return returns
 
 
 @router.post("/{order_id}/returns", status_code=201)
-async def create_order_return(order_id: UUID, return_request: CreateReturnRequest, db: Session = Depends(get_db)) -> Return:
+async def create_order_return(order_id: UUID, return_request: CreateReturnRequest, db: AsyncSession = Depends(get_db), idempotency_key: Annotated[Optional[str], Header()] = None) -> Return:
     """
     Create a return for a given order.
+    Retries with the same Idempotency-Key header get the return that was created the first time.
     """
+    return await _run_idempotent(
+        f"create_order_return:{order_id}", idempotency_key, return_request, Return,
+        lambda store_response: _create_order_return(order_id, return_request, db, store_response)
+    )
+
+
+async def _create_order_return(order_id: UUID, return_request: CreateReturnRequest, db: AsyncSession, store_response: StoreResponse) -> Return:
     return_id = uuid4()
 
     # Create a shipment request, and send to internal_shipping
@@ -189,7 +283,6 @@ async def create_order_return(order_id: UUID, return_request: CreateReturnReques
     )
 
     db.add(db_return)
-    db.commit()
 
     model_return = Return(
         order_id=order_id,
@@ -199,4 +292,8 @@ async def create_order_return(order_id: UUID, return_request: CreateReturnReques
         items=return_request.items
     )
 
+    # The response of an idempotent request is kept only if the return is.
+    await store_response(db, model_return)
+    await db.commit()
+
     return model_return
@@ -4,69 +4,74 @@ A router containing endpoints for getting shipment information & creating shipme
 
 __author__ = "Justin B. (justin@justin.directory)"
 
+import csv
+import io
 from datetime import datetime
+from enum import Enum
+from os import environ
+from typing import Annotated, AsyncIterator
 from uuid import UUID
 
-import sqlalchemy
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import cast
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select, and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.auth.dependencies import get_profile
 from app.auth.profile import AccountProfile
-from app.database import schemas
+from app.database import Session, schemas
 from app.database.dependencies import get_db
-from app.parameters.shipment import FullShipmentQueryParams
+from app.database.loaders import shipment_loaders, shipment_status_loaders
+from app.parameters.pagination import PageCursor, set_page_cursors
+from app.parameters.shipment import (BaseShipmentQueryParams,
+                                     FullShipmentQueryParams)
 from app.shipping.delivery import shipping_providers
 from app.shipping.enums import Provider
 from app.shipping.models import (Shipment, ShipmentStatus,
                                  ShipmentStatusPatchRequest)
+from app.shipping.search import contains_text, delivery_id_prefix
 
-router = APIRouter()
+SHIPMENT_EXPORT_BATCH_SIZE = int(
+    environ.get("SHIPMENT_EXPORT_BATCH_SIZE", "1000"))
+"""The amount of shipments that are read from the database at once when exporting."""
+EXPORT_CSV_COLUMNS = ["shipment_id", "from_address", "shipping_address",
+                      "provider", "provider_shipment_id", "created_at", "items"]
+"""The header of the CSV export."""
 
 
-@router.get("/{shipment_id}", operation_id="get_shipment")
-async def get_shipment(shipment_id: UUID, db: Session = Depends(get_db)) -> Shipment:
+class ExportFormat(str, Enum):
     """
-    Get the shipment using a specific shipment ID.
-
-    :param shipment_id: the ID of the shipment to get
-    :return: the shipment
+    The formats that shipments can be exported in.
     """
-    shipment = db.get(schemas.Shipment, shipment_id)
+    NDJSON = "ndjson"
+    CSV = "csv"
 
-    if shipment is None:
-        raise HTTPException(status_code=404, detail="Shipment not found.")
 
-    return shipment
+router = APIRouter()
 
 
-@router.get("/", operation_id="get_shipments")
-async def get_shipments(params: FullShipmentQueryParams = Depends(), db: Session = Depends(get_db)) -> list[Shipment]:
-    """
-    Get all the shipments related to this user.
+def filter_shipments(query: Select, params: BaseShipmentQueryParams) -> Select:
     """
+    Apply the filters of the shipment query parameters to a shipments query.
 
-    query = db.query(schemas.Shipment)
+    :param query: the query that selects the shipments
+    :param params: the parameters to filter by
+    :return: the filtered query
+    """
+    user_id = getattr(params, "user_id", None)
 
     # If we have a filter that requires table joins, we add them here.
-    if params.delivery_id is not None or params.user_id is not None:
+    if params.delivery_id is not None or user_id is not None:
         query = query.join(schemas.Shipment.delivery)
 
     # Same for delivery ID, but requires additional joins.
-    if params.user_id is not None:
+    if user_id is not None:
         query = query\
             .join(schemas.Delivery.order)\
-            .filter(schemas.Order.customer_id == params.user_id)
+            .filter(schemas.Order.customer_id == user_id)
 
     if params.delivery_id is not None:
-        query = query.filter(
-            cast(
-                schemas.Delivery.delivery_id, sqlalchemy.String
-            ).ilike(
-                f"%{params.delivery_id}%"
-            )
-        )
+        query = query.filter(delivery_id_prefix(params.delivery_id))
 
     if params.provider is not None:
         query = query.filter(schemas.Shipment.provider == params.provider)
@@ -77,29 +82,167 @@ async def get_shipments(params: FullShipmentQueryParams = Depends(), db: Session
             .filter(schemas.ShipmentStatus.message == params.status)
 
     if params.from_address is not None:
-        query = query.filter(schemas.Shipment.from_address.ilike(
-            f"%{params.from_address}%"))
+        query = query.filter(contains_text(
+            "from_address", params.from_address))
 
     if params.shipping_address is not None:
-        query = query.filter(schemas.Shipment.shipping_address.ilike(
-            f"%{params.shipping_address}%"))
+        query = query.filter(contains_text(
+            "shipping_address", params.shipping_address))
 
     if params.tracking_id is not None:
-        query = query.filter(schemas.Shipment.provider_shipment_id.ilike(
-            f"%{params.tracking_id}%"))
+        query = query.filter(contains_text(
+            "tracking_id", params.tracking_id))
+
+    return query
+
+
+async def stream_shipments(params: FullShipmentQueryParams, export_format: ExportFormat) -> AsyncIterator[str]:
+    """
+    Stream every shipment that matches the filters, ordered by creation, as NDJSON or CSV.
+    Shipments are read through a server side cursor in batches of SHIPMENT_EXPORT_BATCH_SIZE,
+    and each batch is let go of once it is written, so memory stays flat for any amount of shipments.
+
+    :param params: the parameters to filter by, where the pagination is ignored
+    :param export_format: the format to write the shipments in
+    :return: the chunks of the export
+    """
+    if export_format == ExportFormat.CSV:
+        yield _csv_rows([EXPORT_CSV_COLUMNS])
 
+    created_at = schemas.Shipment.created_at
+    shipment_id = schemas.Shipment.shipment_id
+    query = filter_shipments(select(schemas.Shipment).options(*shipment_loaders), params)
     if params.date_desc:
-        query = query.order_by(schemas.Shipment.created_at.desc())
+        query = query.order_by(created_at.desc(), shipment_id.desc())
+    else:
+        query = query.order_by(created_at.asc(), shipment_id.asc())
+
+    # The session outlives the request dependencies, since the response is streamed.
+    async with Session() as db:
+        result = await db.stream_scalars(query.execution_options(yield_per=SHIPMENT_EXPORT_BATCH_SIZE))
+
+        async for partition in result.partitions():
+            # The identity map only holds weak references, so the rows are freed along with the partition.
+            shipments = [Shipment.model_validate(shipment) for shipment in partition]
+
+            if export_format == ExportFormat.CSV:
+                yield _csv_rows([
+                    [shipment.shipment_id, shipment.from_address, shipment.shipping_address,
+                     shipment.provider.value, shipment.provider_shipment_id, shipment.created_at.isoformat(),
+                     " ".join(f"{item.upc}:{item.stock}" for item in shipment.items)]
+                    for shipment in shipments
+                ])
+            else:
+                yield "".join(shipment.model_dump_json() + "\n" for shipment in shipments)
+
+
+def _csv_rows(rows: list[list]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+@router.get("/export", operation_id="export_shipments")
+async def export_shipments(params: FullShipmentQueryParams = Depends(), export_format: Annotated[ExportFormat, Query(alias="format")] = ExportFormat.NDJSON) -> StreamingResponse:
+    """
+    Export every shipment that matches the filters, as NDJSON or CSV.
+    Unlike the listing, there is no limit, and the export is streamed as it is read.
+    In CSV, the items are written as space separated upc:stock pairs.
+    """
+    media_types = {ExportFormat.NDJSON: "application/x-ndjson",
+                   ExportFormat.CSV: "text/csv"}
+    return StreamingResponse(
+        stream_shipments(params, export_format),
+        media_type=media_types[export_format],
+        headers={"Content-Disposition": f"attachment; filename=shipments.{export_format.value}"}
+    )
+
+
+@router.get("/{shipment_id}", operation_id="get_shipment")
+async def get_shipment(shipment_id: UUID, db: AsyncSession = Depends(get_db)) -> Shipment:
+    """
+    Get the shipment using a specific shipment ID.
+
+    :param shipment_id: the ID of the shipment to get
+    :return: the shipment
+    """
+    shipment = await db.get(schemas.Shipment, shipment_id, options=shipment_loaders)
+
+    if shipment is None:
+        raise HTTPException(status_code=404, detail="Shipment not found.")
+
+    return shipment
+
+
+@router.get("/", operation_id="get_shipments")
+async def get_shipments(params: FullShipmentQueryParams = Depends(), db: AsyncSession = Depends(get_db), response: Response = None) -> list[Shipment]:
+    """
+    Get all the shipments related to this user.
+    Pages can be read by offset, or by the cursors in the X-Next-Cursor & X-Prev-Cursor headers.
+    """
+
+    query = filter_shipments(select(schemas.Shipment).options(*shipment_loaders), params)
+
+    cursor = None
+    if params.cursor is not None:
+        try:
+            cursor = PageCursor.decode(params.cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+
+    # Pages before a cursor are read in the reverse order, then flipped back.
+    backwards = cursor is not None and cursor.backwards
+    descending = params.date_desc != backwards
+    created_at = schemas.Shipment.created_at
+    shipment_id = schemas.Shipment.shipment_id
+
+    if cursor is not None:
+        # Seek past the cursor, with the shipment ID breaking ties in creation time.
+        if descending:
+            query = query.filter(or_(
+                created_at < cursor.created_at,
+                and_(created_at == cursor.created_at, shipment_id < cursor.id)
+            ))
+        else:
+            query = query.filter(or_(
+                created_at > cursor.created_at,
+                and_(created_at == cursor.created_at, shipment_id > cursor.id)
+            ))
+
+    if descending:
+        query = query.order_by(created_at.desc(), shipment_id.desc())
     else:
-        query = query.order_by(schemas.Shipment.created_at.asc())
+        query = query.order_by(created_at.asc(), shipment_id.asc())
+
+    # One extra shipment is read to tell whether there is another page.
+    query = query.limit(params.limit + 1)
+    if cursor is None:
+        query = query.offset(params.offset)
 
-    query = query.limit(params.limit).offset(params.offset)
+    shipments = list((await db.scalars(query)).all())
+    has_more = len(shipments) > params.limit
+    shipments = shipments[:params.limit]
+
+    if backwards:
+        shipments.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, cursor is not None or params.offset > 0
+
+    if len(shipments) > 0:
+        set_page_cursors(
+            response,
+            PageCursor(created_at=shipments[-1].created_at,
+                       id=shipments[-1].shipment_id) if has_next else None,
+            PageCursor(created_at=shipments[0].created_at,
+                       id=shipments[0].shipment_id, backwards=True) if has_prev else None
+        )
 
-    return query.all()
+    return shipments
 
 
 @router.get("/{shipment_id}/status", operation_id="get_shipment_status")
-async def get_shipment_status(shipment_id: UUID, db: Session = Depends(get_db)) -> ShipmentStatus:
+async def get_shipment_status(shipment_id: UUID, db: AsyncSession = Depends(get_db)) -> ShipmentStatus:
     """
     Get the current status of a shipment.
     Queries third parties - expect failures.
@@ -112,12 +255,12 @@ async def get_shipment_status(shipment_id: UUID, db: Session = Depends(get_db))
 
 
 @router.patch("/{shipment_id}/status", operation_id="update_shipment_status")
-async def update_shipment_status(shipment_id: UUID, status: ShipmentStatusPatchRequest, db: Session = Depends(get_db), profile: AccountProfile = Depends(get_profile)) -> ShipmentStatus:
+async def update_shipment_status(shipment_id: UUID, status: ShipmentStatusPatchRequest, db: AsyncSession = Depends(get_db), profile: AccountProfile = Depends(get_profile)) -> ShipmentStatus:
     """
     Update the status of a shipment.
     """
 
-    shipment = db.get(schemas.Shipment, shipment_id)
+    shipment = await db.get(schemas.Shipment, shipment_id, options=shipment_status_loaders)
 
     if shipment is None:
         raise HTTPException(status_code=404, detail="Shipment not found.")
@@ -137,6 +280,6 @@ async def update_shipment_status(shipment_id: UUID, status: ShipmentStatusPatchR
     shipment.status.message = status.message
     shipment.status.updated_at = datetime.now()
 
-    db.commit()
+    await db.commit()
 
     return shipment.status
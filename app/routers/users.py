@@ -6,11 +6,13 @@ __author__ = "Justin B. (justin@justin.directory)"
 
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import schemas
 from app.database.dependencies import get_db
+from app.database.loaders import delivery_loaders, shipment_loaders
 from app.parameters.shipment import (BaseShipmentQueryParams,
                                      FullShipmentQueryParams)
 from app.routers.shipments import get_shipments
@@ -24,7 +26,7 @@ Fix router to use correct queries in order to find shipments.
 
 
 @router.get("/{user_id}/shipments", operation_id="get_user_shipments")
-async def get_user_shipments(user_id: UUID, params: BaseShipmentQueryParams = Depends(), db: Session = Depends(get_db)) -> list[Shipment]:
+async def get_user_shipments(user_id: UUID, params: BaseShipmentQueryParams = Depends(), db: AsyncSession = Depends(get_db), response: Response = None) -> list[Shipment]:
     """
     Get all the shipments for a given user.
     """
@@ -32,6 +34,7 @@ async def get_user_shipments(user_id: UUID, params: BaseShipmentQueryParams = De
     params = FullShipmentQueryParams(
         limit=params.limit,
         offset=params.offset,
+        cursor=params.cursor,
         user_id=user_id,
         status=params.status,
         provider=params.provider,
@@ -40,21 +43,23 @@ async def get_user_shipments(user_id: UUID, params: BaseShipmentQueryParams = De
         delivery_id=params.delivery_id
     )
 
-    return await get_shipments(params, db)
+    return await get_shipments(params, db, response)
 
 
 @router.get("/{user_id}/shipments/{shipment_id}", operation_id="get_user_shipment")
-async def get_user_shipment(user_id: UUID, shipment_id: UUID, db: Session = Depends(get_db)) -> Shipment:
+async def get_user_shipment(user_id: UUID, shipment_id: UUID, db: AsyncSession = Depends(get_db)) -> Shipment:
     """
     Get a specific shipment for a given user.
     """
 
-    shipment = db.query(schemas.Shipment)\
-        .where(schemas.Shipment.shipment_id == shipment_id)\
-        .join(schemas.Shipment.delivery)\
-        .join(schemas.Delivery.order)\
-        .where(schemas.Order.customer_id == user_id)\
-        .first()
+    shipment = (await db.scalars(
+        select(schemas.Shipment)
+        .where(schemas.Shipment.shipment_id == shipment_id)
+        .join(schemas.Shipment.delivery)
+        .join(schemas.Delivery.order)
+        .where(schemas.Order.customer_id == user_id)
+        .options(*shipment_loaders)
+    )).first()
 
     if shipment is None:
         raise HTTPException(status_code=404, detail="Shipment not found")
@@ -63,7 +68,7 @@ async def get_user_shipment(user_id: UUID, shipment_id: UUID, db: Session = Depe
 
 
 @router.get("/{user_id}/shipments/{shipment_id}/status", operation_id="get_user_shipment_status")
-async def get_user_shipment_status(user_id: UUID, shipment_id: UUID, db: Session = Depends(get_db)) -> ShipmentStatus:
+async def get_user_shipment_status(user_id: UUID, shipment_id: UUID, db: AsyncSession = Depends(get_db)) -> ShipmentStatus:
     """
     Get the status of a shipment for the currently logged in user.
     """
@@ -74,12 +79,14 @@ async def get_user_shipment_status(user_id: UUID, shipment_id: UUID, db: Session
 
 
 @router.get("/{user_id}/deliveries", operation_id="get_user_deliveries")
-async def get_user_deliveries(user_id: UUID, db: Session = Depends(get_db)) -> list[Delivery]:
+async def get_user_deliveries(user_id: UUID, db: AsyncSession = Depends(get_db)) -> list[Delivery]:
     """
     Get all the deliveries for a given user.
     """
 
-    return db.query(schemas.Delivery)\
-        .join(schemas.Order, schemas.Delivery.order_id == schemas.Order.order_id)\
-        .where(schemas.Order.customer_id == user_id)\
-        .all()
+    return (await db.scalars(
+        select(schemas.Delivery)
+        .join(schemas.Order, schemas.Delivery.order_id == schemas.Order.order_id)
+        .where(schemas.Order.customer_id == user_id)
+        .options(*delivery_loaders)
+    )).all()
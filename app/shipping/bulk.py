@@ -0,0 +1,316 @@
+"""
+Bulk creation of deliveries, for imports of many orders at once.
+
+Orders are handled in batches, and every step of a batch is done for all of its orders at once:
+the recipients are geocoded together, the warehouses are ranked once per destination cell,
+the shipments are created with the providers, then the stock is reserved with a handful of queries,
+and the rows are written with bulk inserts.
+An order that fails only fails by itself, and the results of each batch are given as soon as it is committed.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import asyncio
+from datetime import datetime
+from os import environ
+from typing import Any, AsyncIterator, Optional
+from uuid import UUID, uuid4
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import schemas
+from app.database.schemas import Warehouse
+from app.inventory.allocation import (ALLOCATION_STRATEGY,
+                                      AllocationCandidate, OutOfStockException,
+                                      allocation_strategies)
+from app.inventory.warehouse import (get_nearest_warehouse_distances,
+                                     get_warehouses_stock,
+                                     reserve_warehouse_stock)
+from app.shipping import geohash
+from app.shipping.delivery import (QuoteUnavailableException,
+                                   quote_delivery_breakdown)
+from app.shipping.enums import Status
+from app.shipping.location import get_addresses_coordinates
+from app.shipping.matrix import delivery_matrix
+from app.shipping.models import (BulkDeliveryRequest, BulkDeliveryResult,
+                                 CreateShipmentRequest, Delivery, Shipment,
+                                 ShipmentDeliveryBreakdown, ShipmentItem)
+from app.shipping.search import index_inserted_rows
+from app.shipping.shipment import cancel_shipments, create_shipments
+
+BULK_DELIVERY_BATCH_SIZE = int(
+    environ.get("BULK_DELIVERY_BATCH_SIZE", "500"))
+"""The amount of orders that are handled & committed together."""
+BULK_DELIVERY_CONCURRENCY = int(
+    environ.get("BULK_DELIVERY_CONCURRENCY", "16"))
+"""The maximum amount of orders of a batch that are quoted or sent to the providers at once."""
+
+
+def _failed(request: BulkDeliveryRequest, error: str) -> BulkDeliveryResult:
+    return BulkDeliveryResult(order_id=request.order_id, error=error)
+
+
+def _warehouse_items(breakdowns: list[ShipmentDeliveryBreakdown]) -> dict[UUID, list[ShipmentItem]]:
+    warehouse_items: dict[UUID, list[ShipmentItem]] = {}
+    for breakdown in breakdowns:
+        for delivery_time in breakdown.delivery_times:
+            warehouse_items.setdefault(
+                delivery_time.warehouse_id, []).extend(delivery_time.items)
+    return warehouse_items
+
+
+async def _allocate(db: AsyncSession, batch: list[BulkDeliveryRequest], results: dict[int, BulkDeliveryResult]) -> dict[int, ShipmentDeliveryBreakdown]:
+    """
+    Make the breakdowns of a batch, recording the orders that cannot be fulfilled in the results.
+    Orders are allocated in turn against one read of the stock, so an order only gets what the orders before it left.
+    """
+    strategy = allocation_strategies[ALLOCATION_STRATEGY]
+    coordinates, failed = await get_addresses_coordinates([request.recipient_address for request in batch])
+
+    cells: dict[int, str] = {}
+    for i, request in enumerate(batch):
+        if request.recipient_address in failed:
+            results[i] = _failed(request, "Address could not be geocoded")
+        elif coordinates[request.recipient_address] is None:
+            results[i] = _failed(request, "Address not found")
+        else:
+            cells[i] = delivery_matrix.cell(coordinates[request.recipient_address])
+
+    # Warehouses are ranked from the center of each cell, which is within a few miles of every recipient in it.
+    nearest: dict[str, list[tuple[Warehouse, float]]] = {}
+    estimates = {}
+    for cell in set(cells.values()):
+        nearest[cell] = await get_nearest_warehouse_distances(
+            geohash.decode(cell), strategy.max_candidates, strategy.max_distance)
+        estimates[cell] = await delivery_matrix.lookup(db, cell)
+
+    warehouse_map = {
+        warehouse.warehouse_id: warehouse
+        for ranked in nearest.values()
+        for warehouse, _ in ranked
+    }
+    stock = await get_warehouses_stock(
+        list(warehouse_map),
+        list({item.upc for request in batch for item in request.items})
+    )
+
+    allocated = {}
+    for i, cell in cells.items():
+        candidates = [
+            AllocationCandidate(warehouse_id=warehouse.warehouse_id,
+                                distance=miles, stock=stock[warehouse.warehouse_id])
+            for warehouse, miles in nearest[cell]
+        ]
+        try:
+            allocated[i] = strategy.allocate(batch[i].items, candidates)
+        except OutOfStockException:
+            results[i] = _failed(batch[i], "Out of stock")
+            continue
+
+        for chunk in allocated[i]:
+            for item in chunk.items:
+                warehouse_stock = stock[chunk.warehouse_id]
+                warehouse_stock[item.upc] = warehouse_stock.get(item.upc, 0) - item.stock
+
+    semaphore = asyncio.Semaphore(BULK_DELIVERY_CONCURRENCY)
+
+    async def quote(i: int) -> Optional[ShipmentDeliveryBreakdown]:
+        request = batch[i]
+        async with semaphore:
+            try:
+                breakdown = await quote_delivery_breakdown(
+                    request.recipient_address, coordinates[request.recipient_address],
+                    request.delivery_sla, allocated[i], warehouse_map, estimates[cells[i]])
+            except QuoteUnavailableException:
+                results[i] = _failed(request, "Quote unavailable")
+                return None
+
+        if not breakdown.can_meet_sla:
+            results[i] = _failed(request, "Cannot meet SLA")
+            return None
+        return breakdown
+
+    breakdowns = await asyncio.gather(*(quote(i) for i in allocated))
+    return {
+        i: breakdown
+        for i, breakdown in zip(allocated, breakdowns)
+        if breakdown is not None
+    }
+
+
+async def _create_shipments(batch: list[BulkDeliveryRequest], breakdowns: dict[int, ShipmentDeliveryBreakdown], results: dict[int, BulkDeliveryResult]) -> dict[int, list[Shipment]]:
+    """
+    Create the shipments of every order with the providers, before any stock is locked.
+    """
+    semaphore = asyncio.Semaphore(BULK_DELIVERY_CONCURRENCY)
+
+    async def create(i: int) -> Optional[list[Shipment]]:
+        async with semaphore:
+            try:
+                return await create_shipments([
+                    (
+                        CreateShipmentRequest(
+                            shipping_address=batch[i].recipient_address,
+                            from_address=delivery_time.from_address,
+                            items=delivery_time.items,
+                            provider=delivery_time.provider
+                        ),
+                        delivery_time.delivery_time
+                    )
+                    for delivery_time in breakdowns[i].delivery_times
+                ])
+            except Exception:
+                results[i] = _failed(batch[i], "Shipments could not be created")
+                return None
+
+    created = await asyncio.gather(*(create(i) for i in breakdowns))
+    return {
+        i: order_shipments
+        for i, order_shipments in zip(breakdowns, created)
+        if order_shipments is not None
+    }
+
+
+async def _reserve(db: AsyncSession, batch: list[BulkDeliveryRequest], breakdowns: dict[int, ShipmentDeliveryBreakdown], shipments: dict[int, list[Shipment]], results: dict[int, BulkDeliveryResult]):
+    """
+    Reserve the stock of every order with shipments at once.
+    If another request took some of the stock since it was read, the orders that needed it are dropped,
+    their shipments are cancelled, and the rest are reserved again.
+    """
+    while len(shipments) > 0:
+        try:
+            await reserve_warehouse_stock(db, _warehouse_items([breakdowns[i] for i in shipments]))
+            return
+        except OutOfStockException as e:
+            short = {(warehouse_id, upc) for warehouse_id, upcs in e.upcs.items() for upc in upcs}
+            dropped = [
+                i for i in shipments
+                if any(
+                    (delivery_time.warehouse_id, item.upc) in short
+                    for delivery_time in breakdowns[i].delivery_times
+                    for item in delivery_time.items
+                    if item.stock > 0
+                )
+            ]
+            if len(dropped) == 0:
+                # The short items are not known, so none of the orders can be told apart.
+                dropped = list(shipments)
+
+            # The conditional updates may have removed some of the stock before failing.
+            await db.rollback()
+            await cancel_shipments([shipment for i in dropped for shipment in shipments[i]])
+            for i in dropped:
+                results[i] = _failed(batch[i], "Out of stock")
+                del shipments[i]
+
+
+async def _insert(db: AsyncSession, batch: list[BulkDeliveryRequest], breakdowns: dict[int, ShipmentDeliveryBreakdown], shipments: dict[int, list[Shipment]]) -> dict[int, Delivery]:
+    """
+    Insert the deliveries, shipments, statuses & items of every order with one bulk insert per table.
+    """
+    created_at = datetime.now()
+    rows: dict[Any, list[dict[str, Any]]] = {
+        schemas.Delivery: [],
+        schemas.Shipment: [],
+        schemas.ShipmentStatus: [],
+        schemas.ShipmentItem: [],
+        schemas.ShipmentDeliveryInfo: []
+    }
+    deliveries: dict[int, Delivery] = {}
+
+    for i, order_shipments in shipments.items():
+        request = batch[i]
+        delivery_id = uuid4()
+        rows[schemas.Delivery].append({
+            "delivery_id": delivery_id,
+            "order_id": request.order_id,
+            "recipient_address": request.recipient_address,
+            "created_at": created_at,
+            "fulfilled_at": None,
+            "delivery_sla": request.delivery_sla
+        })
+
+        for shipment, delivery_time in zip(order_shipments, breakdowns[i].delivery_times):
+            rows[schemas.Shipment].append(shipment.model_dump(exclude=["items"]))
+            rows[schemas.ShipmentStatus].append({
+                "shipment_id": shipment.shipment_id,
+                "message": Status.PENDING,
+                "expected_at": delivery_time.delivery_time,
+                "updated_at": created_at,
+                "delivered_at": None
+            })
+            rows[schemas.ShipmentItem].extend(
+                {"shipment_id": shipment.shipment_id, **item.model_dump()}
+                for item in shipment.items
+            )
+            rows[schemas.ShipmentDeliveryInfo].append(
+                {"shipment_id": shipment.shipment_id, "delivery_id": delivery_id})
+
+        deliveries[i] = Delivery(
+            delivery_id=delivery_id,
+            order_id=request.order_id,
+            created_at=created_at,
+            delivery_sla=request.delivery_sla,
+            shipments=order_shipments
+        )
+
+    for table, table_rows in rows.items():
+        if len(table_rows) > 0:
+            await db.execute(insert(table), table_rows)
+
+    await index_inserted_rows(
+        db, rows[schemas.Shipment],
+        [row["delivery_id"] for row in rows[schemas.Delivery]]
+    )
+    return deliveries
+
+
+async def _create_batch(db: AsyncSession, batch: list[BulkDeliveryRequest]) -> list[BulkDeliveryResult]:
+    """
+    Create the deliveries of a batch of orders, and commit them together.
+    The shipments are created before the stock is locked, so other orders do not wait on the providers.
+    """
+    results: dict[int, BulkDeliveryResult] = {}
+    breakdowns = await _allocate(db, batch, results)
+    shipments = await _create_shipments(batch, breakdowns, results)
+
+    try:
+        await _reserve(db, batch, breakdowns, shipments, results)
+        deliveries = await _insert(db, batch, breakdowns, shipments)
+        await db.commit()
+    except Exception:
+        # Rolling back releases the reserved stock along with everything else.
+        await db.rollback()
+        await cancel_shipments([shipment for order_shipments in shipments.values() for shipment in order_shipments])
+        for i in shipments:
+            results[i] = _failed(batch[i], "Delivery could not be stored")
+    else:
+        for i, delivery in deliveries.items():
+            results[i] = BulkDeliveryResult(order_id=batch[i].order_id, delivery=delivery)
+
+    return [results[i] for i in range(len(batch))]
+
+
+async def create_bulk_deliveries(db: AsyncSession, requests: list[BulkDeliveryRequest]) -> AsyncIterator[BulkDeliveryResult]:
+    """
+    Create a delivery for each order, in batches of BULK_DELIVERY_BATCH_SIZE.
+    The results of a batch are given once it is committed, in the order of the requests.
+    A batch that fails, such as when the database is unavailable, fails its own orders, and the next batch is tried.
+
+    :param db: the database session to create the deliveries with, which is committed after each batch
+    :param requests: the deliveries to create, each for its own order
+    :return: the result of each request
+    """
+    for i in range(0, len(requests), BULK_DELIVERY_BATCH_SIZE):
+        batch = requests[i:i + BULK_DELIVERY_BATCH_SIZE]
+        try:
+            results = await _create_batch(db, batch)
+        except Exception:
+            # Only this batch fails, and every order in it still gets a result.
+            await db.rollback()
+            results = [_failed(request, "Delivery could not be created") for request in batch]
+
+        for result in results:
+            yield result
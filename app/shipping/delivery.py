@@ -5,9 +5,20 @@ Business logic regarding the delivery of shipments.
 __author__ = "Justin B. (justin@justin.directory)"
 
 
+import asyncio
 from datetime import datetime, timedelta
-
-from app.inventory.warehouse import get_warehouse, get_warehouse_chunks
+from os import environ
+from typing import Optional
+from uuid import UUID
+
+import numpy as np
+
+from app.database import Session
+from app.database.schemas import Warehouse
+from app.inventory.models import WarehouseStockAvailability
+from app.inventory.warehouse import get_warehouse_chunks, get_warehouses_by_id
+from app.shipping.location import get_address_coordinates
+from app.shipping.matrix import Estimate, delivery_matrix
 from app.shipping.models import (CreateDeliveryRequest, DeliveryTimeResponse,
                                  Shipment, ShipmentDeliveryBreakdown,
                                  ShipmentItem)
@@ -15,6 +26,24 @@ from app.shipping.models import (CreateDeliveryRequest, DeliveryTimeResponse,
 from .enums import SLA, Provider
 from .providers import ShipmentProvider, fedex, internal, ups, usps
 
+PROVIDER_QUOTE_TIMEOUT = float(
+    environ.get("PROVIDER_QUOTE_TIMEOUT_SECONDS", "2"))
+"""
+How long a provider has to quote a delivery, before it is left out of the breakdown.
+Only providers that await while quoting, such as a carrier API, can be cut off.
+The built-in providers quote from the distance without awaiting, so they always finish.
+"""
+
+
+class QuoteUnavailableException(Exception):
+    """Raised when no shipping provider could quote a delivery."""
+
+    def __init__(self, message: str, unavailable_providers: Optional[list[Provider]] = None) -> None:
+        super().__init__(message)
+        self.unavailable_providers = unavailable_providers or []
+        """The providers that could not give a quote in time."""
+
+
 shipping_providers: dict[Provider, ShipmentProvider] = {
     Provider.FEDEX: fedex.client,
     Provider.UPS: ups.client,
@@ -30,49 +59,116 @@ sla_times: dict[SLA, timedelta] = {
 }
 
 
+async def _quote_delivery_hours(provider: Provider, recipient_coordinates: tuple[float, float], warehouse_coordinates: np.ndarray) -> np.ndarray:
+    """
+    Get the delivery times of every warehouse chunk from a provider, cutting the provider off after the timeout.
+    A timeout can only interrupt a provider at an await, so it does not apply to providers that quote synchronously.
+    """
+    client = shipping_providers[provider]
+    return await asyncio.wait_for(
+        client.get_delivery_times(
+            recipient_coordinates, warehouse_coordinates),
+        timeout=PROVIDER_QUOTE_TIMEOUT
+    )
+
+
 async def get_delivery_breakdown(recipient_address: str, sla: SLA, items: list[ShipmentItem]) -> ShipmentDeliveryBreakdown:
     """
     Get a delivery breakdown for a specific order.
+    Delivery times come from the precomputed delivery matrix where possible.
+    Otherwise, every provider quotes all remaining warehouse chunks at once, and providers are quoted concurrently.
+    Providers that fail or time out are left out, and reported in the breakdown.
     """
-    # Get the expected delivery time.
-    expected_at = datetime.now() + sla_times[sla]
-    can_meet_sla = True
     warehouse_chunks = await get_warehouse_chunks(recipient_address, items)
-    delivery_times: list[DeliveryTimeResponse] = []
-
-    for chunk in warehouse_chunks:
-        warehouse = await get_warehouse(chunk.warehouse_id)
-        fastest_provider: Provider | None = None
-        fastest_time = timedelta.max
-
-        for provider, client in shipping_providers.items():
-            delivery_time = await client.get_delivery_time(
-                recipient_address, warehouse.address)
+    recipient_coordinates = await get_address_coordinates(recipient_address)
+    warehouse_map = await get_warehouses_by_id([chunk.warehouse_id for chunk in warehouse_chunks])
+    async with Session() as db:
+        estimates = await delivery_matrix.lookup(
+            db, delivery_matrix.cell(recipient_coordinates))
 
-            if delivery_time < fastest_time:
-                fastest_time = delivery_time
-                fastest_provider = provider
+    return await quote_delivery_breakdown(
+        recipient_address, recipient_coordinates, sla, warehouse_chunks, warehouse_map, estimates)
 
-            if delivery_time < sla_times[sla]:
-                # If we are within the SLA, we can meet it.
-                break
 
-        if fastest_time > sla_times[sla]:
-            can_meet_sla = False
+async def quote_delivery_breakdown(recipient_address: str, recipient_coordinates: tuple[float, float], sla: SLA, warehouse_chunks: list[WarehouseStockAvailability], warehouse_map: dict[UUID, Warehouse], estimates: dict[UUID, dict[Provider, Estimate]]) -> ShipmentDeliveryBreakdown:
+    """
+    Choose a provider for each warehouse chunk of a delivery, once the chunks are allocated.
+    Used directly when the coordinates, warehouses & estimates were already loaded for many deliveries.
+
+    :param recipient_address: the address to deliver to
+    :param recipient_coordinates: the coordinates of the address
+    :param sla: the SLA of the delivery
+    :param warehouse_chunks: the items that each warehouse ships
+    :param warehouse_map: the warehouses of the chunks, by ID
+    :param estimates: the precomputed estimates to the destination cell of the address
+    """
+    # Get the expected delivery time.
+    expected_at = datetime.now() + sla_times[sla]
+    sla_hours = sla_times[sla] / timedelta(hours=1)
+    warehouses = [warehouse_map[chunk.warehouse_id]
+                  for chunk in warehouse_chunks]
+    warehouse_coordinates = np.array(
+        [(warehouse.latitude, warehouse.longitude) for warehouse in warehouses]
+    ).reshape(-1, 2)
+
+    # A (chunks, providers) matrix of delivery times, in hours.
+    # Precomputed estimates are used where they exist, the rest are quoted by the providers.
+    providers = list(shipping_providers.keys())
+    delivery_hours = np.full((len(warehouse_chunks), len(providers)), np.nan)
+
+    for i, chunk in enumerate(warehouse_chunks):
+        warehouse_estimates = estimates.get(chunk.warehouse_id, {})
+        for j, provider in enumerate(providers):
+            if provider in warehouse_estimates:
+                delivery_hours[i, j] = warehouse_estimates[provider][0]
+
+    unavailable_providers: list[Provider] = []
+    missing = np.isnan(delivery_hours).any(axis=1)
+    if missing.any():
+        quotes = await asyncio.gather(*(
+            _quote_delivery_hours(
+                provider, recipient_coordinates, warehouse_coordinates[missing])
+            for provider in providers
+        ), return_exceptions=True)
+
+        for j, (provider, quote) in enumerate(zip(providers, quotes)):
+            if isinstance(quote, Exception):
+                unavailable_providers.append(provider)
+                quote = np.inf
+
+            delivery_hours[missing, j] = quote
+
+    if np.isinf(delivery_hours).all(axis=1).any():
+        raise QuoteUnavailableException(
+            "No shipping provider could give a quote in time.", unavailable_providers)
+
+    # The first provider that meets the SLA is chosen, otherwise the fastest provider.
+    within_sla = delivery_hours < sla_hours
+    chosen = np.where(
+        within_sla.any(axis=1),
+        within_sla.argmax(axis=1),
+        delivery_hours.argmin(axis=1)
+    )
+    chosen_hours = delivery_hours[np.arange(len(warehouse_chunks)), chosen]
+    can_meet_sla = not bool((chosen_hours > sla_hours).any())
 
-        delivery_times.append(DeliveryTimeResponse(
-            provider=fastest_provider,
-            delivery_time=datetime.now()+fastest_time,
+    delivery_times: list[DeliveryTimeResponse] = [
+        DeliveryTimeResponse(
+            provider=providers[chosen[i]],
+            delivery_time=datetime.now() + timedelta(hours=float(chosen_hours[i])),
             items=chunk.items,
             warehouse_id=chunk.warehouse_id,
-            from_address=warehouse.address
-        ))
+            from_address=warehouses[i].address
+        )
+        for i, chunk in enumerate(warehouse_chunks)
+    ]
 
     return ShipmentDeliveryBreakdown(
         recipient_address=recipient_address,
         expected_at=expected_at,
         can_meet_sla=can_meet_sla,
         delivery_times=delivery_times,
+        unavailable_providers=unavailable_providers
     )
 
 
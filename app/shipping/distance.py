@@ -0,0 +1,108 @@
+"""
+Vectorized distance calculations between coordinates, in miles.
+Computes one-to-many and many-to-many distances in batch, instead of one pair at a time.
+
+Two modes are available:
+- The default mode uses the haversine formula on a sphere with the mean radius of the earth.
+  It is within 0.6% of the geodesic distance.
+- The precise mode uses Lambert's formula on the WGS-84 ellipsoid.
+  It is within 0.001% of the geodesic distance, for points that are less than 10,000 miles apart.
+  Points that are close to antipodal are not supported.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+EARTH_RADIUS_MILES = 3958.7613
+"""The mean radius of the earth."""
+WGS84_SEMI_MAJOR_AXIS_MILES = 6378137.0 / 1609.344
+"""The equatorial radius of the WGS-84 ellipsoid."""
+WGS84_FLATTENING = 1 / 298.257223563
+"""The flattening of the WGS-84 ellipsoid."""
+
+
+def _central_angle(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """
+    The central angle between points on a sphere, using the haversine formula.
+    All values are in radians.
+    """
+    h = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def _haversine(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    return EARTH_RADIUS_MILES * _central_angle(lat1, lon1, lat2, lon2)
+
+
+def _lambert(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    f = WGS84_FLATTENING
+    # Reduced latitudes, which account for the flattening of the ellipsoid.
+    beta1 = np.arctan((1 - f) * np.tan(lat1))
+    beta2 = np.arctan((1 - f) * np.tan(lat2))
+    sigma = _central_angle(beta1, lon1, beta2, lon2)
+
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    sin_half = np.sin(sigma / 2) ** 2
+    cos_half = np.cos(sigma / 2) ** 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = (sigma - np.sin(sigma)) * np.sin(p) ** 2 * \
+            np.cos(q) ** 2 / cos_half
+        y = (sigma + np.sin(sigma)) * np.cos(p) ** 2 * \
+            np.sin(q) ** 2 / sin_half
+        distance = WGS84_SEMI_MAJOR_AXIS_MILES * (sigma - f / 2 * (x + y))
+
+    # Identical points divide by zero above.
+    return np.where(sigma == 0, 0.0, distance)
+
+
+def _as_radians(coordinates: ArrayLike) -> tuple[np.ndarray, np.ndarray]:
+    points = np.radians(np.asarray(coordinates, dtype=float).reshape(-1, 2))
+    return points[:, 0], points[:, 1]
+
+
+def distances(origin: tuple[float, float], destinations: ArrayLike, precise: bool = False) -> np.ndarray:
+    """
+    Get the distances from one point to many points.
+
+    :param origin: the (latitude, longitude) to measure from
+    :param destinations: the (latitude, longitude) pairs to measure to, with a shape of (N, 2)
+    :param precise: whether to use the ellipsoid instead of a sphere
+    :return: the distances in miles, with a shape of (N,)
+    """
+    lat1, lon1 = _as_radians(origin)
+    lat2, lon2 = _as_radians(destinations)
+    formula = _lambert if precise else _haversine
+    return formula(lat1, lon1, lat2, lon2)
+
+
+def distance_matrix(origins: ArrayLike, destinations: ArrayLike, precise: bool = False) -> np.ndarray:
+    """
+    Get the distances from many points to many points.
+
+    :param origins: the (latitude, longitude) pairs to measure from, with a shape of (M, 2)
+    :param destinations: the (latitude, longitude) pairs to measure to, with a shape of (N, 2)
+    :param precise: whether to use the ellipsoid instead of a sphere
+    :return: the distances in miles, with a shape of (M, N)
+    """
+    lat1, lon1 = _as_radians(origins)
+    lat2, lon2 = _as_radians(destinations)
+    formula = _lambert if precise else _haversine
+    return formula(lat1[:, None], lon1[:, None], lat2[None, :], lon2[None, :])
+
+
+def distance(origin: tuple[float, float], destination: tuple[float, float], precise: bool = True) -> float:
+    """
+    Get the distance between two points.
+
+    :param origin: the (latitude, longitude) to measure from
+    :param destination: the (latitude, longitude) to measure to
+    :param precise: whether to use the ellipsoid instead of a sphere
+    :return: the distance in miles
+    """
+    return float(distances(origin, [destination], precise)[0])
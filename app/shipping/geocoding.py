@@ -0,0 +1,200 @@
+"""
+A long-lived geocoding service, shared by every lookup in a worker.
+Holds one pooled HTTP session per geocoder, instead of one per address.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import asyncio
+import time
+from functools import partial
+from os import environ
+from typing import Optional
+
+import aiohttp
+from geopy.adapters import AioHTTPAdapter
+from geopy.geocoders import GoogleV3, Photon
+
+GEOCODE_MAX_CONCURRENCY = int(environ.get("GEOCODE_MAX_CONCURRENCY", "8"))
+"""The maximum amount of geocoding requests that can be in flight at once."""
+GEOCODE_KEEPALIVE_SECONDS = float(
+    environ.get("GEOCODE_KEEPALIVE_SECONDS", "30"))
+"""How long an idle connection to the geocoding service is kept open."""
+
+DEFAULT_RATE_LIMITS: dict[str, float] = {
+    "photon": 1.0,
+    "google": 50.0
+}
+"""
+The default amount of requests per second for each backend.
+Photon is a free service, and will throttle anything more than a request a second.
+"""
+
+
+class TokenBucket:
+    """
+    A token bucket rate limiter.
+    Tokens are refilled at a constant rate, up to the capacity of the bucket.
+
+    :param rate: the amount of tokens that are refilled per second
+    :param capacity: the maximum amount of tokens, which is the size of a burst
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """
+        Wait until a token is available, and take it.
+        Callers are served in the order that they arrived.
+        """
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+
+            self.tokens -= 1
+
+
+class PooledAioHTTPAdapter(AioHTTPAdapter):
+    """
+    An aiohttp adapter that keeps connections alive, and limits how many can be opened.
+
+    :param limit: the maximum amount of open connections
+    :param keepalive_timeout: how long an idle connection is kept open, in seconds
+    """
+
+    def __init__(self, *, proxies, ssl_context, limit: int, keepalive_timeout: float):
+        super().__init__(proxies=proxies, ssl_context=ssl_context)
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+
+    @property
+    def session(self):
+        session = self.__dict__.get("session")
+        if session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                trust_env=False,
+                raise_for_status=False
+            )
+            self.__dict__["session"] = session
+        return session
+
+
+class GeocodingService:
+    """
+    A geocoding service which reuses one geocoder & HTTP session for every lookup.
+    The amount of requests in flight and the request rate are limited per backend.
+    Should be opened & closed with the lifespan of the application,
+    but will open itself on first use otherwise.
+
+    :param api_key: the Google Maps API key, or None to use Photon
+    :param max_concurrency: the maximum amount of requests in flight at once
+    :param rate_limit: the maximum amount of requests per second, or None for the backend default
+    """
+
+    def __init__(self, api_key: Optional[str] = None, max_concurrency: int = GEOCODE_MAX_CONCURRENCY, rate_limit: Optional[float] = None) -> None:
+        self.api_key = api_key
+        self.backend = "photon" if api_key is None else "google"
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit if rate_limit is not None else float(
+            environ.get("GEOCODE_RATE_LIMIT", DEFAULT_RATE_LIMITS[self.backend]))
+        self._geocoder: Photon | GoogleV3 | None = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._bucket: Optional[TokenBucket] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._open_lock: Optional[asyncio.Lock] = None
+        self._open_lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_open_lock(self) -> asyncio.Lock:
+        # A lock can only be waited on from one event loop, so each loop gets its own.
+        loop = asyncio.get_running_loop()
+        if self._open_lock_loop is not loop:
+            self._open_lock = asyncio.Lock()
+            self._open_lock_loop = loop
+        return self._open_lock
+
+    def _create_geocoder(self) -> Photon | GoogleV3:
+        adapter_factory = partial(
+            PooledAioHTTPAdapter,
+            limit=self.max_concurrency,
+            keepalive_timeout=GEOCODE_KEEPALIVE_SECONDS
+        )
+        if self.api_key is None:
+            return Photon(adapter_factory=adapter_factory)
+
+        return GoogleV3(api_key=self.api_key, adapter_factory=adapter_factory)
+
+    async def open(self):
+        """
+        Open the HTTP session used by the geocoder, unless it is already open on this event loop.
+        A session that was opened on another event loop is closed first.
+        """
+        loop = asyncio.get_running_loop()
+        async with self._get_open_lock():
+            # Another caller may have opened it while this one waited for the lock.
+            if self._geocoder is not None and self._loop is loop:
+                return
+
+            if self._geocoder is not None:
+                try:
+                    await self.close()
+                except RuntimeError:
+                    # The event loop that the session was opened on has already closed.
+                    self._geocoder = None
+                    self._loop = None
+
+            geocoder = await self._create_geocoder().__aenter__()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._bucket = TokenBucket(
+                self.rate_limit, max(1.0, self.rate_limit))
+            self._geocoder = geocoder
+            self._loop = loop
+
+    async def close(self):
+        """
+        Close the HTTP session used by the geocoder.
+        """
+        geocoder = self._geocoder
+        self._geocoder = None
+        self._loop = None
+
+        if geocoder is not None:
+            await geocoder.__aexit__(None, None, None)
+
+    async def geocode(self, address: str) -> Optional[tuple[float, float]]:
+        """
+        Geocode an address, waiting for a free slot and a token from the rate limiter.
+
+        :param address: the address to geocode
+        :return: the coordinates for the address, or None if it could not be found
+        """
+        if self._geocoder is None or self._loop is not asyncio.get_running_loop():
+            # The session is bound to the event loop it was opened on.
+            await self.open()
+
+        async with self._semaphore:
+            await self._bucket.acquire()
+            location = await self._geocoder.geocode(address)
+
+        if location is None:
+            return None
+
+        return (location.latitude, location.longitude)
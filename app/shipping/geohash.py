@@ -0,0 +1,72 @@
+"""
+Geohash encoding, used to group destinations into cells.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+"""The geohash alphabet, which leaves out a, i, l and o."""
+
+
+def encode(latitude: float, longitude: float, precision: int) -> str:
+    """
+    Encode coordinates as a geohash cell.
+
+    :param latitude: the latitude, in degrees
+    :param longitude: the longitude, in degrees
+    :param precision: the amount of characters in the geohash
+    :return: the geohash of the cell that contains the coordinates
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    cell = []
+    bits = 0
+    value = 0
+    even = True
+
+    while len(cell) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude.
+        coordinate, bounds = (longitude, lon_range) if even else (
+            latitude, lat_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        if coordinate >= middle:
+            value = (value << 1) | 1
+            bounds[0] = middle
+        else:
+            value = value << 1
+            bounds[1] = middle
+
+        even = not even
+        bits += 1
+        if bits == 5:
+            cell.append(BASE32[value])
+            bits = 0
+            value = 0
+
+    return "".join(cell)
+
+
+def decode(cell: str) -> tuple[float, float]:
+    """
+    Decode a geohash cell to the coordinates of its center.
+
+    :param cell: the geohash
+    :return: the (latitude, longitude) of the center of the cell
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+
+    for character in cell:
+        value = BASE32.index(character)
+        for shift in range(4, -1, -1):
+            bounds = lon_range if even else lat_range
+            middle = (bounds[0] + bounds[1]) / 2
+            if (value >> shift) & 1:
+                bounds[0] = middle
+            else:
+                bounds[1] = middle
+            even = not even
+
+    return ((lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2)
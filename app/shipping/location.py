@@ -5,12 +5,22 @@ Locational functions and services for shipping.
 __author__ = "Justin B. (justin@justin.directory)"
 
 
+import asyncio
+import re
 import warnings
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from os import environ
+from typing import Optional
 
-from async_lru import alru_cache
-from geopy.adapters import AioHTTPAdapter
-from geopy.geocoders import GoogleV3, Photon
+from geopy.exc import GeopyError
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app.database import Session
+from app.database.schemas import GeocodedAddress
+from app.shipping.geocoding import GeocodingService
+from app.shipping.models import GeocodeCacheStats
 
 warehouse_api_key = environ.get("MAPS_API_KEY")
 
@@ -22,25 +32,239 @@ if warehouse_api_key is None:
 
 CACHE_SIZE = None if __debug__ else 512
 """
-Caching for address coordinates is a relatively small number.
+Caching for address coordinates in memory is a relatively small number.
 This is because the coordinates will be queried in a quick burst.
 For debug purposes, the cache size is unlimited, as it will return random values.
 """
 
+GEOCODE_CACHE_TTL = timedelta(
+    days=float(environ.get("GEOCODE_CACHE_TTL_DAYS", "30")))
+"""How long a successfully geocoded address is kept in the shared cache."""
+GEOCODE_NEGATIVE_TTL = timedelta(
+    hours=float(environ.get("GEOCODE_NEGATIVE_TTL_HOURS", "6")))
+"""How long an address that could not be found is kept in the shared cache."""
+
+GEOCODE_BATCH_CONCURRENCY = int(
+    environ.get("GEOCODE_BATCH_CONCURRENCY", "8"))
+"""The maximum amount of uncached addresses that a batch resolves at once."""
+GEOCODE_BATCH_QUERY_SIZE = 500
+"""The maximum amount of addresses that are looked up in the cache with one query."""
+
+geocoding_service = GeocodingService(api_key=warehouse_api_key)
+"""The geocoding service shared by every lookup in this worker."""
+
+geocode_cache_stats = GeocodeCacheStats()
+"""Hit & miss counters for the shared geocoding cache of this worker."""
+
+_in_flight: dict[str, asyncio.Task] = {}
+"""Lookups that are currently in flight, by normalized address."""
+_resolved: OrderedDict[str, tuple[float, float]] = OrderedDict()
+"""Coordinates resolved by this worker, by normalized address, with the least recently used first."""
+
+
+class AddressNotFoundException(Exception):
+    """Raised when an address could not be geocoded."""
+
+
+def normalize_address(address: str) -> str:
+    """
+    Normalize an address so that formatting differences share a cache entry.
+    Casing, whitespace, periods and spacing around commas are ignored.
+
+    :param address: the address to normalize
+    :return: the normalized address
+    """
+    address = address.lower().replace(".", " ")
+    address = re.sub(r"\s*,\s*", ", ", address)
+    address = re.sub(r"\s+", " ", address)
+    return address.strip(" ,")[:255]
+
+
+async def _get_cached_coordinates(address_key: str) -> Optional[GeocodedAddress]:
+    """
+    Get the cached geocoding result for a normalized address, if it has not expired.
+
+    :param address_key: the normalized address
+    :return: the cached result, or None if there is no usable entry
+    """
+    async with Session() as db:
+        cached = await db.get(GeocodedAddress, address_key)
+
+    if cached is None or cached.expires_at <= datetime.now():
+        return None
+
+    return cached
+
+
+async def _get_cached_coordinates_batch(address_keys: list[str]) -> dict[str, GeocodedAddress]:
+    """
+    Get the cached geocoding results for many normalized addresses, skipping expired entries.
+
+    :param address_keys: the normalized addresses
+    :return: the cached results, by normalized address
+    """
+    now = datetime.now()
+    cached: dict[str, GeocodedAddress] = {}
+
+    async with Session() as db:
+        for i in range(0, len(address_keys), GEOCODE_BATCH_QUERY_SIZE):
+            query = select(GeocodedAddress)\
+                .where(GeocodedAddress.address_key.in_(address_keys[i:i + GEOCODE_BATCH_QUERY_SIZE]))\
+                .where(GeocodedAddress.expires_at > now)
+
+            for entry in await db.scalars(query):
+                cached[entry.address_key] = entry
+
+    return cached
+
+
+async def _store_cached_coordinates(address_key: str, coordinates: Optional[tuple[float, float]]):
+    """
+    Store a geocoding result in the shared cache.
+    A result of None is stored as a negative entry, with a shorter TTL.
+
+    :param address_key: the normalized address
+    :param coordinates: the coordinates of the address, or None if it could not be found
+    """
+    cached_at = datetime.now()
+    ttl = GEOCODE_CACHE_TTL if coordinates is not None else GEOCODE_NEGATIVE_TTL
+    latitude, longitude = coordinates if coordinates is not None else (None, None)
+
+    async with Session() as db:
+        await db.merge(GeocodedAddress(
+            address_key=address_key,
+            latitude=latitude,
+            longitude=longitude,
+            cached_at=cached_at,
+            expires_at=cached_at + ttl
+        ))
+        try:
+            await db.commit()
+        except IntegrityError:
+            # Another worker has stored the same address in the meantime.
+            await db.rollback()
+
+
+def _remember_coordinates(address_key: str, coordinates: tuple[float, float]):
+    """
+    Keep the coordinates of an address in memory, evicting the least recently used past CACHE_SIZE.
+    """
+    _resolved[address_key] = coordinates
+    _resolved.move_to_end(address_key)
+    if CACHE_SIZE is not None and len(_resolved) > CACHE_SIZE:
+        _resolved.popitem(last=False)
+
+
+async def _resolve_coordinates(address_key: str, address: str) -> tuple[float, float]:
+    """
+    Resolve the coordinates of an address through the shared cache, geocoding on a miss.
+
+    :param address_key: the normalized address
+    :param address: the address as it was given
+    :return: the coordinates for the address
+    :raises AddressNotFoundException: if the address could not be geocoded
+    """
+    cached = await _get_cached_coordinates(address_key)
+
+    if cached is not None:
+        if cached.latitude is None:
+            geocode_cache_stats.negative_hits += 1
+            raise AddressNotFoundException(
+                f"Could not find the address '{address}'.")
+
+        geocode_cache_stats.hits += 1
+        _remember_coordinates(address_key, (cached.latitude, cached.longitude))
+        return (cached.latitude, cached.longitude)
+
+    geocode_cache_stats.misses += 1
+    coordinates = await geocoding_service.geocode(address)
+    await _store_cached_coordinates(address_key, coordinates)
+
+    if coordinates is None:
+        raise AddressNotFoundException(
+            f"Could not find the address '{address}'.")
+
+    _remember_coordinates(address_key, coordinates)
+    return coordinates
+
 
-@alru_cache(maxsize=CACHE_SIZE)
 async def get_address_coordinates(address: str) -> tuple[float, float]:
     """
     Get the coordinates for a given address.
+    Results are kept in memory by normalized address, and cached in the database,
+    so they are shared between workers and restarts.
+    Concurrent lookups for the same normalized address share a single lookup,
+    whether or not their text is the same, and every lookup that waits on another is counted as coalesced.
 
     :param address: the address to get the coordinates for
     :return: the coordinates for the address
+    :raises AddressNotFoundException: if the address could not be geocoded
     """
-    if warehouse_api_key is None:
-        async with Photon(adapter_factory=AioHTTPAdapter) as photon:
-            location = await photon.geocode(address)
-            return (location.latitude, location.longitude)
+    address_key = normalize_address(address)
+    coordinates = _resolved.get(address_key)
+    if coordinates is not None:
+        _resolved.move_to_end(address_key)
+        return coordinates
+
+    lookup = _in_flight.get(address_key)
+
+    if lookup is not None:
+        geocode_cache_stats.coalesced += 1
     else:
-        async with GoogleV3(api_key=warehouse_api_key, adapter_factory=AioHTTPAdapter) as google:
-            location = await google.geocode(address)
-            return (location.latitude, location.longitude)
+        lookup = asyncio.ensure_future(
+            _resolve_coordinates(address_key, address))
+        _in_flight[address_key] = lookup
+        lookup.add_done_callback(
+            lambda _: _in_flight.pop(address_key, None))
+
+    # Shielded, so that a cancelled caller does not cancel the lookup for everyone else.
+    return await asyncio.shield(lookup)
+
+
+async def get_addresses_coordinates(addresses: list[str]) -> tuple[dict[str, Optional[tuple[float, float]]], set[str]]:
+    """
+    Get the coordinates for many addresses at once.
+    Addresses are deduplicated after normalization, cached addresses are served with a single query,
+    and the rest are geocoded with bounded concurrency.
+    An address that the geocoder fails on does not fail the others, and is not cached, so it is tried again later.
+
+    :param addresses: the addresses to get the coordinates for
+    :return: the coordinates by address, or None for addresses that could not be found or geocoded,
+        and the addresses that could not be geocoded because of a geocoder error
+    """
+    unique_addresses: dict[str, str] = {}
+    for address in addresses:
+        unique_addresses.setdefault(normalize_address(address), address)
+
+    cached = await _get_cached_coordinates_batch(list(unique_addresses.keys()))
+    coordinates: dict[str, Optional[tuple[float, float]]] = {}
+    failed_keys: set[str] = set()
+
+    for address_key, entry in cached.items():
+        if entry.latitude is None:
+            geocode_cache_stats.negative_hits += 1
+            coordinates[address_key] = None
+        else:
+            geocode_cache_stats.hits += 1
+            coordinates[address_key] = (entry.latitude, entry.longitude)
+
+    semaphore = asyncio.Semaphore(GEOCODE_BATCH_CONCURRENCY)
+
+    async def resolve(address_key: str, address: str):
+        async with semaphore:
+            try:
+                coordinates[address_key] = await get_address_coordinates(address)
+            except AddressNotFoundException:
+                coordinates[address_key] = None
+            except (GeopyError, asyncio.TimeoutError):
+                coordinates[address_key] = None
+                failed_keys.add(address_key)
+
+    await asyncio.gather(*(
+        resolve(address_key, address)
+        for address_key, address in unique_addresses.items()
+        if address_key not in cached
+    ))
+
+    failed = {address for address in addresses if normalize_address(address) in failed_keys}
+    return {address: coordinates[normalize_address(address)] for address in addresses}, failed
@@ -0,0 +1,201 @@
+"""
+A precomputed matrix of delivery estimates, from each warehouse to each destination cell, for each provider.
+Built offline, so quoting a delivery to a known cell is a lookup instead of a computation.
+
+Destinations are grouped into geohash cells, and estimated from the center of their cell.
+At the default precision of 5, a destination is at most ~2 miles from the center of its cell,
+so estimates are off by at most ~15 minutes of transit, times the speed multiplier of the provider.
+
+To build the matrix for every address in the geocoding cache, run `python -m app.shipping.matrix`.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import asyncio
+import time
+from collections import OrderedDict
+from os import environ
+from typing import TYPE_CHECKING, Optional
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import Session
+from app.database.schemas import DeliveryEstimate, GeocodedAddress, Warehouse
+from app.shipping import geohash
+from app.shipping.distance import distance_matrix
+from app.shipping.enums import Provider
+
+if TYPE_CHECKING:
+    from app.shipping.providers import ShipmentProvider
+
+DELIVERY_MATRIX_PRECISION = int(environ.get("DELIVERY_MATRIX_PRECISION", "5"))
+"""The geohash precision of the destination cells."""
+DELIVERY_MATRIX_CACHE_SIZE = int(
+    environ.get("DELIVERY_MATRIX_CACHE_SIZE", "4096"))
+"""The maximum amount of destination cells that are kept in memory."""
+DELIVERY_MATRIX_TTL = float(environ.get("DELIVERY_MATRIX_TTL_SECONDS", "3600"))
+"""How long a destination cell is kept in memory, so that rebuilds of the matrix are picked up."""
+DELIVERY_MATRIX_BATCH_SIZE = 1000
+"""The amount of destination cells that are built at once."""
+
+Estimate = tuple[float, float]
+"""An estimated (transit hours, price) pair."""
+
+
+class DeliveryMatrix:
+    """
+    Lookups into the precomputed delivery estimates.
+    Every estimate of a destination cell is loaded with one query, and kept in an LRU cache.
+
+    :param precision: the geohash precision of the destination cells
+    :param cache_size: the maximum amount of destination cells that are kept in memory
+    :param ttl: how long a destination cell is kept in memory, in seconds
+    """
+
+    def __init__(self, precision: int = DELIVERY_MATRIX_PRECISION, cache_size: int = DELIVERY_MATRIX_CACHE_SIZE, ttl: float = DELIVERY_MATRIX_TTL) -> None:
+        self.precision = precision
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._cells: OrderedDict[str, tuple[float, dict[UUID, dict[Provider, Estimate]]]] = OrderedDict()
+
+    def cell(self, coordinates: tuple[float, float]) -> str:
+        """
+        Get the destination cell of a set of coordinates.
+
+        :param coordinates: the coordinates of the destination
+        :return: the geohash of the destination cell
+        """
+        return geohash.encode(*coordinates, self.precision)
+
+    async def lookup(self, db: AsyncSession, cell: str) -> dict[UUID, dict[Provider, Estimate]]:
+        """
+        Get every precomputed estimate to a destination cell.
+
+        :param db: the database session to load the cell with, if it is not in memory
+        :param cell: the geohash of the destination cell
+        :return: the estimates by provider, by warehouse ID
+        """
+        cached = self._cells.get(cell)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            self._cells.move_to_end(cell)
+            return cached[1]
+
+        estimates: dict[UUID, dict[Provider, Estimate]] = {}
+        rows = await db.execute(
+            select(DeliveryEstimate.warehouse_id, DeliveryEstimate.provider,
+                   DeliveryEstimate.transit_hours, DeliveryEstimate.price)
+            .where(DeliveryEstimate.cell == cell)
+        )
+        for warehouse_id, provider, transit_hours, price in rows:
+            estimates.setdefault(warehouse_id, {})[
+                provider] = (transit_hours, price)
+
+        self._cells[cell] = (time.monotonic(), estimates)
+        self._cells.move_to_end(cell)
+        if len(self._cells) > self.cache_size:
+            self._cells.popitem(last=False)
+
+        return estimates
+
+    async def get_estimate(self, db: AsyncSession, coordinates: tuple[float, float], warehouse_id: UUID, provider: Provider) -> Optional[Estimate]:
+        """
+        Get the precomputed estimate from a warehouse to a destination, for a provider.
+
+        :param db: the database session to load the cell with, if it is not in memory
+        :param coordinates: the coordinates of the destination
+        :param warehouse_id: the ID of the warehouse
+        :param provider: the provider
+        :return: the (transit hours, price) estimate, or None if it was not precomputed
+        """
+        estimates = await self.lookup(db, self.cell(coordinates))
+        return estimates.get(warehouse_id, {}).get(provider)
+
+    def clear(self):
+        """
+        Forget every destination cell that is kept in memory.
+        """
+        self._cells.clear()
+
+
+async def build_delivery_matrix(db: AsyncSession, providers: dict[Provider, "ShipmentProvider"], cells: list[str], max_distance: Optional[float] = None) -> int:
+    """
+    Build the delivery estimates for destination cells, replacing any that exist.
+    Only warehouses within the maximum distance of a cell are estimated.
+
+    :param db: the database session to write the estimates with
+    :param providers: the providers to estimate for
+    :param cells: the geohashes of the destination cells
+    :param max_distance: the maximum distance from a warehouse to a cell, in miles
+    :return: the amount of estimates that were written
+    """
+    warehouses = list(await db.scalars(select(Warehouse)))
+    warehouse_coordinates = [(warehouse.latitude, warehouse.longitude)
+                             for warehouse in warehouses]
+    written = 0
+
+    for i in range(0, len(cells), DELIVERY_MATRIX_BATCH_SIZE):
+        batch = cells[i:i + DELIVERY_MATRIX_BATCH_SIZE]
+        # A (cells, warehouses) matrix of distances, from the center of each cell.
+        miles = distance_matrix([geohash.decode(cell) for cell in batch],
+                                warehouse_coordinates, precise=True)
+        in_range = np.ones_like(miles, dtype=bool) if max_distance is None \
+            else miles <= max_distance
+        cell_indices, warehouse_indices = np.nonzero(in_range)
+        pair_miles = miles[cell_indices, warehouse_indices]
+
+        rows = []
+        for provider, client in providers.items():
+            transit_hours = client.estimate_delivery_hours(pair_miles)
+            prices = client.estimate_price(pair_miles)
+            rows.extend(
+                {
+                    "cell": batch[cell_index],
+                    "warehouse_id": warehouses[warehouse_index].warehouse_id,
+                    "provider": provider,
+                    "transit_hours": float(hours),
+                    "price": float(price)
+                }
+                for cell_index, warehouse_index, hours, price
+                in zip(cell_indices, warehouse_indices, transit_hours, prices)
+            )
+
+        await db.execute(delete(DeliveryEstimate).where(
+            DeliveryEstimate.cell.in_(batch)))
+        if len(rows) > 0:
+            await db.execute(insert(DeliveryEstimate), rows)
+        written += len(rows)
+
+    await db.commit()
+    return written
+
+
+delivery_matrix = DeliveryMatrix()
+"""The delivery matrix shared by this worker."""
+
+
+async def main():
+    """
+    Build the delivery matrix for every destination cell in the geocoding cache.
+    """
+    from app.inventory.allocation import ALLOCATION_RADIUS_MILES
+    from app.shipping.delivery import shipping_providers
+
+    async with Session() as db:
+        coordinates = await db.execute(
+            select(GeocodedAddress.latitude, GeocodedAddress.longitude)
+            .where(GeocodedAddress.latitude.is_not(None))
+        )
+        cells = sorted({geohash.encode(latitude, longitude, DELIVERY_MATRIX_PRECISION)
+                        for latitude, longitude in coordinates})
+        written = await build_delivery_matrix(
+            db, shipping_providers, cells, ALLOCATION_RADIUS_MILES)
+
+    print(f"Built {written} delivery estimates for {len(cells)} cells.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -11,6 +11,7 @@ from uuid import UUID
 
 from pydantic import BaseModel
 
+from app.database.models import PoolStats, RouteQueryStats
 from app.shipping.enums import SLA, Provider, Status
 
 
@@ -152,6 +153,10 @@ class ShipmentDeliveryBreakdown(BaseModel):
     """Whether or not the delivery can meet the SLA."""
     delivery_times: list[DeliveryTimeResponse]
     """A list of delivery providers and their respective delivery times, given a set of items."""
+    unavailable_providers: list[Provider] = []
+    """The providers that could not give a quote in time, and were left out of the breakdown."""
+    quote_id: Optional[str] = None
+    """A signed ID for this breakdown, which can be given when creating the delivery, until it expires."""
 
 
 class CreateDeliveryRequest(BaseModel):
@@ -164,6 +169,39 @@ class CreateDeliveryRequest(BaseModel):
     """The SLA that this delivery request must adhere to."""
     items: list[ShipmentItem]
     """A list of items that are going to be delivered."""
+    quote_id: Optional[str] = None
+    """The quote ID of a breakdown made for this same request, so the breakdown is not made again."""
+
+
+class BulkDeliveryRequest(BaseModel):
+    """
+    A request to create a delivery, as part of a bulk import of many orders.
+    Quotes are not taken, as the breakdowns of a bulk import are made together.
+    """
+    order_id: UUID
+    """The ID of the order to create the delivery for."""
+    recipient_address: str
+    """The address that the delivery is going to."""
+    delivery_sla: SLA
+    """The SLA that this delivery request must adhere to."""
+    items: list[ShipmentItem]
+    """A list of items that are going to be delivered."""
+
+    model_config = {
+        "extra": "forbid"
+    }
+
+
+class BulkDeliveryResult(BaseModel):
+    """
+    The result of creating one delivery of a bulk import.
+    """
+    order_id: UUID
+    """The ID of the order that the delivery was for."""
+    delivery: Optional[Delivery] = None
+    """The delivery that was created, or None if it could not be."""
+    error: Optional[str] = None
+    """Why the delivery could not be created, if it was not."""
 
 
 class CreateShipmentRequest(BaseModel):
@@ -191,3 +229,53 @@ class CreateReturnRequest(BaseModel):
     """The items in the order that are being returned."""
     from_address: str
     """The address that the return is coming from."""
+
+
+class GeocodeCacheStats(BaseModel):
+    """
+    Counters for the shared geocoding cache of this worker.
+    """
+    hits: int = 0
+    """The amount of lookups that were answered with cached coordinates."""
+    negative_hits: int = 0
+    """The amount of lookups that were answered with a cached "not found" result."""
+    misses: int = 0
+    """The amount of lookups that had to be geocoded."""
+    coalesced: int = 0
+    """The amount of lookups that waited on a lookup for the same address that was already in flight."""
+
+
+class GeocodeWarmResponse(BaseModel):
+    """
+    The result of pre-warming the geocoding cache.
+    """
+    addresses: int
+    """The amount of distinct addresses that were resolved."""
+    resolved: int
+    """The amount of addresses that have coordinates."""
+    not_found: int
+    """The amount of addresses that could not be found."""
+    failed: int = 0
+    """The amount of addresses that the geocoder failed on, such as with a timeout, which are tried again next time."""
+
+
+class SearchRebuildResponse(BaseModel):
+    """
+    The result of rebuilding the search indexes.
+    """
+    shipments: int
+    """The amount of shipments that were indexed."""
+    deliveries: int
+    """The amount of deliveries that were indexed."""
+
+
+class MetricsResponse(BaseModel):
+    """
+    Runtime metrics of this worker.
+    """
+    pool: PoolStats
+    """The counters of the database connection pool."""
+    geocode_cache: GeocodeCacheStats
+    """The counters of the shared geocoding cache."""
+    routes: dict[str, RouteQueryStats] = {}
+    """The query counters by route, if SQL stats are enabled."""
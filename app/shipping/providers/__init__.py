@@ -6,12 +6,19 @@ __author__ = "Justin B. (justin@justin.directory)"
 
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
+from typing import Optional
 from uuid import UUID, uuid4
 
-from geopy.distance import geodesic
+import numpy as np
+from numpy.typing import ArrayLike
+from sqlalchemy import select
 
+from app.database import Session
+from app.database.schemas import Warehouse
+from app.shipping.distance import distance, distances
 from app.shipping.enums import Provider, Status
 from app.shipping.location import get_address_coordinates
+from app.shipping.matrix import delivery_matrix
 
 from ..models import CreateShipmentRequest, Shipment, ShipmentStatus
 
@@ -67,16 +74,18 @@ class ShipmentProvider(ABC):
         """
         return None
 
-    async def create_shipment(self, request: CreateShipmentRequest) -> Shipment:
+    async def create_shipment(self, request: CreateShipmentRequest, expected_at: Optional[datetime] = None) -> Shipment:
         """
         Create a shipment using the request.
         :param request: the request to create the shipment
+        :param expected_at: when the shipment is expected, if it was already quoted, so it is not estimated again
         :return: the created shipment
         """
         shipment_id = uuid4()
         created_at = datetime.now()
-        expected_time = await self.get_delivery_time(request.from_address, request.shipping_address)
-        expected_at = created_at + expected_time
+        if expected_at is None:
+            expected_time = await self.get_delivery_time(request.from_address, request.shipping_address)
+            expected_at = created_at + expected_time
 
         shipment = Shipment(
             shipment_id=shipment_id,
@@ -96,6 +105,14 @@ class ShipmentProvider(ABC):
 
         return shipment
 
+    async def cancel_shipment(self, shipment: Shipment) -> None:
+        """
+        Cancel a shipment that was created, but will not be stored.
+        The providers are simulated, so there is nothing to cancel by default.
+        :param shipment: the shipment to cancel
+        """
+        return None
+
     @abstractmethod
     def create_random_id(self, associated: UUID) -> str:
         """
@@ -107,6 +124,28 @@ class ShipmentProvider(ABC):
         """
         raise NotImplementedError()
 
+    def estimate_delivery_hours(self, miles: ArrayLike) -> np.ndarray:
+        """
+        Estimate the delivery time for distances, in hours.
+
+        :param miles: the distances to estimate for
+        :return: the delivery times, in hours
+        """
+        # Default of 12 hours per 100 miles
+        # Times by the speed multiplier
+        return (np.asarray(miles) / 100 * 12) * self.speed_mult
+
+    def estimate_price(self, miles: ArrayLike) -> np.ndarray:
+        """
+        Estimate the price of shipping for distances.
+
+        :param miles: the distances to estimate for
+        :return: the prices of shipping
+        """
+        # Default of $5 per 100 miles
+        # Times by the price multiplier
+        return (np.asarray(miles) / 100 * 5) * self.price_mult
+
     async def get_delivery_time(self, to_address: str, from_address: str) -> timedelta:
         """
         Get the delivery time from one address to another.
@@ -118,16 +157,27 @@ class ShipmentProvider(ABC):
 
         to_coords = await get_address_coordinates(to_address)
         from_coords = await get_address_coordinates(from_address)
-        dist = geodesic(to_coords, from_coords).miles
-        # Default of 12 hours per 100 miles
-        # Times by the speed multiplier
-        time_hours = (dist / 100 * 12) * self.speed_mult
+        dist = distance(to_coords, from_coords)
+        time_hours = float(self.estimate_delivery_hours(dist))
 
         return timedelta(hours=time_hours)
 
+    async def get_delivery_times(self, to_coordinates: tuple[float, float], from_coordinates: ArrayLike) -> np.ndarray:
+        """
+        Get the delivery times from many locations to one location, in hours.
+        This estimate does not await, so PROVIDER_QUOTE_TIMEOUT does not apply to it.
+        Providers that quote over the network should await their requests, so that they can be cut off.
+
+        :param to_coordinates: the coordinates to ship to
+        :param from_coordinates: the coordinates to ship from, with a shape of (N, 2)
+        :return: the delivery times, in hours, with a shape of (N,)
+        """
+        return self.estimate_delivery_hours(distances(to_coordinates, from_coordinates, precise=True))
+
     async def get_shipment_price(self, to_address: str, from_address: str) -> float:
         """
         Get the price of shipping from one address to another.
+        Shipping from a warehouse uses the precomputed delivery matrix, if it has an estimate.
 
         :param to_address: the address to ship to
         :param from_address: the address to ship from
@@ -135,13 +185,29 @@ class ShipmentProvider(ABC):
         """
 
         to_coords = await get_address_coordinates(to_address)
+        async with Session() as db:
+            warehouse_id = await db.scalar(
+                select(Warehouse.warehouse_id).where(Warehouse.address == from_address))
+            estimate = await delivery_matrix.get_estimate(
+                db, to_coords, warehouse_id, self.provider_type) if warehouse_id is not None else None
+
+        if estimate is not None:
+            return estimate[1]
+
         from_coords = await get_address_coordinates(from_address)
-        dist = geodesic(to_coords, from_coords).miles
-        # Default of $5 per 100 miles
-        # Times by the price multiplier
-        price = (dist / 100 * 5) * self.price_mult
+        dist = distance(to_coords, from_coords)
+
+        return float(self.estimate_price(dist))
 
-        return price
+    async def get_shipment_prices(self, to_coordinates: tuple[float, float], from_coordinates: ArrayLike) -> np.ndarray:
+        """
+        Get the prices of shipping from many locations to one location.
+
+        :param to_coordinates: the coordinates to ship to
+        :param from_coordinates: the coordinates to ship from, with a shape of (N, 2)
+        :return: the prices of shipping, with a shape of (N,)
+        """
+        return self.estimate_price(distances(to_coordinates, from_coordinates, precise=True))
 
 
 async def get_current_delivery_progress_estimate(shipment: Shipment) -> float:
@@ -173,4 +239,4 @@ async def get_delivery_distance_away(shipment: Shipment) -> float:
     else:
         to_coords = await get_address_coordinates(shipment.shipping_address)
         from_coords = await get_address_coordinates(shipment.from_address)
-        dist = geodesic(to_coords, from_coords).miles
+        dist = distance(to_coords, from_coords)
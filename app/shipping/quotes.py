@@ -0,0 +1,112 @@
+"""
+Quotes for delivery breakdowns.
+
+A breakdown is stored when it is made, and the client is given a signed ID for it.
+Creating the delivery with that ID uses the stored breakdown, instead of geocoding,
+allocating & quoting the providers all over again.
+The signature covers the request that the breakdown was made for,
+so a quote cannot be used for different items or a different address.
+A quote whose signature does not match is treated like an expired one, and the breakdown is made again,
+since it may have been signed by a worker with a different key.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import base64
+import hashlib
+import hmac
+import secrets
+import warnings
+from datetime import datetime, timedelta
+from os import environ
+from typing import Optional
+from uuid import UUID, uuid4
+
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.schemas import DeliveryQuote
+from app.shipping.models import (CreateDeliveryRequest,
+                                 ShipmentDeliveryBreakdown)
+
+QUOTE_TTL = timedelta(seconds=float(environ.get("QUOTE_TTL_SECONDS", "900")))
+"""How long a quote can be used to create a delivery."""
+
+quote_signing_key = environ.get("QUOTE_SIGNING_KEY")
+
+if quote_signing_key is None:
+    warnings.warn(
+        "Could not find a quote signing key. Quotes made on other workers will be recomputed.")
+    quote_signing_key = secrets.token_hex(32)
+
+
+class InvalidQuoteException(Exception):
+    """Raised when a quote ID is malformed."""
+
+
+def _request_digest(request: CreateDeliveryRequest) -> bytes:
+    items = sorted((item.upc, item.stock) for item in request.items)
+    content = f"{request.recipient_address}|{request.delivery_sla}|{items}"
+    return hashlib.sha256(content.encode()).digest()
+
+
+def _sign(quote_id: UUID, request: CreateDeliveryRequest) -> str:
+    signature = hmac.new(quote_signing_key.encode(),
+                         quote_id.bytes + _request_digest(request), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(signature).decode().rstrip("=")
+
+
+async def save_quote(db: AsyncSession, request: CreateDeliveryRequest, breakdown: ShipmentDeliveryBreakdown) -> str:
+    """
+    Store a breakdown, and clear the quotes that have expired, without committing.
+
+    :param db: the database session to store the quote with
+    :param request: the request that the breakdown was made for
+    :param breakdown: the breakdown to store
+    :return: the signed quote ID
+    """
+    quote_id = uuid4()
+    created_at = datetime.now()
+
+    await db.execute(delete(DeliveryQuote).where(DeliveryQuote.expires_at <= created_at))
+    db.add(DeliveryQuote(
+        quote_id=quote_id,
+        breakdown=breakdown.model_dump_json(exclude={"quote_id"}),
+        created_at=created_at,
+        expires_at=created_at + QUOTE_TTL
+    ))
+
+    return f"{quote_id.hex}.{_sign(quote_id, request)}"
+
+
+async def use_quote(db: AsyncSession, request: CreateDeliveryRequest) -> Optional[ShipmentDeliveryBreakdown]:
+    """
+    Take the breakdown of the quote in a request, without committing.
+    The quote is deleted, so it is used once if the transaction is committed.
+
+    :param db: the database session to take the quote with
+    :param request: the request with the quote ID
+    :return: the quoted breakdown, or None if the quote has expired, was already used, or was not signed for this request
+    :raises InvalidQuoteException: if the quote ID is malformed
+    """
+    try:
+        quote_hex, signature = request.quote_id.split(".", 1)
+        quote_id = UUID(hex=quote_hex)
+    except ValueError as e:
+        raise InvalidQuoteException("Invalid quote ID.") from e
+
+    # Recomputing is safe, as the stock is checked again when it is reserved.
+    if not hmac.compare_digest(signature, _sign(quote_id, request)):
+        return None
+
+    quote = await db.get(DeliveryQuote, quote_id)
+    if quote is None or quote.expires_at <= datetime.now():
+        return None
+
+    # Only the request that deletes the quote gets to use it, if two use the same quote at once.
+    result = await db.execute(delete(DeliveryQuote).where(DeliveryQuote.quote_id == quote_id))
+    if result.rowcount != 1:
+        return None
+
+    return ShipmentDeliveryBreakdown.model_validate_json(quote.breakdown)
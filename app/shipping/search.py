@@ -0,0 +1,244 @@
+"""
+Search indexes for the wildcard shipment filters.
+
+Address & tracking ID searches are substring searches, which cannot use a regular index.
+Instead, every searchable field is split into trigrams in a side table.
+A search only scans the shipments that have every trigram of the search term,
+and the wildcard match is then checked on those shipments alone.
+
+Partial delivery IDs are prefix searches, which use a range on the normalized hex of the delivery ID.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import re
+from typing import Any
+from uuid import UUID
+
+from sqlalchemy import (ColumnElement, and_, delete, event, false, func,
+                        insert, inspect, select)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.schemas import (Delivery, DeliverySearchKey, Shipment,
+                                  ShipmentSearchGram)
+
+SEARCH_GRAM_SIZE = 3
+"""The length of the grams that fields are split into."""
+SEARCH_REBUILD_BATCH_SIZE = 1000
+"""The amount of rows that are indexed at once when rebuilding."""
+
+searchable_fields: dict[str, Any] = {
+    "from_address": Shipment.from_address,
+    "shipping_address": Shipment.shipping_address,
+    "tracking_id": Shipment.provider_shipment_id
+}
+"""The searchable shipment columns, by the name of their field in the index."""
+
+HEX_DIGITS = re.compile(r"^[0-9a-f]*$")
+
+
+def normalize_search_text(text: str) -> str:
+    """
+    Normalize text for the trigram index.
+    Only letters & digits are kept, so a substring of a field stays a substring after normalizing.
+
+    :param text: the text to normalize
+    :return: the lowercase letters & digits of the text
+    """
+    return re.sub(r"[\W_]+", "", text.lower())
+
+
+def make_grams(text: str) -> set[str]:
+    """
+    Split text into its distinct trigrams.
+
+    :param text: the text to split
+    :return: the trigrams of the normalized text
+    """
+    text = normalize_search_text(text)
+    return {text[i:i + SEARCH_GRAM_SIZE] for i in range(len(text) - SEARCH_GRAM_SIZE + 1)}
+
+
+def _shipment_gram_rows(shipment_id: UUID, values: dict[str, str]) -> list[dict[str, Any]]:
+    return [
+        {"field": field, "gram": gram, "shipment_id": shipment_id}
+        for field, value in values.items()
+        for gram in make_grams(value or "")
+    ]
+
+
+def _shipment_values(shipment: Shipment) -> dict[str, str]:
+    return {
+        "from_address": shipment.from_address,
+        "shipping_address": shipment.shipping_address,
+        "tracking_id": shipment.provider_shipment_id
+    }
+
+
+def contains_text(field: str, term: str) -> ColumnElement[bool]:
+    """
+    Make a filter for shipments where a field contains the term, ignoring case.
+    Terms with at least one trigram are narrowed down with the trigram index first.
+
+    :param field: the name of the searchable field
+    :param term: the text to search for
+    :return: the filter for the shipments query
+    """
+    column = searchable_fields[field]
+    condition = column.ilike(f"%{term}%")
+    grams = make_grams(term)
+
+    # Wildcards in the term can match text that does not contain its trigrams.
+    if len(grams) == 0 or "%" in term or "_" in term:
+        return condition
+
+    candidates = select(ShipmentSearchGram.shipment_id)\
+        .where(ShipmentSearchGram.field == field)\
+        .where(ShipmentSearchGram.gram.in_(grams))\
+        .group_by(ShipmentSearchGram.shipment_id)\
+        .having(func.count(ShipmentSearchGram.gram) == len(grams))
+
+    return and_(Shipment.shipment_id.in_(candidates), condition)
+
+
+def delivery_id_prefix(partial_id: str) -> ColumnElement[bool]:
+    """
+    Make a filter for deliveries where the ID starts with a partial ID.
+    Dashes & casing are ignored, and a partial ID that is not hex matches nothing.
+
+    :param partial_id: the start of the delivery ID
+    :return: the filter for a query that is joined with the deliveries
+    """
+    prefix = partial_id.replace("-", "").lower()
+    if not HEX_DIGITS.match(prefix) or len(prefix) > 32:
+        return false()
+
+    # Every hex digit sorts before "g", so this is every key that starts with the prefix.
+    keys = select(DeliverySearchKey.delivery_id)\
+        .where(DeliverySearchKey.delivery_hex >= prefix)\
+        .where(DeliverySearchKey.delivery_hex < prefix + "g")
+
+    return Delivery.delivery_id.in_(keys)
+
+
+def _index_shipment(_: Any, connection: Any, shipment: Shipment):
+    rows = _shipment_gram_rows(shipment.shipment_id, _shipment_values(shipment))
+    if len(rows) > 0:
+        connection.execute(insert(ShipmentSearchGram), rows)
+
+
+def _reindex_shipment(mapper: Any, connection: Any, shipment: Shipment):
+    state = inspect(shipment)
+    if not any(state.attrs[column.key].history.has_changes() for column in searchable_fields.values()):
+        return
+
+    _unindex_shipment(mapper, connection, shipment)
+    _index_shipment(mapper, connection, shipment)
+
+
+def _unindex_shipment(_: Any, connection: Any, shipment: Shipment):
+    connection.execute(delete(ShipmentSearchGram).where(
+        ShipmentSearchGram.shipment_id == shipment.shipment_id))
+
+
+def _index_delivery(_: Any, connection: Any, delivery: Delivery):
+    connection.execute(insert(DeliverySearchKey).values(
+        delivery_hex=delivery.delivery_id.hex, delivery_id=delivery.delivery_id))
+
+
+def _unindex_delivery(_: Any, connection: Any, delivery: Delivery):
+    connection.execute(delete(DeliverySearchKey).where(
+        DeliverySearchKey.delivery_id == delivery.delivery_id))
+
+
+async def index_inserted_rows(db: AsyncSession, shipments: list[dict[str, Any]], delivery_ids: list[UUID]):
+    """
+    Index shipments & deliveries that were inserted in bulk, which skips the ORM events.
+
+    :param db: the database session that inserted the rows
+    :param shipments: the inserted shipment rows, by column name
+    :param delivery_ids: the IDs of the inserted deliveries
+    """
+    rows = [
+        gram
+        for shipment in shipments
+        for gram in _shipment_gram_rows(shipment["shipment_id"], {
+            field: shipment[column.key] for field, column in searchable_fields.items()
+        })
+    ]
+    if len(rows) > 0:
+        await db.execute(insert(ShipmentSearchGram), rows)
+
+    if len(delivery_ids) > 0:
+        await db.execute(insert(DeliverySearchKey), [
+            {"delivery_hex": delivery_id.hex, "delivery_id": delivery_id}
+            for delivery_id in delivery_ids
+        ])
+
+
+async def rebuild_search_index(db: AsyncSession) -> tuple[int, int]:
+    """
+    Rebuild the search indexes from every shipment & delivery.
+    Needed for rows that were written without the ORM, or before the indexes existed.
+
+    :param db: the database session to rebuild with
+    :return: the amount of shipments & deliveries that were indexed
+    """
+    await db.execute(delete(ShipmentSearchGram))
+    await db.execute(delete(DeliverySearchKey))
+
+    shipments = 0
+    last_id = None
+    while True:
+        query = select(Shipment.shipment_id, *searchable_fields.values())\
+            .order_by(Shipment.shipment_id)\
+            .limit(SEARCH_REBUILD_BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(Shipment.shipment_id > last_id)
+
+        batch = (await db.execute(query)).all()
+        if len(batch) == 0:
+            break
+
+        rows = [
+            gram
+            for shipment_id, *values in batch
+            for gram in _shipment_gram_rows(shipment_id, dict(zip(searchable_fields, values)))
+        ]
+        if len(rows) > 0:
+            await db.execute(insert(ShipmentSearchGram), rows)
+
+        shipments += len(batch)
+        last_id = batch[-1][0]
+
+    deliveries = 0
+    last_id = None
+    while True:
+        query = select(Delivery.delivery_id)\
+            .order_by(Delivery.delivery_id)\
+            .limit(SEARCH_REBUILD_BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(Delivery.delivery_id > last_id)
+
+        batch = (await db.scalars(query)).all()
+        if len(batch) == 0:
+            break
+
+        await db.execute(insert(DeliverySearchKey), [
+            {"delivery_hex": delivery_id.hex, "delivery_id": delivery_id}
+            for delivery_id in batch
+        ])
+
+        deliveries += len(batch)
+        last_id = batch[-1]
+
+    await db.commit()
+    return shipments, deliveries
+
+
+event.listen(Shipment, "after_insert", _index_shipment)
+event.listen(Shipment, "after_update", _reindex_shipment)
+event.listen(Shipment, "after_delete", _unindex_shipment)
+event.listen(Delivery, "after_insert", _index_delivery)
+event.listen(Delivery, "after_delete", _unindex_delivery)
@@ -5,14 +5,64 @@ Business functions for creating low level shipments.
 __author__ = "Justin B. (justin@justin.directory)"
 
 
+import asyncio
+from datetime import datetime
+from os import environ
+from typing import Optional
+
 from app.shipping.delivery import shipping_providers
 from app.shipping.models import CreateShipmentRequest, Shipment
 
+SHIPMENT_CREATE_CONCURRENCY = int(
+    environ.get("SHIPMENT_CREATE_CONCURRENCY", "4"))
+"""The maximum amount of shipments that are created with the providers at once."""
+
 
-async def create_shipment(request: CreateShipmentRequest) -> Shipment:
+async def create_shipment(request: CreateShipmentRequest, expected_at: Optional[datetime] = None) -> Shipment:
     """
     Create a shipment with the given request.
+
+    :param request: the request to create the shipment
+    :param expected_at: when the shipment is expected, if it was already quoted
     """
     provider = shipping_providers[request.provider]
-    shipment = await provider.create_shipment(request)
+    shipment = await provider.create_shipment(request, expected_at)
     return shipment
+
+
+async def cancel_shipments(shipments: list[Shipment]):
+    """
+    Cancel shipments with their providers, after they could not be stored.
+
+    :param shipments: the shipments to cancel
+    """
+    await asyncio.gather(*(
+        shipping_providers[shipment.provider].cancel_shipment(shipment)
+        for shipment in shipments
+    ))
+
+
+async def create_shipments(requests: list[tuple[CreateShipmentRequest, Optional[datetime]]]) -> list[Shipment]:
+    """
+    Create many shipments concurrently, with at most SHIPMENT_CREATE_CONCURRENCY at once.
+    If any shipment cannot be created, the shipments that were created are cancelled.
+
+    :param requests: the requests to create the shipments, with when each is expected, if it was already quoted
+    :return: the created shipments, in the order of the requests
+    """
+    semaphore = asyncio.Semaphore(SHIPMENT_CREATE_CONCURRENCY)
+
+    async def create(request: CreateShipmentRequest, expected_at: Optional[datetime]) -> Shipment:
+        async with semaphore:
+            return await create_shipment(request, expected_at)
+
+    results = await asyncio.gather(*(
+        create(request, expected_at) for request, expected_at in requests
+    ), return_exceptions=True)
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if len(errors) > 0:
+        await cancel_shipments([result for result in results if isinstance(result, Shipment)])
+        raise errors[0]
+
+    return results
@@ -0,0 +1,4 @@
+"""
+Benchmarks for the performance sensitive parts of the API.
+Run a benchmark as a module from the root of the repository, e.g. `python -m benchmarks.allocation`.
+"""
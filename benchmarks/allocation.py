@@ -0,0 +1,102 @@
+"""
+Benchmarks the allocation strategies on synthetic orders with hundreds of SKUs.
+Reports how often each strategy can fulfill an order, how many shipments it takes,
+the total distance of those shipments, and how long an allocation takes.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import time
+from random import Random
+from uuid import uuid4
+
+from app.inventory.allocation import (AllocationCandidate,
+                                      AllocationStrategy,
+                                      GreedyNearestAllocation,
+                                      OutOfStockException, SetCoverAllocation)
+from app.shipping.models import ShipmentItem
+
+CATALOG_SIZE = 2000
+"""The amount of distinct SKUs across all warehouses."""
+ORDERS = 200
+"""The amount of orders to allocate for each strategy."""
+
+
+def make_candidates(rng: Random, count: int) -> list[AllocationCandidate]:
+    """
+    Make candidate warehouses, nearest first, which each carry a random part of the catalog.
+    """
+    candidates = []
+    for i in range(count):
+        carried = rng.sample(range(CATALOG_SIZE), k=int(
+            CATALOG_SIZE * rng.uniform(0.5, 0.95)))
+        candidates.append(AllocationCandidate(
+            warehouse_id=uuid4(),
+            distance=50 * (i + 1) + rng.uniform(0, 50),
+            stock={upc: rng.randint(0, 20) for upc in carried}
+        ))
+    return candidates
+
+
+def make_order(rng: Random) -> list[ShipmentItem]:
+    """
+    Make an order with hundreds of SKUs.
+    """
+    upcs = rng.sample(range(CATALOG_SIZE), k=rng.randint(100, 500))
+    return [ShipmentItem(upc=upc, stock=rng.randint(1, 4)) for upc in upcs]
+
+
+def run(strategy: AllocationStrategy, orders: list[list[ShipmentItem]], candidates: list[AllocationCandidate]) -> tuple[dict[int, tuple[int, float]], float]:
+    """
+    Allocate every order with a strategy.
+
+    :return: the shipments & total distance by fulfilled order index, and the seconds taken
+    """
+    distances = {
+        candidate.warehouse_id: candidate.distance for candidate in candidates}
+    results: dict[int, tuple[int, float]] = {}
+    started_at = time.perf_counter()
+
+    for i, items in enumerate(orders):
+        try:
+            chunks = strategy.allocate(
+                items, candidates[:strategy.max_candidates])
+        except OutOfStockException:
+            continue
+
+        results[i] = (len(chunks), sum(
+            distances[chunk.warehouse_id] for chunk in chunks))
+
+    return results, time.perf_counter() - started_at
+
+
+def report(name: str, results: dict[int, tuple[int, float]], orders: list, elapsed: float):
+    fulfilled = max(len(results), 1)
+    shipments = sum(count for count, _ in results.values())
+    distance = sum(miles for _, miles in results.values())
+    print(
+        f"{name:>16}: fulfilled {len(results)}/{len(orders)}, "
+        f"{shipments / fulfilled:.2f} shipments & {distance / fulfilled:.0f} miles per order, "
+        f"{elapsed / len(orders) * 1000:.2f} ms per order"
+    )
+
+
+def main():
+    rng = Random(0)
+    candidates = make_candidates(rng, 16)
+    orders = [make_order(rng) for _ in range(ORDERS)]
+
+    greedy, greedy_elapsed = run(GreedyNearestAllocation(), orders, candidates)
+    cover, cover_elapsed = run(SetCoverAllocation(), orders, candidates)
+    report("greedy", greedy, orders, greedy_elapsed)
+    report("cover", cover, orders, cover_elapsed)
+
+    # Compare on the orders that both strategies can fulfill.
+    both = [i for i in greedy if i in cover]
+    report("greedy (shared)", {i: greedy[i] for i in both}, orders, greedy_elapsed)
+    report("cover (shared)", {i: cover[i] for i in both}, orders, cover_elapsed)
+
+
+if __name__ == "__main__":
+    main()
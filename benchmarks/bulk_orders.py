@@ -0,0 +1,146 @@
+"""
+Benchmarks creating deliveries for many orders, one order at a time and with the bulk import.
+Loads a SQLite database with warehouses & their stock, and caches the coordinates of every recipient,
+so that neither side waits on geocoding. Reports the orders per second of each.
+
+The amount of orders can be changed with BENCHMARK_ORDERS, and a tenth of them are created one at a time.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import asyncio
+import tempfile
+import time
+from datetime import datetime, timedelta
+from os import environ, path
+from random import Random
+from uuid import uuid4
+
+# The application connects when it is imported, so the database has to be chosen first.
+environ.setdefault("DATABASE_URL", f"sqlite:///{path.join(tempfile.mkdtemp(), 'bulk_orders.db')}")
+
+from sqlalchemy import insert  # noqa: E402
+
+from app.database import Session, engine, schemas  # noqa: E402
+from app.database.schemas import Base  # noqa: E402
+from app.routers.orders import create_order_delivery  # noqa: E402
+from app.shipping.bulk import create_bulk_deliveries  # noqa: E402
+from app.shipping.enums import SLA  # noqa: E402
+from app.shipping.location import normalize_address  # noqa: E402
+from app.shipping.models import (BulkDeliveryRequest,  # noqa: E402
+                                 CreateDeliveryRequest, ShipmentItem)
+
+ORDERS = int(environ.get("BENCHMARK_ORDERS", "2000"))
+"""The amount of orders to import in bulk."""
+WAREHOUSES = 40
+"""The amount of warehouses, spread across the continental US."""
+TOWNS = 100
+"""The amount of towns that the recipients live in."""
+CATALOG_SIZE = 200
+"""The amount of distinct UPCs, which every warehouse carries."""
+
+
+async def load(rng: Random) -> list[tuple[float, float]]:
+    """
+    Load the warehouses & their stock.
+
+    :return: the coordinates of each town
+    """
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+        warehouses = [
+            {"warehouse_id": uuid4(), "address": f"{i} Warehouse Way",
+             "latitude": rng.uniform(30, 47), "longitude": rng.uniform(-120, -75)}
+            for i in range(WAREHOUSES)
+        ]
+        await connection.execute(insert(schemas.Warehouse), warehouses)
+        await connection.execute(insert(schemas.WarehouseItem), [
+            {"warehouse_id": warehouse["warehouse_id"], "upc": upc, "stock": 1000000}
+            for warehouse in warehouses
+            for upc in range(CATALOG_SIZE)
+        ])
+
+    return [(rng.uniform(30, 47), rng.uniform(-120, -75)) for _ in range(TOWNS)]
+
+
+async def make_requests(rng: Random, towns: list[tuple[float, float]], first: int, count: int) -> list[BulkDeliveryRequest]:
+    """
+    Make orders with a few items each, and cache the coordinates of their recipients.
+    Each recipient has its own address, numbered from the first.
+    """
+    requests = []
+    cached = []
+    now = datetime.now()
+    for i in range(first, first + count):
+        town = rng.randrange(TOWNS)
+        address = f"{i} Benchmark Rd, Town {town}"
+        latitude, longitude = towns[town]
+        cached.append({"address_key": normalize_address(address),
+                       "latitude": latitude + rng.uniform(-0.01, 0.01),
+                       "longitude": longitude + rng.uniform(-0.01, 0.01),
+                       "cached_at": now, "expires_at": now + timedelta(days=1)})
+        requests.append(BulkDeliveryRequest(
+            order_id=uuid4(),
+            delivery_sla=SLA.STANDARD,
+            items=[ShipmentItem(upc=upc, stock=rng.randint(1, 3))
+                   for upc in rng.sample(range(CATALOG_SIZE), k=rng.randint(1, 5))],
+            recipient_address=address
+        ))
+
+    async with Session() as db:
+        await db.execute(insert(schemas.GeocodedAddress), cached)
+        await db.commit()
+
+    return requests
+
+
+async def run_single(requests: list[BulkDeliveryRequest]) -> float:
+    """
+    Create the deliveries one order at a time, as the single order endpoint does.
+
+    :return: the seconds taken
+    """
+    started_at = time.perf_counter()
+    for request in requests:
+        async with Session() as db:
+            await create_order_delivery(request.order_id, CreateDeliveryRequest(
+                **request.model_dump(exclude={"order_id"})), db)
+    return time.perf_counter() - started_at
+
+
+async def run_bulk(requests: list[BulkDeliveryRequest]) -> tuple[float, int]:
+    """
+    Create the deliveries with the bulk import.
+
+    :return: the seconds taken, and the amount of orders that failed
+    """
+    failed = 0
+    started_at = time.perf_counter()
+    async with Session() as db:
+        async for result in create_bulk_deliveries(db, requests):
+            failed += result.error is not None
+    return time.perf_counter() - started_at, failed
+
+
+async def main():
+    rng = Random(0)
+    towns = await load(rng)
+    single_requests = await make_requests(rng, towns, 0, max(ORDERS // 10, 1))
+    bulk_requests = await make_requests(rng, towns, len(single_requests), ORDERS)
+
+    single_seconds = await run_single(single_requests)
+    bulk_seconds, failed = await run_bulk(bulk_requests)
+    await engine.dispose()
+
+    single_rate = len(single_requests) / single_seconds
+    bulk_rate = len(bulk_requests) / bulk_seconds
+    print(f"{'single':>8}: {len(single_requests):6} orders in {single_seconds:6.1f}s ({single_rate:8.1f} orders/s)")
+    print(f"{'bulk':>8}: {len(bulk_requests):6} orders in {bulk_seconds:6.1f}s ({bulk_rate:8.1f} orders/s), "
+          f"{failed} failed")
+    print(f"{'speedup':>8}: {bulk_rate / single_rate:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,179 @@
+"""
+Benchmarks the shipment & delivery query paths, with and without secondary indexes.
+Loads a SQLite database with a million shipments, times each query without indexes,
+then creates the indexes and times them again.
+
+The amount of shipments can be changed with BENCHMARK_SHIPMENTS.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import tempfile
+import time
+from datetime import datetime, timedelta
+from os import environ, path
+from random import Random
+from typing import Callable
+from uuid import UUID
+
+from sqlalchemy import Connection, Select, create_engine, insert, select, text
+
+from app.database import schemas
+from app.database.schemas import Base, create_missing_indexes
+from app.shipping.enums import SLA, Provider, Status
+
+SHIPMENTS = int(environ.get("BENCHMARK_SHIPMENTS", "1000000"))
+"""The amount of shipments to load."""
+SHIPMENTS_PER_DELIVERY = 4
+"""The amount of shipments in each delivery, and each delivery is its own order."""
+REPEATS = 20
+"""The amount of times each query is run, with different parameters."""
+BATCH_SIZE = 50000
+"""The amount of rows inserted at once."""
+
+
+def random_uuid(rng: Random) -> UUID:
+    return UUID(int=rng.getrandbits(128), version=4)
+
+
+def load(connection: Connection, rng: Random) -> tuple[list[UUID], list[UUID], list[UUID]]:
+    """
+    Load the orders, deliveries, shipments & returns.
+
+    :return: the order IDs, customer IDs & delivery IDs that were loaded
+    """
+    start = datetime(2024, 1, 1)
+    providers = list(Provider)
+    statuses = list(Status)
+    customers = [random_uuid(rng) for _ in range(SHIPMENTS // 40)]
+    order_ids: list[UUID] = []
+    delivery_ids: list[UUID] = []
+
+    for offset in range(0, SHIPMENTS, BATCH_SIZE):
+        orders, deliveries, shipments, statuses_rows, links, returns = [], [], [], [], [], []
+
+        for i in range(offset, min(offset + BATCH_SIZE, SHIPMENTS), SHIPMENTS_PER_DELIVERY):
+            created_at = start + timedelta(seconds=i * 30)
+            order_id = random_uuid(rng)
+            delivery_id = random_uuid(rng)
+            order_ids.append(order_id)
+            delivery_ids.append(delivery_id)
+            orders.append({"order_id": order_id, "customer_id": rng.choice(customers),
+                           "created_at": created_at})
+            deliveries.append({"delivery_id": delivery_id, "order_id": order_id,
+                               "recipient_address": f"{i} Benchmark Rd", "created_at": created_at,
+                               "fulfilled_at": None, "delivery_sla": SLA.STANDARD})
+
+            for j in range(SHIPMENTS_PER_DELIVERY):
+                shipment_id = random_uuid(rng)
+                shipments.append({"shipment_id": shipment_id, "from_address": f"{j} Warehouse Way",
+                                  "shipping_address": f"{i} Benchmark Rd",
+                                  "provider": rng.choice(providers),
+                                  "provider_shipment_id": shipment_id.hex,
+                                  "created_at": created_at + timedelta(seconds=j)})
+                statuses_rows.append({"shipment_id": shipment_id, "message": rng.choice(statuses),
+                                      "expected_at": created_at + timedelta(days=3),
+                                      "updated_at": created_at, "delivered_at": None})
+                links.append({"shipment_id": shipment_id,
+                             "delivery_id": delivery_id})
+
+            if rng.random() < 0.05:
+                returns.append({"return_id": random_uuid(rng), "shipment_id": shipments[-1]["shipment_id"],
+                                "order_id": order_id, "created_at": created_at})
+
+        for table, rows in ((schemas.Order, orders), (schemas.Delivery, deliveries),
+                            (schemas.Shipment, shipments), (schemas.ShipmentStatus, statuses_rows),
+                            (schemas.ShipmentDeliveryInfo, links), (schemas.Return, returns)):
+            if len(rows) > 0:
+                connection.execute(insert(table), rows)
+
+    return order_ids, customers, delivery_ids
+
+
+def make_queries(rng: Random, order_ids: list[UUID], customers: list[UUID], delivery_ids: list[UUID]) -> dict[str, Callable[[], Select]]:
+    """
+    Make the queries of each endpoint, which pick new parameters every time they are called.
+    """
+    return {
+        "shipments by provider": lambda: select(schemas.Shipment)
+        .where(schemas.Shipment.provider == rng.choice(list(Provider)))
+        .order_by(schemas.Shipment.created_at.desc()).limit(50),
+        "open shipments": lambda: select(schemas.Shipment)
+        .join(schemas.Shipment.status)
+        .where(schemas.ShipmentStatus.message == Status.PENDING)
+        .where(schemas.Shipment.provider == Provider.INTERNAL)
+        .order_by(schemas.Shipment.created_at.asc()).limit(50),
+        "order deliveries": lambda: select(schemas.Delivery)
+        .where(schemas.Delivery.order_id == rng.choice(order_ids)),
+        "delivery shipments": lambda: select(schemas.Shipment)
+        .join(schemas.ShipmentDeliveryInfo)
+        .where(schemas.ShipmentDeliveryInfo.delivery_id == rng.choice(delivery_ids)),
+        "user deliveries": lambda: select(schemas.Delivery)
+        .join(schemas.Order, schemas.Delivery.order_id == schemas.Order.order_id)
+        .where(schemas.Order.customer_id == rng.choice(customers)),
+        "order returns": lambda: select(schemas.Return)
+        .where(schemas.Return.order_id == rng.choice(order_ids))
+    }
+
+
+def time_queries(connection: Connection, queries: dict[str, Callable[[], Select]]) -> dict[str, float]:
+    """
+    Time each query, in milliseconds per run.
+    """
+    timings = {}
+    for name, make_query in queries.items():
+        started_at = time.perf_counter()
+        for _ in range(REPEATS):
+            connection.execute(make_query()).all()
+        timings[name] = (time.perf_counter() - started_at) / REPEATS * 1000
+    return timings
+
+
+def main():
+    rng = Random(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(
+            f"sqlite:///{path.join(directory, 'indexes.db')}")
+        # Create the tables without their secondary indexes.
+        indexes = {table: set(table.indexes)
+                   for table in Base.metadata.sorted_tables}
+        for table in indexes:
+            table.indexes.clear()
+        Base.metadata.create_all(engine)
+        for table, table_indexes in indexes.items():
+            table.indexes.update(table_indexes)
+
+        with engine.begin() as connection:
+            started_at = time.perf_counter()
+            order_ids, customers, delivery_ids = load(connection, rng)
+            print(
+                f"Loaded {SHIPMENTS} shipments in {time.perf_counter() - started_at:.1f}s")
+
+        queries = make_queries(Random(1), order_ids, customers, delivery_ids)
+        with engine.connect() as connection:
+            before = time_queries(connection, queries)
+
+        with engine.begin() as connection:
+            started_at = time.perf_counter()
+            create_missing_indexes(connection)
+            connection.execute(text("ANALYZE"))
+            print(
+                f"Created indexes in {time.perf_counter() - started_at:.1f}s")
+
+        queries = make_queries(Random(1), order_ids, customers, delivery_ids)
+        with engine.connect() as connection:
+            after = time_queries(connection, queries)
+
+        engine.dispose()
+
+    for name in queries:
+        print(
+            f"{name:>20}: {before[name]:9.2f} ms -> {after[name]:7.2f} ms "
+            f"({before[name] / max(after[name], 1e-6):.0f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,18 +6,21 @@ __author__ = "Justin B. (justin@justin.directory)"
 
 # pylint: disable=W0621
 
+import asyncio
 import os
 from datetime import datetime, timedelta
 from random import choice, randint
+from typing import Any, Awaitable
 from uuid import UUID, uuid4
 
 import pytest
+import pytest_asyncio
 from dotenv import load_dotenv
-from sqlalchemy import Engine
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
 from app.auth.profile import AccountProfile
 from app.database import engine
+from app.database.observability import instrument_queries, track_queries
 from app.database.schemas import (Base, Delivery, Order, Shipment,
                                   ShipmentItem, ShipmentStatus,
                                   ShippingEmployeeReservation, Warehouse,
@@ -216,18 +219,21 @@ def db():
 
 
 @pytest.fixture(scope="session", autouse=True)
-def setup_db(db: Engine):
+def setup_db(db: AsyncEngine):
     """
     Creates the tables in the database.
     """
-    Base.metadata.create_all(db)
-    session_factory = sessionmaker(bind=db)
-    session = session_factory()
-    session.add_all(test_warehouses)
-    session.add_all(test_items)
-    session.add_all(mock_orders)
-    session.commit()
-    session.close()
+    async def create():
+        async with db.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
+        async with AsyncSession(db) as session:
+            session.add_all(test_warehouses)
+            session.add_all(test_items)
+            session.add_all(mock_orders)
+            await session.commit()
+
+    asyncio.run(create())
     yield
 
 
@@ -239,18 +245,34 @@ def delivery_id():
     return mock_delivery_id
 
 
-@pytest.fixture(scope="function")
-def session(db: Engine):
+@pytest_asyncio.fixture(scope="function")
+async def session(db: AsyncEngine):
     """
     Returns a database session.
     """
-    connection = db.connect()
-    transaction = connection.begin()
-    session = Session(bind=connection)
-    yield session
-    session.close()
-    transaction.rollback()
-    connection.close()
+    async with db.connect() as connection:
+        transaction = await connection.begin()
+        session = AsyncSession(bind=connection, expire_on_commit=False)
+        yield session
+        await session.close()
+        # A rollback in the test already ends the outer transaction.
+        if transaction.is_active:
+            await transaction.rollback()
+
+
+@pytest.fixture(scope="session")
+def count_queries():
+    """
+    Returns a function which counts the queries made while awaiting something.
+    """
+    instrument_queries(engine)
+
+    async def count(awaitable: Awaitable[Any]) -> tuple[Any, int]:
+        stats = track_queries()
+        result = await awaitable
+        return result, stats.queries
+
+    return count
 
 
 @pytest.fixture(scope="function")
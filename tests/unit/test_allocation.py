@@ -0,0 +1,69 @@
+"""
+Unit tests for the warehouse allocation strategies.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+from uuid import uuid4
+
+import pytest
+
+from app.inventory.allocation import (AllocationCandidate,
+                                      GreedyNearestAllocation,
+                                      OutOfStockException, SetCoverAllocation)
+from app.shipping.models import ShipmentItem
+
+
+def make_candidates(stocks: list[dict[int, int]]) -> list[AllocationCandidate]:
+    return [
+        AllocationCandidate(warehouse_id=uuid4(),
+                            distance=100 * (i + 1), stock=stock)
+        for i, stock in enumerate(stocks)
+    ]
+
+
+def test_cover_uses_fifth_warehouse():
+    """
+    Tests that an order the 4 nearest warehouses cannot fulfill is fulfilled by a further warehouse.
+    """
+    items = [ShipmentItem(upc=1, stock=5), ShipmentItem(upc=2, stock=5)]
+    candidates = make_candidates([{1: 1}, {1: 1}, {2: 1}, {2: 1}, {1: 5, 2: 5}])
+
+    with pytest.raises(OutOfStockException):
+        GreedyNearestAllocation().allocate(items, candidates[:4])
+
+    chunks = SetCoverAllocation().allocate(items, candidates)
+    assert len(chunks) == 1
+    assert chunks[0].warehouse_id == candidates[4].warehouse_id
+
+
+def test_cover_minimizes_shipments_then_distance():
+    """
+    Tests that fewer shipments are preferred over closer ones, and closer ones over further ones.
+    """
+    items = [ShipmentItem(upc=1, stock=4), ShipmentItem(
+        upc=2, stock=4), ShipmentItem(upc=3, stock=4)]
+    candidates = make_candidates([
+        {1: 4},
+        {2: 4},
+        {3: 4},
+        {1: 4, 2: 4},
+        {1: 4, 2: 4, 3: 2},
+        {3: 4}
+    ])
+
+    chunks = SetCoverAllocation().allocate(items, candidates)
+    assert {chunk.warehouse_id for chunk in chunks} == {
+        candidates[2].warehouse_id, candidates[3].warehouse_id}
+    assert sum(item.stock for chunk in chunks for item in chunk.items) == 12
+
+
+def test_cover_out_of_stock():
+    """
+    Tests that an order that no combination of warehouses can fulfill raises.
+    """
+    items = [ShipmentItem(upc=1, stock=10)]
+    candidates = make_candidates([{1: 3}, {1: 3}, {1: 3}])
+
+    with pytest.raises(OutOfStockException):
+        SetCoverAllocation().allocate(items, candidates)
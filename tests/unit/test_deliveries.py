@@ -1,8 +1,25 @@
+import asyncio
+from random import Random
+from uuid import uuid4
+
 import pytest
+from fastapi import HTTPException
+from sqlalchemy import delete
 
-from app.inventory.warehouse import get_nearest_warehouses
+from app.database import Session
+from app.database.schemas import DeliveryEstimate
+from app.inventory.allocation import GreedyNearestAllocation
+from app.inventory.spatial import KDTree, to_unit_vector
+from app.inventory.warehouse import (get_nearest_warehouses,
+                                     get_warehouse_chunks,
+                                     get_warehouse_stock_availability)
 from app.routers.deliveries import make_delivery_breakdown
-from app.shipping.enums import SLA
+from app.routers.orders import create_order_delivery
+from app.shipping import delivery
+from app.shipping.delivery import get_delivery_breakdown
+from app.shipping.enums import SLA, Provider
+from app.shipping.location import get_address_coordinates
+from app.shipping.matrix import build_delivery_matrix, delivery_matrix
 from app.shipping.models import CreateDeliveryRequest, ShipmentItem
 
 
@@ -40,3 +57,136 @@ async def test_get_nearest_warehouses():
     assert nearest_warehouses[1].address == "131 E Exchange Ave, Fort Worth, TX 76164"
     assert nearest_warehouses[2].address == "409 N 10th St, New Salem, ND 58563"
     assert nearest_warehouses[3].address == "1540 Navco Ln, Wells, NV 89835"
+
+
+def test_kd_tree_nearest():
+    """
+    Tests that the k-d tree agrees with a brute force search.
+    """
+    rng = Random(42)
+    coordinates = [
+        (rng.uniform(25, 49), rng.uniform(-124, -67))
+        for _ in range(500)
+    ]
+    tree = KDTree([to_unit_vector(*coordinate)
+                  for coordinate in coordinates], coordinates)
+
+    for _ in range(20):
+        target = (rng.uniform(25, 49), rng.uniform(-124, -67))
+        point = to_unit_vector(*target)
+        expected = sorted(coordinates, key=lambda coordinate: sum(
+            (a - b) ** 2 for a, b in zip(point, to_unit_vector(*coordinate))))
+
+        assert tree.nearest(point, 4) == expected[:4]
+
+
+@pytest.mark.asyncio
+async def test_warehouse_chunks_match_per_warehouse_allocation():
+    """
+    Tests that the batched stock query allocates the same as querying each warehouse in turn.
+    """
+    test_address = "2683 NC-24, Warsaw, NC 28398"
+    items = [
+        ShipmentItem(upc=5, stock=15),
+        ShipmentItem(upc=6, stock=25),
+        ShipmentItem(upc=7, stock=3)
+    ]
+
+    chunks = await get_warehouse_chunks(test_address, items, GreedyNearestAllocation())
+
+    items_left = [item.model_copy() for item in items]
+    expected = []
+    for warehouse in await get_nearest_warehouses(test_address):
+        if len(items_left) == 0:
+            break
+        expected.append(await get_warehouse_stock_availability(warehouse.warehouse_id, items_left))
+        items_left = [item for item in items_left if item.stock > 0]
+
+    assert chunks == expected
+
+
+@pytest.mark.asyncio
+async def test_breakdown_cuts_off_slow_provider(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a provider that does not quote in time is left out, and reported in the breakdown.
+    """
+    async def slow_delivery_times(*_):
+        await asyncio.sleep(5)
+
+    monkeypatch.setattr(delivery, "PROVIDER_QUOTE_TIMEOUT", 0.1)
+    monkeypatch.setattr(
+        delivery.shipping_providers[Provider.FEDEX], "get_delivery_times", slow_delivery_times)
+
+    breakdown = await get_delivery_breakdown(
+        "2683 NC-24, Warsaw, NC 28398",
+        SLA.STANDARD,
+        [ShipmentItem(upc=8, stock=3)]
+    )
+
+    assert breakdown.unavailable_providers == [Provider.FEDEX]
+    assert all(delivery_time.provider != Provider.FEDEX
+               for delivery_time in breakdown.delivery_times)
+
+
+@pytest.mark.asyncio
+async def test_breakdown_unavailable_when_every_provider_times_out(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a breakdown or delivery that no provider could quote in time is a 503, with the providers.
+    """
+    async def slow_delivery_times(*_):
+        await asyncio.sleep(5)
+
+    async def no_estimates(*_):
+        return {}
+
+    monkeypatch.setattr(delivery, "PROVIDER_QUOTE_TIMEOUT", 0.1)
+    monkeypatch.setattr(delivery.delivery_matrix, "lookup", no_estimates)
+    for provider in delivery.shipping_providers.values():
+        monkeypatch.setattr(provider, "get_delivery_times", slow_delivery_times)
+
+    request = CreateDeliveryRequest(
+        delivery_sla=SLA.STANDARD,
+        items=[ShipmentItem(upc=8, stock=3)],
+        recipient_address="2683 NC-24, Warsaw, NC 28398"
+    )
+
+    for create in (make_delivery_breakdown, lambda request: create_order_delivery(uuid4(), request, None)):
+        with pytest.raises(HTTPException) as e:
+            await create(request)
+
+        assert e.value.status_code == 503
+        assert set(e.value.detail["unavailable_providers"]) == set(delivery.shipping_providers)
+
+
+@pytest.mark.asyncio
+async def test_breakdown_uses_delivery_matrix(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a breakdown to a precomputed cell does not quote the providers.
+    """
+    recipient_address = "1790 Quarry Rd, Winston-Salem, NC 27107"
+    cell = delivery_matrix.cell(await get_address_coordinates(recipient_address))
+
+    async def unavailable_delivery_times(*_):
+        raise RuntimeError("Provider should not be quoted.")
+
+    for client in delivery.shipping_providers.values():
+        monkeypatch.setattr(client, "get_delivery_times",
+                            unavailable_delivery_times)
+
+    async with Session() as db:
+        assert await build_delivery_matrix(db, delivery.shipping_providers, [cell]) > 0
+
+    try:
+        delivery_matrix.clear()
+        breakdown = await get_delivery_breakdown(
+            recipient_address,
+            SLA.STANDARD,
+            [ShipmentItem(upc=9, stock=3)]
+        )
+        assert breakdown.unavailable_providers == []
+        assert len(breakdown.delivery_times) == 1
+    finally:
+        async with Session() as db:
+            await db.execute(delete(DeliveryEstimate))
+            await db.commit()
+        delivery_matrix.clear()
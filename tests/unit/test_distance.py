@@ -0,0 +1,64 @@
+"""
+Unit tests for the vectorized distance module.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+from random import Random
+
+from geopy.distance import geodesic
+
+from app.shipping import geohash
+from app.shipping.distance import distance_matrix, distances
+
+rng = Random(7)
+origins = [(rng.uniform(25, 49), rng.uniform(-124, -67)) for _ in range(20)]
+destinations = [(rng.uniform(25, 49), rng.uniform(-124, -67))
+                for _ in range(30)]
+
+
+def test_distances_within_error_bound():
+    """
+    Tests both modes against geodesic distances, within their documented error bounds.
+    """
+    for origin in origins:
+        expected = [geodesic(origin, destination).miles
+                    for destination in destinations]
+        approximate = distances(origin, destinations)
+        precise = distances(origin, destinations, precise=True)
+
+        for i, miles in enumerate(expected):
+            assert abs(approximate[i] - miles) <= miles * 0.006
+            assert abs(precise[i] - miles) <= miles * 0.00001
+
+
+def test_distance_matrix_matches_distances():
+    """
+    Tests that the many-to-many distances match the one-to-many distances.
+    """
+    matrix = distance_matrix(origins, destinations, precise=True)
+    assert matrix.shape == (len(origins), len(destinations))
+
+    for i, origin in enumerate(origins):
+        assert (abs(matrix[i] - distances(origin, destinations, precise=True)) < 1e-9).all()
+
+
+def test_distance_to_self():
+    """
+    Tests that the distance from a point to itself is zero, and not NaN.
+    """
+    assert distances(origins[0], [origins[0]], precise=True)[0] == 0.0
+    assert distances(origins[0], [origins[0]])[0] == 0.0
+
+
+def test_geohash_round_trip():
+    """
+    Tests geohash encoding against a known cell, and that a cell decodes to its center.
+    """
+    assert geohash.encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+
+    for origin in origins:
+        cell = geohash.encode(*origin, 5)
+        center = geohash.decode(cell)
+        assert geohash.encode(*center, 5) == cell
+        assert distances(origin, [center])[0] < 3
@@ -0,0 +1,175 @@
+"""
+Unit tests for idempotency keys.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException
+
+from app.database import Session, idempotency
+from app.database.schemas import IdempotencyRecord
+from app.database.idempotency import run_idempotent
+from app.routers import orders
+from app.routers.orders import create_order_return
+from app.shipping.enums import Provider
+from app.shipping.models import (CreateReturnRequest, Return, Shipment,
+                                 ShipmentItem)
+
+
+@pytest.mark.asyncio
+async def test_return_replay(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a retried return gets the first response, without creating it again,
+    and that the key cannot be used for a different return.
+    """
+    created = []
+
+    async def create_return(order_id, return_request, *_):
+        shipment_id = uuid4()
+        created.append(return_request)
+        return Return(
+            order_id=order_id,
+            return_id=uuid4(),
+            shipment=Shipment(
+                shipment_id=shipment_id,
+                from_address=return_request.from_address,
+                shipping_address="119 Ranch Dr, Maggie Valley, NC 28751",
+                provider=Provider.INTERNAL,
+                provider_shipment_id=str(shipment_id),
+                created_at=datetime.now(),
+                items=return_request.items
+            ),
+            created_at=datetime.now(),
+            items=return_request.items
+        )
+
+    monkeypatch.setattr(orders, "_create_order_return", create_return)
+
+    order_id = uuid4()
+    key = str(uuid4())
+    request = CreateReturnRequest(
+        order_id=order_id,
+        items=[ShipmentItem(upc=1, stock=2)],
+        from_address="2683 NC-24, Warsaw, NC 28398"
+    )
+
+    first = await create_order_return(order_id, request, None, key)
+    retry = await create_order_return(order_id, request, None, key)
+
+    assert retry == first
+    assert len(created) == 1
+
+    other_request = request.model_copy(update={"items": [ShipmentItem(upc=2, stock=2)]})
+    with pytest.raises(HTTPException) as e:
+        await create_order_return(order_id, other_request, None, key)
+    assert e.value.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicates_wait():
+    """
+    Tests that duplicates wait for the first request, and that a failed request can be retried.
+    """
+    runs = []
+    request = ShipmentItem(upc=1, stock=1)
+
+    async def run(_):
+        runs.append(request)
+        await asyncio.sleep(0.2)
+        return request.model_copy(update={"stock": len(runs)})
+
+    key = str(uuid4())
+    responses = await asyncio.gather(*(
+        run_idempotent("test", key, request, ShipmentItem, run) for _ in range(3)
+    ))
+
+    assert len(runs) == 1
+    assert all(response.stock == 1 for response in responses)
+
+    async def fail(_):
+        raise RuntimeError("The request failed.")
+
+    key = str(uuid4())
+    with pytest.raises(RuntimeError):
+        await run_idempotent("test", key, request, ShipmentItem, fail)
+
+    response = await run_idempotent("test", key, request, ShipmentItem, run)
+    assert len(runs) == 2
+    assert response.stock == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_claim_is_released(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a claim which fails does not leave later requests with the same key waiting for it.
+    """
+    request = ShipmentItem(upc=1, stock=1)
+    claim = idempotency._claim
+
+    async def fail_claim(*_):
+        raise RuntimeError("The database is unavailable.")
+
+    async def run(_):
+        return request
+
+    key = str(uuid4())
+    monkeypatch.setattr(idempotency, "_claim", fail_claim)
+    with pytest.raises(RuntimeError):
+        await run_idempotent("test", key, request, ShipmentItem, run)
+
+    monkeypatch.setattr(idempotency, "_claim", claim)
+    response = await run_idempotent("test", key, request, ShipmentItem, run, wait=1)
+    assert response == request
+
+
+@pytest.mark.asyncio
+async def test_failed_finish_is_released(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a response which cannot be stored does not leave later requests with the same key waiting for it.
+    """
+    request = ShipmentItem(upc=1, stock=1)
+
+    async def fail_finish(*_):
+        raise RuntimeError("The database is unavailable.")
+
+    async def run(_):
+        return request
+
+    key = str(uuid4())
+    monkeypatch.setattr(idempotency, "_finish", fail_finish)
+    with pytest.raises(RuntimeError):
+        await run_idempotent("test", key, request, ShipmentItem, run)
+
+    assert idempotency.hash_key("test", key) not in idempotency._in_flight
+
+
+@pytest.mark.asyncio
+async def test_response_stored_with_request(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a response stored in the transaction of the request is kept without storing it again.
+    """
+    finished = []
+    request = ShipmentItem(upc=1, stock=1)
+
+    async def finish(*args):
+        finished.append(args)
+
+    async def run(store_response):
+        async with Session() as db:
+            await store_response(db, request)
+            await db.commit()
+        return request
+
+    key = str(uuid4())
+    monkeypatch.setattr(idempotency, "_finish", finish)
+    await run_idempotent("test", key, request, ShipmentItem, run)
+
+    async with Session() as db:
+        record = await db.get(IdempotencyRecord, idempotency.hash_key("test", key))
+    assert finished == []
+    assert ShipmentItem.model_validate_json(record.response) == request
@@ -4,10 +4,18 @@ Tests for the internal router
 
 __author__ = "Justin B. (justin@justin.directory)"
 
+from collections import Counter, OrderedDict
+
 import pytest
+from sqlalchemy import delete
 
+from app.database import Session
+from app.database.schemas import GeocodedAddress
 from app.parameters.pagination import PaginationParams
-from app.routers.internal import get_open_shipments
+from app.routers.internal import (get_metrics, get_open_shipments,
+                                  warm_geocode_cache)
+from app.shipping import location
+from app.shipping.geocoding import TokenBucket
 
 
 @pytest.mark.asyncio
@@ -19,3 +27,49 @@ async def test_get_open_internal_shipments(session):
     open_shipments = await get_open_shipments(params, session)
 
     assert len(open_shipments) == 1
+
+
+@pytest.mark.asyncio
+async def test_warm_geocode_cache(session, monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that every shipment & warehouse address is geocoded once, and served from the cache afterwards.
+    """
+    async with Session() as db:
+        await db.execute(delete(GeocodedAddress))
+        await db.commit()
+    monkeypatch.setattr(location, "_resolved", OrderedDict())
+    # The rate limit of the geocoder would otherwise take a second per address.
+    monkeypatch.setattr(location.geocoding_service, "rate_limit", 1000.0)
+    monkeypatch.setattr(location.geocoding_service, "_bucket", TokenBucket(1000.0, 1000.0))
+
+    calls = Counter()
+    geocode = location.geocoding_service.geocode
+
+    async def count_geocode(address):
+        calls[address] += 1
+        return await geocode(address)
+
+    monkeypatch.setattr(location.geocoding_service, "geocode", count_geocode)
+
+    response = await warm_geocode_cache(session)
+
+    assert response.addresses > 0
+    assert response.resolved + response.not_found + response.failed == response.addresses
+    assert len(calls) == response.addresses
+    assert all(count == 1 for count in calls.values())
+
+    calls.clear()
+    assert await warm_geocode_cache(session) == response
+    assert len(calls) == 0
+
+
+@pytest.mark.asyncio
+async def test_get_metrics(session):
+    """
+    Tests that connection pool checkouts are counted.
+    """
+    await get_open_shipments(PaginationParams(), session)
+    metrics = await get_metrics()
+
+    assert metrics.pool.checkouts > 0
+    assert metrics.pool.connects > 0
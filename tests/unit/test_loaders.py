@@ -0,0 +1,131 @@
+"""
+Tests that the amount of queries of each endpoint does not grow with the amount of rows it returns.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.auth.profile import AccountProfile
+from app.database import schemas
+from app.parameters.pagination import PaginationParams
+from app.parameters.shipment import (BaseShipmentQueryParams,
+                                     FullShipmentQueryParams)
+from app.routers.deliveries import get_delivery_shipments
+from app.routers.internal import get_open_shipments
+from app.routers.orders import get_order_deliveries
+from app.routers.shipments import get_shipments
+from app.routers.users import get_user_deliveries, get_user_shipments
+from app.shipping.enums import SLA, Provider, Status
+from app.shipping.models import Delivery, Shipment
+from tests.conftest import mock_delivery_id, mock_order_id
+
+
+async def add_delivery(session: AsyncSession, shipments: int) -> schemas.Delivery:
+    """
+    Add a delivery with internal, pending shipments to the mock order.
+    The session is cleared afterwards, so every row is loaded from the database again.
+    """
+    delivery = schemas.Delivery(
+        delivery_id=uuid4(),
+        order_id=mock_order_id,
+        created_at=datetime.now(),
+        delivery_sla=SLA.STANDARD,
+        recipient_address="2683 NC-24, Warsaw, NC 28398",
+        shipments=[
+            schemas.Shipment(
+                shipment_id=uuid4(),
+                shipping_address="2683 NC-24, Warsaw, NC 28398",
+                from_address="279 Kadire Dr, Marion, NC 28752",
+                provider=Provider.INTERNAL,
+                provider_shipment_id=str(uuid4()),
+                created_at=datetime.now() - timedelta(minutes=i),
+                items=[schemas.ShipmentItem(upc=1, stock=1),
+                       schemas.ShipmentItem(upc=2, stock=2)],
+                status=schemas.ShipmentStatus(
+                    message=Status.PENDING,
+                    expected_at=datetime.now() + timedelta(days=3),
+                    updated_at=datetime.now()
+                )
+            )
+            for i in range(shipments)
+        ]
+    )
+    session.add(delivery)
+    await session.flush()
+    session.expunge_all()
+    return delivery
+
+
+@pytest.mark.asyncio
+async def test_shipment_listing_queries(session: AsyncSession, account: AccountProfile, count_queries):
+    """
+    Tests that serializing a larger page of shipments takes the same amount of queries.
+    """
+    await add_delivery(session, 6)
+
+    async def list_shipments(limit: int):
+        shipments = await get_shipments(FullShipmentQueryParams(limit=limit), session)
+        return [Shipment.model_validate(shipment) for shipment in shipments]
+
+    async def list_user_shipments(limit: int):
+        shipments = await get_user_shipments(account.user_id, BaseShipmentQueryParams(limit=limit), session)
+        return [Shipment.model_validate(shipment) for shipment in shipments]
+
+    async def list_open_shipments(limit: int):
+        shipments = await get_open_shipments(PaginationParams(limit=limit), session)
+        return [Shipment.model_validate(shipment) for shipment in shipments]
+
+    for list_page in (list_shipments, list_user_shipments, list_open_shipments):
+        small_page, small_queries = await count_queries(list_page(1))
+        large_page, large_queries = await count_queries(list_page(8))
+
+        assert len(large_page) > len(small_page)
+        assert large_queries == small_queries, list_page.__name__
+
+
+@pytest.mark.asyncio
+async def test_delivery_queries(session: AsyncSession, account: AccountProfile, count_queries):
+    """
+    Tests that serializing deliveries with more shipments takes the same amount of queries.
+    """
+    async def list_delivery_shipments(delivery_id):
+        shipments = await get_delivery_shipments(delivery_id, session)
+        return [Shipment.model_validate(shipment) for shipment in shipments]
+
+    async def list_user_deliveries():
+        deliveries = await get_user_deliveries(account.user_id, session)
+        return [Delivery.model_validate(delivery) for delivery in deliveries]
+
+    _, small_queries = await count_queries(list_delivery_shipments(mock_delivery_id))
+    _, small_user_queries = await count_queries(list_user_deliveries())
+
+    delivery = await add_delivery(session, 6)
+
+    _, large_queries = await count_queries(list_delivery_shipments(delivery.delivery_id))
+    deliveries, large_user_queries = await count_queries(list_user_deliveries())
+
+    assert large_queries == small_queries
+    assert len(deliveries) == 2
+    assert large_user_queries == small_user_queries
+
+
+@pytest.mark.asyncio
+async def test_order_deliveries_queries(session: AsyncSession, count_queries):
+    """
+    Tests that an order split into more deliveries takes the same amount of queries.
+    """
+    _, small_queries = await count_queries(get_order_deliveries(mock_order_id, session))
+
+    for _ in range(3):
+        await add_delivery(session, 4)
+
+    deliveries, large_queries = await count_queries(get_order_deliveries(mock_order_id, session))
+
+    assert len(deliveries) == 4
+    assert sum(len(delivery.shipments) for delivery in deliveries) == 14
+    assert large_queries == small_queries
@@ -0,0 +1,162 @@
+"""
+Unit tests for the location module.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+import asyncio
+import time
+
+import pytest
+from geopy.exc import GeocoderServiceError
+
+from app.shipping import location
+from app.shipping.geocoding import GeocodingService, TokenBucket
+from app.shipping.location import (AddressNotFoundException,
+                                   _store_cached_coordinates,
+                                   geocode_cache_stats,
+                                   get_address_coordinates,
+                                   get_addresses_coordinates,
+                                   normalize_address)
+
+
+def test_normalize_address():
+    """
+    Tests that formatting differences normalize to the same address.
+    """
+    expected = "279 kadire dr, marion, nc 28752"
+    assert normalize_address("279 Kadire Dr, Marion, NC 28752") == expected
+    assert normalize_address("  279  KADIRE Dr. ,Marion,NC 28752 ") == expected
+
+
+@pytest.mark.asyncio
+async def test_cached_address_coordinates():
+    """
+    Tests that coordinates stored in the shared cache are used instead of geocoding.
+    """
+    await _store_cached_coordinates("1 cached test ln, nowhere, nc 00000", (1.5, -2.5))
+    hits = geocode_cache_stats.hits
+
+    coordinates = await get_address_coordinates("1 Cached Test Ln,  Nowhere, NC 00000")
+    assert coordinates == (1.5, -2.5)
+    assert geocode_cache_stats.hits == hits + 1
+
+
+@pytest.mark.asyncio
+async def test_negative_cached_address_coordinates():
+    """
+    Tests that addresses cached as not found raise without geocoding.
+    """
+    await _store_cached_coordinates("2 missing test ln, nowhere, nc 00000", None)
+    negative_hits = geocode_cache_stats.negative_hits
+
+    with pytest.raises(AddressNotFoundException):
+        await get_address_coordinates("2 Missing Test Ln, Nowhere, NC 00000")
+    assert geocode_cache_stats.negative_hits == negative_hits + 1
+
+
+@pytest.mark.asyncio
+async def test_coalesced_address_coordinates():
+    """
+    Tests that concurrent lookups for the same normalized address share one lookup, and are counted,
+    whether or not their text is the same.
+    """
+    await _store_cached_coordinates("3 shared test ln, nowhere, nc 00000", (3.0, -3.0))
+    coalesced = geocode_cache_stats.coalesced
+
+    results = await asyncio.gather(
+        get_address_coordinates("3 Shared Test Ln, Nowhere, NC 00000"),
+        get_address_coordinates("3 Shared Test Ln, Nowhere, NC 00000"),
+        get_address_coordinates("3 shared test ln,nowhere,nc 00000"),
+        get_address_coordinates("3 SHARED TEST LN, NOWHERE, NC 00000")
+    )
+
+    assert results == [(3.0, -3.0)] * 4
+    assert geocode_cache_stats.coalesced == coalesced + 3
+
+
+@pytest.mark.asyncio
+async def test_batch_address_coordinates():
+    """
+    Tests that a batch returns a result for every given address, including duplicates.
+    """
+    await _store_cached_coordinates("4 batch test ln, nowhere, nc 00000", (4.0, -4.0))
+    await _store_cached_coordinates("5 batch test ln, nowhere, nc 00000", None)
+    addresses = [
+        "4 Batch Test Ln, Nowhere, NC 00000",
+        "4 batch test ln,nowhere,nc 00000",
+        "5 Batch Test Ln, Nowhere, NC 00000"
+    ]
+
+    coordinates, failed = await get_addresses_coordinates(addresses)
+    assert coordinates == {
+        addresses[0]: (4.0, -4.0),
+        addresses[1]: (4.0, -4.0),
+        addresses[2]: None
+    }
+    assert failed == set()
+
+
+@pytest.mark.asyncio
+async def test_batch_address_coordinates_failures(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that an address the geocoder fails on is reported, without failing the rest of the batch.
+    """
+    await _store_cached_coordinates("6 batch test ln, nowhere, nc 00000", (6.0, -6.0))
+    failing_address = "7 Failing Test Ln, Nowhere, NC 00000"
+
+    async def fail_geocode(_):
+        raise GeocoderServiceError("The geocoder is unavailable.")
+
+    monkeypatch.setattr(location.geocoding_service, "geocode", fail_geocode)
+
+    coordinates, failed = await get_addresses_coordinates(["6 Batch Test Ln, Nowhere, NC 00000", failing_address])
+    assert coordinates == {"6 Batch Test Ln, Nowhere, NC 00000": (6.0, -6.0), failing_address: None}
+    assert failed == {failing_address}
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_rate_limit():
+    """
+    Tests that the token bucket only lets a burst through, and then waits for tokens.
+    """
+    bucket = TokenBucket(rate=20, capacity=2)
+    started_at = time.monotonic()
+
+    for _ in range(4):
+        await bucket.acquire()
+
+    # Two tokens are available immediately, the other two take 1/20th of a second each.
+    assert time.monotonic() - started_at >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_geocoding_service_opens_once(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that first lookups made at once share one geocoder, and that it is closed with the service.
+    """
+    geocoders = []
+
+    class Geocoder:
+        closed = False
+
+        async def __aenter__(self):
+            # Opening yields to the event loop, so the other callers arrive in the meantime.
+            await asyncio.sleep(0.01)
+            return self
+
+        async def __aexit__(self, *_):
+            self.closed = True
+
+    def create_geocoder():
+        geocoders.append(Geocoder())
+        return geocoders[-1]
+
+    service = GeocodingService()
+    monkeypatch.setattr(service, "_create_geocoder", create_geocoder)
+
+    await asyncio.gather(*(service.open() for _ in range(5)))
+    assert len(geocoders) == 1
+
+    await service.close()
+    assert geocoders[0].closed
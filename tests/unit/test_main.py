@@ -0,0 +1,71 @@
+"""
+Unit tests for the main module.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+import asyncio
+from pathlib import Path
+
+import httpx
+import jwt
+import pytest
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app import main
+from app.database.schemas import Base
+from tests.conftest import jwt_content
+
+
+def role_headers(roles: str) -> dict[str, str]:
+    """
+    Get the headers of a user with the given roles, with a token that is only decoded in debug mode.
+    """
+    token = jwt.encode({**jwt_content, "extension_roles": roles}, "test")
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.mark.asyncio
+async def test_lifespan_creates_tables(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    """
+    Tests that starting the application through its middleware runs the lifespan, which creates the tables.
+    """
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'lifespan.db'}")
+    monkeypatch.setattr(main, "engine", engine)
+
+    received: asyncio.Queue = asyncio.Queue()
+    sent: asyncio.Queue = asyncio.Queue()
+    await received.put({"type": "lifespan.startup"})
+    lifespan = asyncio.create_task(main.app(
+        {"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}}, received.get, sent.put))
+
+    assert (await asyncio.wait_for(sent.get(), timeout=10))["type"] == "lifespan.startup.complete"
+    await received.put({"type": "lifespan.shutdown"})
+    assert (await asyncio.wait_for(sent.get(), timeout=10))["type"] == "lifespan.shutdown.complete"
+    await lifespan
+
+    async with engine.connect() as connection:
+        tables = await connection.run_sync(lambda sync: inspect(sync).get_table_names())
+    await engine.dispose()
+
+    assert set(Base.metadata.tables) <= set(tables)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("method, path", [
+    ("GET", "/internal/metrics"),
+    ("POST", "/internal/geocode/warm"),
+    ("POST", "/internal/search/rebuild")
+])
+async def test_staff_endpoints_need_staff_role(method: str, path: str):
+    """
+    Tests that the staff endpoints under /internal only require the staff role, and not the driver role.
+    """
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        driver = await client.request(method, path, headers=role_headers("SHP-DLR"))
+        staff = await client.request(method, path, headers=role_headers("SHP-STF"))
+
+    assert driver.status_code == 403
+    assert staff.status_code == 200
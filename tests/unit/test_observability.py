@@ -0,0 +1,43 @@
+"""
+Unit tests for SQL observability.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from sqlalchemy import select
+
+from app.database import Session, engine
+from app.database.observability import instrument_queries, route_query_stats
+from app.database.schemas import Warehouse
+from app.middleware.timing import QueryTimingMiddleware
+
+
+@pytest.mark.asyncio
+async def test_query_timing_middleware():
+    """
+    Tests that the queries of a request are reported in Server-Timing, and counted for its route.
+    """
+    instrument_queries(engine)
+    app = FastAPI()
+    app.add_middleware(QueryTimingMiddleware)
+
+    @app.get("/warehouses/{count}")
+    async def get_warehouses(count: int) -> int:
+        async with Session() as db:
+            for _ in range(count):
+                await db.scalars(select(Warehouse))
+        return count
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/warehouses/3")
+
+    assert response.status_code == 200
+    assert 'desc="3 queries"' in response.headers["server-timing"]
+    route_stats = route_query_stats["GET /warehouses/{count}"]
+    assert route_stats.requests == 1
+    assert route_stats.max_queries == 3
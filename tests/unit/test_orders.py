@@ -5,19 +5,34 @@ Test order-related router requests.
 __author__ = "Justin B. (justin@justin.directory)"
 
 
-from app.routers.orders import create_order_delivery, create_order_return
-from app.shipping.enums import SLA
-from app.shipping.models import CreateDeliveryRequest, CreateReturnRequest, ShipmentItem
-
+from datetime import datetime, timedelta
+from uuid import uuid4
 
 import pytest
-from sqlalchemy.orm.session import Session
+from fastapi import HTTPException
+from geopy.exc import GeocoderTimedOut
+from pydantic import ValidationError
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from uuid import uuid4
+from app.database.schemas import DeliverySearchKey, WarehouseItem
+from app.inventory.allocation import OutOfStockException
+from app.routers import orders
+from app.routers.deliveries import make_delivery_breakdown
+from app.routers.orders import (create_order_delivery, create_order_return,
+                                get_order_deliveries)
+from app.shipping import bulk, location
+from app.shipping.bulk import create_bulk_deliveries
+from app.shipping.enums import SLA, Provider
+from app.shipping.models import (BulkDeliveryRequest, CreateDeliveryRequest,
+                                 CreateReturnRequest, CreateShipmentRequest,
+                                 ShipmentItem)
+from app.shipping.providers import internal, ups
+from app.shipping.shipment import create_shipments
 
 
 @pytest.mark.asyncio
-async def test_create_delivery(session: Session):
+async def test_create_delivery(session: AsyncSession):
     """
     Tests the creation of a shipment.
     """
@@ -39,7 +54,293 @@ async def test_create_delivery(session: Session):
 
 
 @pytest.mark.asyncio
-async def test_create_return(session: Session):
+async def test_create_delivery_from_quote(session: AsyncSession, monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a delivery made with a quote ID uses the quoted breakdown,
+    and that the breakdown is made again if the quote was for a different request.
+    """
+    request = CreateDeliveryRequest(
+        delivery_sla=SLA.STANDARD,
+        items=[
+            ShipmentItem(upc=5, stock=4),
+            ShipmentItem(upc=6, stock=3)
+        ],
+        recipient_address="2683 NC-24, Warsaw, NC 28398"
+    )
+    breakdown = await make_delivery_breakdown(request)
+    assert breakdown.quote_id is not None
+
+    async def no_breakdown(*_):
+        raise AssertionError("The breakdown was already quoted.")
+
+    monkeypatch.setattr(orders, "get_delivery_breakdown", no_breakdown)
+
+    changed_request = request.model_copy(update={
+        "quote_id": breakdown.quote_id,
+        "items": [ShipmentItem(upc=5, stock=40)]
+    })
+    with pytest.raises(AssertionError):
+        await create_order_delivery(uuid4(), changed_request, session)
+
+    malformed_request = request.model_copy(update={"quote_id": "invalid"})
+    with pytest.raises(HTTPException) as e:
+        await create_order_delivery(uuid4(), malformed_request, session)
+    assert e.value.status_code == 400
+
+    request.quote_id = breakdown.quote_id
+    delivery = await create_order_delivery(uuid4(), request, session)
+    assert len(delivery.shipments) == len(breakdown.delivery_times)
+
+
+@pytest.mark.asyncio
+async def test_create_delivery_rolls_back_stock(session: AsyncSession, monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that the stock reserved for a delivery is released, and its shipments cancelled, when it cannot be stored.
+    """
+    cancelled = []
+
+    async def fail_commit():
+        raise RuntimeError("Database is down.")
+
+    async def cancel_shipments(shipments):
+        cancelled.extend(shipments)
+
+    monkeypatch.setattr(session, "commit", fail_commit)
+    monkeypatch.setattr(orders, "cancel_shipments", cancel_shipments)
+    stock_query = select(func.sum(WarehouseItem.stock)).where(WarehouseItem.upc.in_([1, 2]))
+    stock_before = await session.scalar(stock_query)
+
+    request = CreateDeliveryRequest(
+        delivery_sla=SLA.STANDARD,
+        items=[
+            ShipmentItem(upc=1, stock=9),
+            ShipmentItem(upc=2, stock=12)
+        ],
+        recipient_address="2683 NC-24, Warsaw, NC 28398"
+    )
+
+    with pytest.raises(RuntimeError):
+        await create_order_delivery(uuid4(), request, session)
+
+    assert await session.scalar(stock_query) == stock_before
+    assert len(cancelled) > 0
+
+
+@pytest.mark.asyncio
+async def test_create_delivery_reserves_after_shipments(session: AsyncSession, monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that stock is only reserved once the shipments are created,
+    and that the shipments are cancelled if the stock was taken in the meantime.
+    """
+    calls = []
+    create = orders.create_shipments
+
+    async def create_shipments(requests):
+        calls.append("create")
+        return await create(requests)
+
+    async def reserve_warehouse_stock(_, warehouse_items):
+        calls.append("reserve")
+        warehouse_id = next(iter(warehouse_items))
+        raise OutOfStockException("Not enough stock to fulfill the order.", {warehouse_id: [1]})
+
+    async def cancel_shipments(shipments):
+        calls.append(("cancel", len(shipments)))
+
+    monkeypatch.setattr(orders, "create_shipments", create_shipments)
+    monkeypatch.setattr(orders, "reserve_warehouse_stock", reserve_warehouse_stock)
+    monkeypatch.setattr(orders, "cancel_shipments", cancel_shipments)
+
+    request = CreateDeliveryRequest(
+        delivery_sla=SLA.STANDARD,
+        items=[ShipmentItem(upc=1, stock=1)],
+        recipient_address="2683 NC-24, Warsaw, NC 28398"
+    )
+
+    with pytest.raises(HTTPException) as e:
+        await create_order_delivery(uuid4(), request, session)
+
+    assert e.value.status_code == 409
+    assert calls == ["create", "reserve", ("cancel", 1)]
+
+
+@pytest.mark.asyncio
+async def test_create_shipments_cancels_finished(monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that the shipments which were created are cancelled when another one fails,
+    and that quoted shipments are not estimated again.
+    """
+    cancelled = []
+
+    async def fail_shipment(*_):
+        raise RuntimeError("Provider is down.")
+
+    async def record_cancel(shipment):
+        cancelled.append(shipment.shipment_id)
+
+    async def no_estimate(*_):
+        raise AssertionError("The shipment was already quoted.")
+
+    monkeypatch.setattr(ups.client, "create_shipment", fail_shipment)
+    monkeypatch.setattr(internal.client, "cancel_shipment", record_cancel)
+    monkeypatch.setattr(internal.client, "get_delivery_time", no_estimate)
+
+    expected_at = datetime.now() + timedelta(days=2)
+    requests = [
+        (CreateShipmentRequest(
+            from_address="279 Kadire Dr, Marion, NC 28752",
+            shipping_address="2683 NC-24, Warsaw, NC 28398",
+            items=[ShipmentItem(upc=1, stock=1)],
+            provider=provider
+        ), expected_at)
+        for provider in (Provider.INTERNAL, Provider.UPS, Provider.INTERNAL)
+    ]
+
+    shipments = await create_shipments([requests[0], requests[2]])
+    assert len(shipments) == 2
+
+    with pytest.raises(RuntimeError):
+        await create_shipments(requests)
+
+    assert len(cancelled) == 2
+
+
+@pytest.mark.asyncio
+async def test_create_bulk_deliveries(session: AsyncSession):
+    """
+    Tests that a bulk import creates every delivery it can, and fails the rest by themselves.
+    """
+    requests = [
+        BulkDeliveryRequest(
+            order_id=uuid4(),
+            delivery_sla=SLA.STANDARD,
+            items=[ShipmentItem(upc=upc, stock=2)],
+            recipient_address=address
+        )
+        for upc, address in ((7, "2683 NC-24, Warsaw, NC 28398"),
+                             (8, "1790 Quarry Rd, Winston-Salem, NC 27107"),
+                             (7, "196 NC-801, Bermuda Run, NC 27006"))
+    ]
+    requests.insert(1, BulkDeliveryRequest(
+        order_id=uuid4(),
+        delivery_sla=SLA.STANDARD,
+        items=[ShipmentItem(upc=9, stock=1000)],
+        recipient_address="2683 NC-24, Warsaw, NC 28398"
+    ))
+    stock_query = select(func.sum(WarehouseItem.stock)).where(WarehouseItem.upc.in_([7, 8]))
+    stock_before = await session.scalar(stock_query)
+
+    results = [result async for result in create_bulk_deliveries(session, requests)]
+
+    assert [result.order_id for result in results] == [request.order_id for request in requests]
+    assert results[1].error == "Out of stock"
+    assert all(result.delivery is not None for i, result in enumerate(results) if i != 1)
+    assert await session.scalar(stock_query) == stock_before - 6
+
+    deliveries = await get_order_deliveries(requests[0].order_id, session)
+    assert len(deliveries) == 1
+    assert deliveries[0].shipments[0].items == [ShipmentItem(upc=7, stock=2)]
+
+    # Bulk inserts skip the ORM events, so the search indexes are written with them.
+    search_key = await session.get(DeliverySearchKey, deliveries[0].delivery_id.hex)
+    assert search_key is not None
+
+
+@pytest.mark.asyncio
+async def test_bulk_deliveries_reserve_after_shipments(session: AsyncSession, monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a bulk import reserves stock once the shipments are created,
+    and that the orders whose stock was taken in the meantime fail with their shipments cancelled.
+    """
+    calls = []
+    create, reserve = bulk.create_shipments, bulk.reserve_warehouse_stock
+
+    async def create_shipments(requests):
+        calls.append("create")
+        return await create(requests)
+
+    async def reserve_warehouse_stock(db, warehouse_items):
+        calls.append("reserve")
+        short = {
+            warehouse_id: [11]
+            for warehouse_id, items in warehouse_items.items()
+            if any(item.upc == 11 for item in items)
+        }
+        if len(short) > 0:
+            raise OutOfStockException("Not enough stock to fulfill the order.", short)
+        await reserve(db, warehouse_items)
+
+    async def cancel_shipments(shipments):
+        calls.append(("cancel", len(shipments)))
+
+    monkeypatch.setattr(bulk, "create_shipments", create_shipments)
+    monkeypatch.setattr(bulk, "reserve_warehouse_stock", reserve_warehouse_stock)
+    monkeypatch.setattr(bulk, "cancel_shipments", cancel_shipments)
+
+    requests = [
+        BulkDeliveryRequest(
+            order_id=uuid4(),
+            delivery_sla=SLA.STANDARD,
+            items=[ShipmentItem(upc=upc, stock=1)],
+            recipient_address="2683 NC-24, Warsaw, NC 28398"
+        )
+        for upc in (10, 11)
+    ]
+
+    results = [result async for result in create_bulk_deliveries(session, requests)]
+
+    assert results[0].delivery is not None
+    assert results[1].error == "Out of stock"
+    assert calls == ["create", "create", "reserve", ("cancel", 1), "reserve"]
+
+
+@pytest.mark.asyncio
+async def test_bulk_deliveries_fail_by_themselves(session: AsyncSession, monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that a geocoder error fails only its order, and that a batch which fails does not stop the next one.
+    """
+    failing_address = f"{uuid4()} Failing Test Ln, Nowhere, NC 00000"
+    geocode = location.geocoding_service.geocode
+    allocate = bulk._allocate
+    batches = []
+
+    async def fail_geocode(address):
+        if address == failing_address:
+            raise GeocoderTimedOut("The geocoder timed out.")
+        return await geocode(address)
+
+    async def fail_first_batch(db, batch, results):
+        batches.append(batch)
+        if len(batches) == 1:
+            raise RuntimeError("Database is down.")
+        return await allocate(db, batch, results)
+
+    monkeypatch.setattr(location.geocoding_service, "geocode", fail_geocode)
+    monkeypatch.setattr(bulk, "_allocate", fail_first_batch)
+    monkeypatch.setattr(bulk, "BULK_DELIVERY_BATCH_SIZE", 2)
+
+    requests = [
+        BulkDeliveryRequest(
+            order_id=uuid4(),
+            delivery_sla=SLA.STANDARD,
+            items=[ShipmentItem(upc=12, stock=1)],
+            recipient_address=address
+        )
+        for address in ("2683 NC-24, Warsaw, NC 28398", "1790 Quarry Rd, Winston-Salem, NC 27107",
+                        "2683 NC-24, Warsaw, NC 28398", failing_address)
+    ]
+
+    results = [result async for result in create_bulk_deliveries(session, requests)]
+
+    assert [result.order_id for result in results] == [request.order_id for request in requests]
+    assert [result.error for result in results] == [
+        "Delivery could not be created", "Delivery could not be created",
+        None, "Address could not be geocoded"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_create_return(session: AsyncSession):
     order_id = uuid4()
     request = CreateReturnRequest(
         order_id=order_id,
@@ -52,3 +353,17 @@ async def test_create_return(session: Session):
     order_return = await create_order_return(order_id, request, session)
     assert order_return.order_id == order_id
     assert order_return.created_at is not None
+
+
+def test_bulk_delivery_request_rejects_quote():
+    """
+    Tests that a bulk delivery request does not take a quote ID, which the bulk import would not use.
+    """
+    with pytest.raises(ValidationError):
+        BulkDeliveryRequest(
+            order_id=uuid4(),
+            delivery_sla=SLA.STANDARD,
+            items=[ShipmentItem(upc=1, stock=1)],
+            recipient_address="2683 NC-24, Warsaw, NC 28398",
+            quote_id="quote"
+        )
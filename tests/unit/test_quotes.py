@@ -0,0 +1,50 @@
+"""
+Unit tests for delivery quotes.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+from datetime import datetime
+from uuid import UUID
+
+import pytest
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.schemas import DeliveryQuote
+from app.shipping.enums import SLA
+from app.shipping.models import (CreateDeliveryRequest,
+                                 ShipmentDeliveryBreakdown, ShipmentItem)
+from app.shipping.quotes import save_quote, use_quote
+
+
+@pytest.mark.asyncio
+async def test_quote_used_once(session: AsyncSession):
+    """
+    Tests that a quote which another request deleted after it was read is not used again.
+    """
+    request = CreateDeliveryRequest(
+        delivery_sla=SLA.STANDARD,
+        items=[ShipmentItem(upc=1, stock=1)],
+        recipient_address="2683 NC-24, Warsaw, NC 28398"
+    )
+    breakdown = ShipmentDeliveryBreakdown(
+        recipient_address=request.recipient_address,
+        expected_at=datetime.now(),
+        can_meet_sla=True,
+        delivery_times=[]
+    )
+    request.quote_id = await save_quote(session, request, breakdown)
+    await session.flush()
+    quote_id = UUID(hex=request.quote_id.split(".")[0])
+
+    # This request has read the quote, when another request uses it.
+    quote = await session.get(DeliveryQuote, quote_id)
+    assert quote is not None
+    await session.execute(
+        delete(DeliveryQuote)
+        .where(DeliveryQuote.quote_id == quote_id)
+        .execution_options(synchronize_session=False)
+    )
+
+    assert await use_quote(session, request) is None
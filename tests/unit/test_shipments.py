@@ -4,21 +4,30 @@ Unit tests for the shipments module.
 
 __author__ = "Justin B. (justin@justin.directory)"
 
+import csv
+import io
+import json
+from contextlib import asynccontextmanager
 from uuid import UUID
 
 import pytest
-from sqlalchemy.orm.session import Session
+from fastapi import HTTPException, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.auth.profile import AccountProfile
+from app.parameters.pagination import NEXT_CURSOR_HEADER, PREV_CURSOR_HEADER
 from app.parameters.shipment import FullShipmentQueryParams
-from app.routers.shipments import (get_shipment, get_shipments,
+from app.routers import shipments as shipments_router
+from app.routers.shipments import (ExportFormat, export_shipments,
+                                   get_shipment, get_shipments,
                                    update_shipment_status)
 from app.shipping.providers import ShipmentProvider
 from app.shipping.enums import Status
 from app.shipping.models import ShipmentStatusPatchRequest
+from app.shipping.search import rebuild_search_index
 
 
 @pytest.mark.asyncio
-async def test_get_shipment(session: Session, shipment_id: UUID):
+async def test_get_shipment(session: AsyncSession, shipment_id: UUID):
     """
     Tests the retrieval of a shipment.
     """
@@ -28,7 +37,7 @@ async def test_get_shipment(session: Session, shipment_id: UUID):
 
 
 @pytest.mark.asyncio
-async def test_get_shipments(session: Session):
+async def test_get_shipments(session: AsyncSession):
     """
     Tests the retrieval of all shipments.
     """
@@ -38,7 +47,7 @@ async def test_get_shipments(session: Session):
 
 
 @pytest.mark.asyncio
-async def test_get_shipments_from_partial_delivery_id(delivery_id: UUID, session: Session):
+async def test_get_shipments_from_partial_delivery_id(delivery_id: UUID, session: AsyncSession):
     """
     Test a partial shipment query, with the delivery ID filled in.
     """
@@ -48,7 +57,7 @@ async def test_get_shipments_from_partial_delivery_id(delivery_id: UUID, session
 
 
 @pytest.mark.asyncio
-async def test_get_shipments_from_invalid_delivery_id(session: Session):
+async def test_get_shipments_from_invalid_delivery_id(session: AsyncSession):
     """
     Create a shipment query with an invalid delivery ID.
     """
@@ -58,7 +67,7 @@ async def test_get_shipments_from_invalid_delivery_id(session: Session):
 
 
 @pytest.mark.asyncio
-async def test_update_shipment_status(shipment_id: UUID, session: Session, account: AccountProfile):
+async def test_update_shipment_status(shipment_id: UUID, session: AsyncSession, account: AccountProfile):
     """
     Test updating the shipment status.
     """
@@ -71,3 +80,82 @@ async def test_update_shipment_status(shipment_id: UUID, session: Session, accou
     )
     status = await update_shipment_status(shipment_id, new_status, session, account)
     assert status.message == Status.SHIPPED
+
+
+@pytest.mark.asyncio
+async def test_get_shipments_from_partial_address(session: AsyncSession):
+    """
+    Tests wildcard searches through the trigram index, ignoring case.
+    """
+    shipments = await get_shipments(FullShipmentQueryParams(shipping_address="nc-24, WARSAW"), session)
+    assert len(shipments) == 2
+
+    shipments = await get_shipments(FullShipmentQueryParams(from_address="Kadire"), session)
+    assert len(shipments) == 2
+
+    shipments = await get_shipments(FullShipmentQueryParams(shipping_address="Warsaw, TX"), session)
+    assert len(shipments) == 0
+
+
+@pytest.mark.asyncio
+async def test_rebuild_search_index(session: AsyncSession):
+    """
+    Tests that rebuilding the search indexes keeps the same results.
+    """
+    shipments, deliveries = await rebuild_search_index(session)
+    assert shipments >= 2
+    assert deliveries >= 1
+
+    shipment_query = FullShipmentQueryParams(shipping_address="Warsaw")
+    assert len(await get_shipments(shipment_query, session)) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_shipments_by_cursor(session: AsyncSession):
+    """
+    Tests paging forwards & backwards through the shipments with cursors.
+    """
+    response = Response()
+    first_page = await get_shipments(FullShipmentQueryParams(limit=1), session, response)
+    assert PREV_CURSOR_HEADER not in response.headers
+
+    next_cursor = response.headers[NEXT_CURSOR_HEADER]
+    response = Response()
+    second_page = await get_shipments(FullShipmentQueryParams(limit=1, cursor=next_cursor), session, response)
+    assert second_page[0].shipment_id != first_page[0].shipment_id
+    assert NEXT_CURSOR_HEADER not in response.headers
+
+    prev_cursor = response.headers[PREV_CURSOR_HEADER]
+    response = Response()
+    previous_page = await get_shipments(FullShipmentQueryParams(limit=1, cursor=prev_cursor), session, response)
+    assert previous_page[0].shipment_id == first_page[0].shipment_id
+    assert PREV_CURSOR_HEADER not in response.headers
+
+    with pytest.raises(HTTPException):
+        await get_shipments(FullShipmentQueryParams(cursor="invalid"), session)
+
+
+@pytest.mark.asyncio
+async def test_export_shipments(session: AsyncSession, monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that the export streams every shipment, in the order of the listing, as NDJSON & CSV.
+    """
+    @asynccontextmanager
+    async def test_session():
+        yield session
+
+    monkeypatch.setattr(shipments_router, "Session", test_session)
+    monkeypatch.setattr(shipments_router, "SHIPMENT_EXPORT_BATCH_SIZE", 1)
+    listed = await get_shipments(FullShipmentQueryParams(limit=100), session)
+    shipment_ids = [str(shipment.shipment_id) for shipment in listed]
+
+    response = await export_shipments(FullShipmentQueryParams(limit=1), ExportFormat.NDJSON)
+    assert response.media_type == "application/x-ndjson"
+    body = "".join([chunk async for chunk in response.body_iterator])
+    assert [json.loads(line)["shipment_id"] for line in body.splitlines()] == shipment_ids
+
+    response = await export_shipments(FullShipmentQueryParams(), ExportFormat.CSV)
+    assert response.media_type == "text/csv"
+    body = "".join([chunk async for chunk in response.body_iterator])
+    rows = list(csv.DictReader(io.StringIO(body)))
+    assert [row["shipment_id"] for row in rows] == shipment_ids
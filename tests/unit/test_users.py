@@ -7,7 +7,7 @@ __author__ = "Justin B. (justin@justin.directory)"
 from uuid import UUID, uuid4
 from fastapi import HTTPException
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.auth.profile import AccountProfile
 from app.parameters.shipment import BaseShipmentQueryParams
@@ -15,7 +15,7 @@ from app.routers.users import get_user_shipment, get_user_shipments
 
 
 @pytest.mark.asyncio
-async def test_get_user_shipments(account: AccountProfile, session: Session):
+async def test_get_user_shipments(account: AccountProfile, session: AsyncSession):
     """
     Test the get_user_shipments function
     """
@@ -25,7 +25,7 @@ async def test_get_user_shipments(account: AccountProfile, session: Session):
 
 
 @pytest.mark.asyncio
-async def test_get_user_shipment(account: AccountProfile, shipment_id: UUID, session: Session):
+async def test_get_user_shipment(account: AccountProfile, shipment_id: UUID, session: AsyncSession):
     """
     Test the get_user_shipment function
     """
@@ -35,7 +35,7 @@ async def test_get_user_shipment(account: AccountProfile, shipment_id: UUID, ses
 
 
 @pytest.mark.asyncio
-async def test_get_invalid_user_shipment(account: AccountProfile, session: Session):
+async def test_get_invalid_user_shipment(account: AccountProfile, session: AsyncSession):
     """
     Test the get_user_shipment function with an invalid shipment ID
     """
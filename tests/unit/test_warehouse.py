@@ -0,0 +1,101 @@
+"""
+Unit tests for reserving & releasing warehouse stock.
+"""
+
+__author__ = "Justin B. (justin@justin.directory)"
+
+from uuid import UUID
+
+import pytest
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.schemas import WarehouseItem
+from app.inventory.allocation import OutOfStockException
+from app.inventory.warehouse import (release_warehouse_stock,
+                                     reserve_warehouse_stock)
+from app.shipping.models import ShipmentItem
+from tests.conftest import test_warehouses
+
+east, south = test_warehouses[0].warehouse_id, test_warehouses[1].warehouse_id
+
+
+async def get_stock(session: AsyncSession, warehouse_id: UUID, upcs: list[int]) -> list[int]:
+    stock = dict((await session.execute(
+        select(WarehouseItem.upc, WarehouseItem.stock)
+        .where(WarehouseItem.warehouse_id == warehouse_id)
+        .where(WarehouseItem.upc.in_(upcs))
+    )).all())
+    return [stock[upc] for upc in upcs]
+
+
+@pytest.mark.asyncio
+async def test_reserve_stock(session: AsyncSession, count_queries):
+    """
+    Tests that stock is reserved with one query per warehouse, and one query to check it.
+    """
+    east_before = await get_stock(session, east, [3, 4])
+    south_before = await get_stock(session, south, [3])
+
+    _, queries = await count_queries(reserve_warehouse_stock(session, {
+        east: [ShipmentItem(upc=3, stock=2), ShipmentItem(upc=4, stock=1), ShipmentItem(upc=3, stock=1)],
+        south: [ShipmentItem(upc=3, stock=4)]
+    }))
+
+    assert queries == 3
+    assert await get_stock(session, east, [3, 4]) == [east_before[0] - 3, east_before[1] - 1]
+    assert await get_stock(session, south, [3]) == [south_before[0] - 4]
+
+    await release_warehouse_stock(session, {
+        east: [ShipmentItem(upc=3, stock=3), ShipmentItem(upc=4, stock=1)],
+        south: [ShipmentItem(upc=3, stock=4)]
+    })
+
+    assert await get_stock(session, east, [3, 4]) == east_before
+    assert await get_stock(session, south, [3]) == south_before
+
+
+@pytest.mark.asyncio
+async def test_reserve_stock_reports_short_upcs(session: AsyncSession):
+    """
+    Tests that a reservation with any short items reports all of them, and removes no stock.
+    """
+    east_before = await get_stock(session, east, [3, 4])
+
+    with pytest.raises(OutOfStockException) as e:
+        await reserve_warehouse_stock(session, {
+            east: [ShipmentItem(upc=3, stock=1), ShipmentItem(upc=4, stock=east_before[1] + 1)],
+            south: [ShipmentItem(upc=404, stock=1)]
+        })
+
+    assert e.value.upcs == {east: [4], south: [404]}
+    assert await get_stock(session, east, [3, 4]) == east_before
+
+
+@pytest.mark.asyncio
+async def test_reserve_stock_reports_raced_upcs(session: AsyncSession, monkeypatch: pytest.MonkeyPatch):
+    """
+    Tests that stock taken by another order between the check & the update is reported by UPC.
+    """
+    execute = session.execute
+
+    async def execute_after_race(statement, *args, **kwargs):
+        result = await execute(statement, *args, **kwargs)
+        if statement.is_select and statement.get_final_froms()[0].name == "warehouse_items":
+            # Another order takes the stock of UPC 4 once it has been checked.
+            monkeypatch.setattr(session, "execute", execute)
+            await execute(
+                update(WarehouseItem)
+                .where(WarehouseItem.warehouse_id == east)
+                .where(WarehouseItem.upc == 4)
+                .values(stock=0)
+            )
+        return result
+
+    monkeypatch.setattr(session, "execute", execute_after_race)
+    with pytest.raises(OutOfStockException) as e:
+        await reserve_warehouse_stock(session, {
+            east: [ShipmentItem(upc=3, stock=1), ShipmentItem(upc=4, stock=1)]
+        })
+
+    assert e.value.upcs == {east: [4]}